@@ -0,0 +1,1050 @@
+# -*- coding: utf-8 -*-
+"""
+An in-memory implementation of the RETE network in rete.models.
+
+It exposes the same interface as rete.models.Rete, and takes the same
+Production and Triple instances as input, but keeps its alphanodes, beta
+memories and tokens in plain Python objects instead of database rows, so
+matching never touches the database. The network only lives as long as the
+process.
+"""
+import os
+import time
+from collections import OrderedDict
+
+from django.db import transaction
+
+from triple.constants import FIELD_INDEXES, FIELD_IDX_TO_NAME
+from triple.models import Triple
+
+from constants import *
+from models import Condition, Production, JoinPlan, ThresholdIndex, \
+    alpha_value, passes_constant_test, get_join_signature, plan_conditions, \
+    get_extraction_plan, extract_variables, iter_chunks, _print
+from snapshot import Snapshot, NONE, from_int
+
+class AlphaNode(object):
+    """
+    Tests a working memory element for a constant condition.
+    """
+
+    __slots__ = (
+        'id',
+        'field',
+        'operation',
+        'value',
+        'parent',
+        'children',
+        'inequalities',
+        'items',
+        'successors',
+    )
+
+    def __init__(self, id, field=None, operation=None, value=None, parent=None):
+        self.id = id
+        self.field = field
+        self.operation = operation
+        self.value = value
+        self.parent = parent
+        # {(field,operation,value):AlphaNode}
+        self.children = {}
+        # {field:ThresholdIndex}, over the children with inequality tests.
+        self.inequalities = {}
+        # {wme id:wme}
+        self.items = OrderedDict()
+        # [BetaJoinNode], in order of creation.
+        self.successors = []
+
+    def __repr__(self):
+        return "<%s:%i %s %s %s>" % (type(self).__name__, self.id, self.field_name, self.operation_name, self.value)
+
+    @property
+    def field_name(self):
+        return FIELD_IDX_TO_NAME.get(self.field)
+
+    @property
+    def operation_name(self):
+        return OP_IDX_TO_NAME.get(self.operation)
+
+    def test(self, wme):
+        """
+        Returns true if the working memory element passes our constant test.
+        """
+        return passes_constant_test(self.operation, self.value, getattr(wme, FIELD_IDX_TO_NAME[self.field]))
+
+    def add_child(self, node):
+        self.children[(node.field, node.operation, node.value)] = node
+        if node.operation != EQ_IDX:
+            self.inequalities.setdefault(node.field, ThresholdIndex()).add(node.operation, node.value, node)
+
+    def remove_child(self, node):
+        del self.children[(node.field, node.operation, node.value)]
+        if node.operation != EQ_IDX:
+            self.inequalities[node.field].remove(node.operation, node.value, node)
+
+    def get_matching_children(self, wme):
+        """
+        Returns the child alphanodes whose constant test is passed by the
+        working memory element.
+        """
+        children = []
+        for field_idx in FIELD_INDEXES:
+            field_value = getattr(wme, FIELD_IDX_TO_NAME[field_idx])
+            child = self.children.get((field_idx, EQ_IDX, alpha_value(field_value)))
+            if child:
+                children.append(child)
+            if field_idx in self.inequalities:
+                children.extend(self.inequalities[field_idx].get_matches(field_value))
+        return children
+
+    def memory_activation(self, wme):
+        """
+        Adds a working memory element to the alphanode's memory.
+        [Production Matching for Large Learning Systems, Page 21]
+        """
+        self.items[wme.id] = wme
+        for betanode in reversed(self.successors):
+            betanode.right_activation(wme)
+
+class BetaMemoryNode(object):
+    """
+    Stores partial instantiations of productions (i.e. partial matches).
+    """
+
+    __slots__ = (
+        'id',
+        'parent',
+        'tokens',
+        'children',
+    )
+
+    def __init__(self, id, parent):
+        self.id = id
+        self.parent = parent
+        # {Token:None}, in order of activation.
+        self.tokens = OrderedDict()
+        # [BetaJoinNode]
+        self.children = []
+
+    def __repr__(self):
+        return "<%s:%i>" % (type(self).__name__, self.id)
+
+    @property
+    def rete(self):
+        return self.parent.rete
+
+    def left_activation(self, token, wme):
+        """
+        Builds a token, adds it to the beta memory's list of tokens, and
+        informs each child.
+        [Production Matching for Large Learning Systems, Page 23]
+        """
+        new_token = Token(token, wme, self)
+        self.tokens[new_token] = None
+        for child in self.children:
+            child.left_activation(new_token)
+
+    def remove_token(self, token):
+        del self.tokens[token]
+
+class TestAtJoinNode(object):
+    """
+    "...specifies the locations of the two felds whose values must be equal in
+    order for some variable to be bound consistently."
+    [Production Matching for Large Learning Systems, Page 24]
+    """
+
+    __slots__ = (
+        'id',
+        'field_of_arg1',
+        'condition_number_of_arg2',
+        'field_of_arg2',
+        'expression',
+    )
+
+    def __init__(self, id, field_of_arg1=None, condition_number_of_arg2=None, field_of_arg2=None, expression=None):
+        self.id = id
+        self.field_of_arg1 = field_of_arg1
+        self.condition_number_of_arg2 = condition_number_of_arg2
+        self.field_of_arg2 = field_of_arg2
+        self.expression = expression
+
+    def __repr__(self):
+        if self.expression:
+            return "<%s: %s>" % (type(self).__name__, self.expression)
+        return "<%s: wme.%s == token[%i].wme.%s>" % (
+            type(self).__name__,
+            FIELD_IDX_TO_NAME[self.field_of_arg1],
+            self.condition_number_of_arg2,
+            FIELD_IDX_TO_NAME[self.field_of_arg2],
+        )
+
+    @property
+    def signature(self):
+        return (self.field_of_arg1, self.condition_number_of_arg2, self.field_of_arg2, self.expression)
+
+class BetaJoinNode(object):
+    """
+    Joins the tokens in its parent beta memory against the WMEs in its
+    alphanode's memory.
+    [Production Matching for Large Learning Systems, Page 24]
+    """
+
+    __slots__ = (
+        'id',
+        'parent',
+        'alphanode',
+        'tests',
+        'signature',
+        'join_plan',
+        'child',
+        'pnodes',
+        'rete',
+    )
+
+    def __init__(self, id, rete, parent, alphanode, tests):
+        self.id = id
+        self.rete = rete
+        self.parent = parent
+        self.alphanode = alphanode
+        self.tests = tests
+        self.signature = get_join_signature(parent.id if parent else None, alphanode.id, tests)
+        self.join_plan = JoinPlan(tests)
+        self.child = None
+        self.pnodes = []
+
+    def __repr__(self):
+        return "<%s:%i>" % (type(self).__name__, self.id)
+
+    @property
+    def children(self):
+        if self.child:
+            yield self.child
+        for pnode in self.pnodes:
+            yield pnode
+
+    def left_activation(self, token):
+        """
+        Joins a token newly added to the parent beta memory against the
+        alpha memory.
+        [Production Matching for Large Learning Systems, Page 24-25]
+        """
+        for wme in self.alphanode.items.values():
+            if self.join_plan(token, wme):
+                for child in list(self.children):
+                    child.left_activation(token, wme)
+
+    def right_activation(self, wme, children=None):
+        """
+        Joins a WME newly added to the alpha memory against the parent beta
+        memory, or against the dummy top token if we have no parent.
+        [Production Matching for Large Learning Systems, Page 24-25]
+        """
+        if self.parent:
+            tokens = list(self.parent.tokens)
+        else:
+            tokens = [self.rete.dummy_token]
+        for token in tokens:
+            if self.join_plan(token, wme):
+                for child in (children or list(self.children)):
+                    child.left_activation(token, wme)
+
+class Token(object):
+    """
+    Represents a list of working memory elements.
+    """
+
+    __slots__ = (
+        'parent',
+        'wme',
+        'index',
+        'wmes',
+        'children',
+        'node',
+    )
+
+    def __init__(self, parent=None, wme=None, node=None):
+        self.parent = parent
+        self.wme = wme
+        self.node = node
+        self.children = []
+        if parent is None:
+            self.index = 0
+            self.wmes = ()
+        else:
+            self.index = parent.index + 1
+            self.wmes = parent.wmes + (wme,)
+            parent.children.append(self)
+            node.rete.tokens_by_wme.setdefault(wme.id, set()).add(self)
+
+    def __repr__(self):
+        return "<%s:%i %s>" % (type(self).__name__, self.index, self.wme)
+
+    def get_wmes(self):
+        return list(self.wmes)
+
+    def get_wme(self, index):
+        if index < 1 or index > len(self.wmes):
+            return
+        return self.wmes[index-1]
+
+    def get_list(self):
+        return list(reversed(self.wmes))
+
+class PNode(object):
+    """
+    Links a production to beta join node.
+    """
+
+    __slots__ = (
+        'production',
+        'parent',
+        'tokens',
+        'condition_ids',
+        '_triggered',
+    )
+
+    def __init__(self, production, parent, condition_ids=None):
+        self.production = production
+        self.parent = parent
+        # {Token:None}, in order of activation.
+        self.tokens = OrderedDict()
+        # [condition id], in the order they were joined, if reordered.
+        self.condition_ids = condition_ids
+        self._triggered = 0
+
+    def __repr__(self):
+        return "<%s:%s>" % (type(self).__name__, self.production.name)
+
+    @property
+    def rete(self):
+        return self.parent.rete
+
+    @property
+    def triggered(self):
+        return self._triggered
+
+    def left_activation(self, token, wme):
+        """
+        Records the final token chain and marks the production as triggered.
+        """
+        new_token = Token(token, wme, self)
+        self.tokens[new_token] = None
+        self._triggered += 1
+        self.rete._activations.append((self.production, True, new_token.get_list()))
+
+    def remove_token(self, token):
+        del self.tokens[token]
+        self._triggered -= 1
+        self.rete._activations.append((self.production, False, token.get_list()))
+
+    @property
+    def token_list(self):
+        return list(self.tokens)
+
+    @property
+    def matches(self):
+        """
+        Iterates over each unique match set.
+        """
+        for token in self.token_list:
+            yield token.get_list()
+
+    @property
+    def conditions(self):
+        """
+        Returns the production's conditions in the order they were joined.
+        """
+        conditions = list(self.production.conditions.all().order_by('id'))
+        if not self.condition_ids:
+            return conditions
+        conditions = dict((c.id, c) for c in conditions)
+        return [conditions[_id] for _id in self.condition_ids]
+
+    @property
+    def match_variables(self):
+        """
+        Iterates over the variable bindings for each match set.
+        Conditions are visited in their defined order, even if they were
+        joined in another.
+        """
+        plan = get_extraction_plan(self.conditions)
+        for token in self.token_list:
+            yield extract_variables(plan, token.wmes)
+
+class Rete(object):
+    """
+    Encapsulates the top-level interface for an in-memory RETE network,
+    with the same interface as rete.models.Rete.
+    """
+
+    __slots__ = (
+        'alphanode_top',
+        'dummy_token',
+        'pnodes',
+        'tokens_by_wme',
+        '_pnodes_by_production',
+        '_alphanodes_by_wme',
+        '_joins_by_signature',
+        '_activations',
+        '_pruned',
+        '_last_id',
+    )
+
+    def __init__(self):
+        self._last_id = 0
+        self.alphanode_top = AlphaNode(id=self._next_id())
+        self.dummy_token = Token()
+        self.pnodes = []
+        # {wme id:set(Token)}
+        self.tokens_by_wme = {}
+        # {production id:PNode}
+        self._pnodes_by_production = {}
+        # {wme id:[AlphaNode]}
+        self._alphanodes_by_wme = {}
+        # {signature:BetaJoinNode}
+        self._joins_by_signature = {}
+        # [(production, added, [wme])], where an activation's sequence number
+        # is its position plus one, plus the number pruned.
+        self._activations = []
+        self._pruned = 0
+
+    def _next_id(self):
+        self._last_id += 1
+        return self._last_id
+
+    def save(self):
+        """
+        Does nothing, since the network isn't persisted, but allows the
+        network to be constructed like rete.models.Rete.
+        """
+        return self
+
+    @property
+    def items(self):
+        return self.alphanode_top.items.values()
+
+    def dump(self, path):
+        """
+        Writes the network's state to a snapshot file.
+        """
+        snapshot = Snapshot()
+
+        # Alphanodes, parents first.
+        anodes = {} # {AlphaNode:index}
+        pending = [self.alphanode_top]
+        while pending:
+            node = pending.pop(0)
+            anodes[node] = snapshot.append('ANOD', anodes.get(node.parent), node.field, node.operation, snapshot.add_string(node.value))
+            for wme_id in node.items:
+                snapshot.append('AMEM', anodes[node], wme_id)
+            pending.extend(sorted(node.children.values(), key=lambda n: n.id))
+
+        # Beta nodes, parents first.
+        joins = {} # {BetaJoinNode:index}
+        memories = {} # {BetaMemoryNode:index}
+        pending = sorted(set(n for anode in anodes for n in anode.successors if n.parent is None), key=lambda n: n.id, reverse=True)
+        while pending:
+            node = pending.pop()
+            first_test = snapshot.count('TEST')
+            for test in node.tests:
+                snapshot.append('TEST', test.field_of_arg1, test.condition_number_of_arg2, test.field_of_arg2, snapshot.add_string(test.expression))
+            joins[node] = snapshot.append('JOIN', memories.get(node.parent), anodes[node.alphanode], first_test, len(node.tests))
+            if node.child:
+                memories[node.child] = snapshot.append('BMEM', joins[node])
+                pending.extend(reversed(node.child.children))
+
+        # Tokens, parents first.
+        tokens = {} # {Token:index}
+        for memory,i in sorted(memories.items(), key=lambda item: item[1]):
+            for token in memory.tokens:
+                tokens[token] = snapshot.append('TOKN', tokens.get(token.parent), token.wme.id, i, None)
+        for pnode in self.pnodes:
+            i = snapshot.append('PNOD', pnode.production.id, joins[pnode.parent], pnode._triggered)
+            for condition_id in pnode.condition_ids or []:
+                snapshot.append('PCND', i, condition_id)
+            for token in pnode.tokens:
+                snapshot.append('TOKN', tokens.get(token.parent), token.wme.id, None, i)
+
+        snapshot.write(path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Creates a network from a snapshot file, written by this class's or
+        rete.models.Rete's dump().
+        """
+        snapshot = Snapshot.read(path)
+        rete = cls()
+
+        def in_bulk(model, ids):
+            objects = {}
+            for chunk in iter_chunks(set(ids)):
+                objects.update(model.objects.in_bulk(chunk))
+            missing = set(ids).difference(objects)
+            assert not missing, "Missing %s ids: %s" % (model.__name__, sorted(missing))
+            return objects
+        wmes = in_bulk(Triple,
+            [wme_id for _,wme_id in snapshot.records('AMEM')] +
+            [wme_id for _,wme_id,_,_ in snapshot.records('TOKN')])
+        productions = in_bulk(Production,
+            [production_id for production_id,_,_ in snapshot.records('PNOD')])
+
+        anodes = []
+        for parent,field,operation,value in snapshot.records('ANOD'):
+            if parent == NONE:
+                node = rete.alphanode_top
+            else:
+                parent = anodes[parent]
+                value = snapshot.get_string(value)
+                node = AlphaNode(rete._next_id(), field=from_int(field), operation=from_int(operation), value=value, parent=parent)
+                parent.add_child(node)
+            anodes.append(node)
+        for i,wme_id in snapshot.records('AMEM'):
+            anodes[i].items[wme_id] = wmes[wme_id]
+            rete._alphanodes_by_wme.setdefault(wme_id, []).append(anodes[i])
+
+        tests = [TestAtJoinNode(rete._next_id(),
+                                field_of_arg1=from_int(field1),
+                                condition_number_of_arg2=from_int(condition_number),
+                                field_of_arg2=from_int(field2),
+                                expression=snapshot.get_string(expression))
+                 for field1,condition_number,field2,expression in snapshot.records('TEST')]
+        memory_indexes = dict((parent,i) for i,(parent,) in enumerate(snapshot.records('BMEM'))) # {join index:memory index}
+        joins = []
+        memories = [None]*len(memory_indexes)
+        for i,(parent,anode,first_test,test_count) in enumerate(snapshot.records('JOIN')):
+            parent = memories[parent] if parent != NONE else None
+            node = BetaJoinNode(rete._next_id(), rete, parent, anodes[anode], tests[first_test:first_test+test_count])
+            rete._joins_by_signature[node.signature] = node
+            if parent:
+                parent.children.append(node)
+            node.alphanode.successors.append(node)
+            joins.append(node)
+            if i in memory_indexes:
+                node.child = memories[memory_indexes[i]] = BetaMemoryNode(rete._next_id(), node)
+
+        pnodes = []
+        for production_id,parent,triggered in snapshot.records('PNOD'):
+            pnode = PNode(productions[production_id], joins[parent])
+            pnode._triggered = triggered
+            pnode.parent.pnodes.append(pnode)
+            rete.pnodes.append(pnode)
+            rete._pnodes_by_production[production_id] = pnode
+            pnodes.append(pnode)
+        for i,condition_id in snapshot.records('PCND'):
+            pnodes[i].condition_ids = (pnodes[i].condition_ids or []) + [condition_id]
+
+        tokens = []
+        for parent,wme_id,memory,pnode in snapshot.records('TOKN'):
+            owner = memories[memory] if memory != NONE else pnodes[pnode]
+            token = Token(tokens[parent] if parent != NONE else rete.dummy_token, wmes[wme_id], owner)
+            owner.tokens[token] = None
+            tokens.append(token)
+
+        return rete
+
+    @property
+    def triggered_pnodes(self):
+        return [pnode for pnode in self.pnodes if pnode._triggered]
+
+    def add_production(self, production, reorder=False, conditions=None):
+        """
+        Populates the RETE network from the production's conditions.
+        [Production Matching for Large Learning Systems, Page 37]
+
+        If reorder is true, the conditions are joined in the order chosen by
+        plan_conditions() instead of the order they were defined.
+
+        conditions := Optional list of the production's conditions, in the
+            order to join them, overriding reorder.
+        """
+        assert isinstance(production, Production)
+        condition_ids = None
+        if conditions is not None:
+            conditions = list(conditions)
+            condition_ids = [c.id for c in conditions]
+        else:
+            conditions = list(production.conditions.all().order_by('id'))
+        assert len(conditions) >= 1, "Production must have at least 1 condition."
+        if reorder and condition_ids is None:
+            conditions = plan_conditions(conditions, self.get_condition_cardinality)
+            condition_ids = [c.id for c in conditions]
+        assert production.id not in self._pnodes_by_production, "Production %s already added." % (production,)
+
+        bc = {} # binding_condition, {variable name: index of last condition to reference this variable}
+        bf = {} # binding_field, {variable name: index of last field to reference this variable}
+        earlier_conds = []
+
+        condition = conditions[0]
+        tests = self.get_join_tests_from_condition(condition, earlier_conds, bc, bf)
+        alphanode = self.build_or_share_alpha_memory(condition)
+        current_node = self.build_or_share_join_node(None, alphanode, tests)
+        condition0 = condition
+
+        for condition in conditions[1:]:
+            current_node = self.build_or_share_beta_memory_node(current_node)
+            if condition0:
+                earlier_conds.append(condition0)
+            tests = self.get_join_tests_from_condition(condition, earlier_conds, bc, bf)
+            if condition.expression:
+                # Expression tests are joined against the last alpha memory,
+                # and aren't included in index calculations.
+                current_node = self.build_or_share_join_node(current_node, alphanode, tests)
+                condition0 = None
+            else:
+                alphanode = self.build_or_share_alpha_memory(condition)
+                current_node = self.build_or_share_join_node(current_node, alphanode, tests)
+                condition0 = condition
+
+        # Create and link pnode.
+        pnode = PNode(production, current_node, condition_ids)
+        current_node.pnodes.append(pnode)
+        self.pnodes.append(pnode)
+        self._pnodes_by_production[production.id] = pnode
+        self.update_new_node_with_matches_from_above(pnode)
+        return pnode
+
+    def add_productions(self, productions, reorder=False):
+        """
+        Populates the RETE network from the conditions of several productions.
+        Returns the new pnodes, in the order of the productions.
+        """
+        return [self.add_production(production, reorder=reorder) for production in productions]
+
+    def match_changes(self, since=0, productions=None):
+        """
+        Iterates over the matches added or removed after the given sequence
+        number, in order, as (sequence number, production, added, [wme])
+        tuples, like rete.models.Rete.match_changes().
+
+        Note, sequence numbers restart when a snapshot is loaded.
+        """
+        production_ids = None
+        if productions is not None:
+            production_ids = set(getattr(p, 'id', p) for p in productions)
+        for i in xrange(max(since - self._pruned, 0), len(self._activations)):
+            production,added,match = self._activations[i]
+            if production_ids is None or production.id in production_ids:
+                yield self._pruned+i+1, production, added, match
+
+    def prune_match_changes(self, through=None):
+        """
+        Discards the logged matches with sequence numbers up to and including
+        the given one, or all of them if none is given, except the latest,
+        like rete.models.Rete.prune_match_changes().
+        Returns the number of changes discarded.
+        """
+        if through is None:
+            through = self._pruned + len(self._activations)
+        count = min(max(through - self._pruned, 0), len(self._activations) - 1)
+        if count <= 0:
+            return 0
+        del self._activations[:count]
+        self._pruned += count
+        return count
+
+    def get_condition_cardinality(self, condition):
+        """
+        Estimates the number of WMEs matching the condition, as the size of
+        the deepest existing alpha memory on the condition's constant tests.
+        """
+        node = self.alphanode_top
+        for field_idx,op_idx,field_value in condition.constant_tests:
+            child = node.children.get((field_idx, op_idx, alpha_value(field_value)))
+            if child is None:
+                break
+            node = child
+        return len(node.items)
+
+    def add_wme(self, triple):
+        """
+        Adds working memory element to the RETE network.
+        [Production Matching for Large Learning Systems, Page 14-15]
+        """
+        assert isinstance(triple, Triple)
+        if triple.id in self.alphanode_top.items:
+            return
+        _print('ADDING WME:',triple)
+        anodes = []
+        pending = [self.alphanode_top]
+        while pending:
+            node = pending.pop(0)
+            anodes.append(node)
+            pending.extend(node.get_matching_children(triple))
+        self._alphanodes_by_wme[triple.id] = anodes
+        for node in anodes:
+            node.memory_activation(triple)
+
+    def add_wmes(self, triples):
+        """
+        Adds a batch of working memory elements to the RETE network.
+        """
+        for triple in triples:
+            self.add_wme(triple)
+
+    def remove_wme(self, wme):
+        """
+        Removes a working memory element from the RETE network.
+        [Production Matching for Large Learning Systems, Page 30]
+        """
+        assert isinstance(wme, Triple)
+        if wme.id not in self.alphanode_top.items:
+            return
+        for anode in self._alphanodes_by_wme.pop(wme.id, []):
+            del anode.items[wme.id]
+        for token in list(self.tokens_by_wme.get(wme.id, [])):
+            # A token may hold the same WME as its ancestor, as with
+            # expression tests or self-joins, and so be deleted along with it.
+            if token not in self.tokens_by_wme.get(wme.id, ()):
+                continue
+            self.delete_token_and_descendents(token)
+
+    def remove_production(self, production):
+        """
+        Removes a production and all it's dependencies from the network.
+        [Production Matching for Large Learning Systems, Page 38]
+        """
+        pnode = self._pnodes_by_production.pop(production.id)
+        self.pnodes.remove(pnode)
+        self.delete_node_and_any_unused_ancestors(pnode)
+
+    def delete_token_and_descendents(self, token):
+        """
+        Removes a token and all descendent tokens.
+        [Production Matching for Large Learning Systems, Page 31]
+        """
+        while token.children:
+            self.delete_token_and_descendents(token.children[-1])
+        token.node.remove_token(token)
+        token.parent.children.remove(token)
+        tokens = self.tokens_by_wme[token.wme.id]
+        tokens.discard(token)
+        if not tokens:
+            del self.tokens_by_wme[token.wme.id]
+
+    def delete_node_and_any_unused_ancestors(self, node):
+        """
+        [Production Matching for Large Learning Systems, Page 39]
+        """
+        if isinstance(node, BetaJoinNode):
+            del self._joins_by_signature[node.signature]
+            alphanode = node.alphanode
+            alphanode.successors.remove(node)
+            self.delete_alpha_memory(alphanode)
+            parent = node.parent
+            if parent:
+                parent.children.remove(node)
+                if not parent.children:
+                    self.delete_node_and_any_unused_ancestors(parent)
+        else:
+            for token in list(node.tokens):
+                self.delete_token_and_descendents(token)
+            parent = node.parent
+            if isinstance(node, PNode):
+                parent.pnodes.remove(node)
+            else:
+                parent.child = None
+            if not list(parent.children):
+                self.delete_node_and_any_unused_ancestors(parent)
+
+    def delete_alpha_memory(self, alphanode):
+        """
+        Removes an unused alphanode, along with any of its ancestors left
+        without a use.
+        """
+        while alphanode.parent is not None and not alphanode.successors and not alphanode.children:
+            parent = alphanode.parent
+            parent.remove_child(alphanode)
+            for wme_id in alphanode.items:
+                self._alphanodes_by_wme[wme_id].remove(alphanode)
+            alphanode = parent
+
+    def build_or_share_alpha_memory(self, condition):
+        """
+        Finds or creates the alphanodes testing the condition's constants.
+        [Production Matching for Large Learning Systems, Page 35].
+
+        Returns the last alphanode/memory used by the condition.
+        """
+        assert isinstance(condition, Condition)
+        current_node = self.alphanode_top
+        for field_idx,op_idx,field_value in condition.constant_tests:
+            key = (field_idx, op_idx, alpha_value(field_value))
+            child = current_node.children.get(key)
+            if child is None:
+                child = AlphaNode(id=self._next_id(), field=field_idx, operation=op_idx, value=key[2], parent=current_node)
+                current_node.add_child(child)
+
+                # Initialize the new alpha memory with the current WMEs that
+                # pass its test.
+                for wme in current_node.items.values():
+                    if child.test(wme):
+                        child.items[wme.id] = wme
+                        self._alphanodes_by_wme[wme.id].append(child)
+            current_node = child
+        return current_node
+
+    def build_or_share_beta_memory_node(self, parent):
+        """
+        Creates a BetaMemoryNode.
+        [Production Matching for Large Learning Systems, Page 34]
+        """
+        if parent.child:
+            return parent.child
+        new_node = BetaMemoryNode(self._next_id(), parent)
+        parent.child = new_node
+        self.update_new_node_with_matches_from_above(new_node)
+        return new_node
+
+    def build_or_share_join_node(self, betamemory, alphanode, tests):
+        """
+        Creates a BetaJoinNode.
+        [Production Matching for Large Learning Systems, Page 34]
+        """
+        node = self._joins_by_signature.get(get_join_signature(betamemory.id if betamemory else None, alphanode.id, tests))
+        if node:
+            return node
+        node = BetaJoinNode(self._next_id(), self, betamemory, alphanode, tests)
+        self._joins_by_signature[node.signature] = node
+        if betamemory:
+            betamemory.children.append(node)
+        alphanode.successors.append(node)
+        return node
+
+    def get_join_tests_from_condition(self, condition, earlier_conds, binding_condition, binding_field):
+        """
+        Creates join tests from conditions. These describe the relationships
+        between variables contained across multiple conditions.
+        [Production Matching for Large Learning Systems, Page 35]
+        """
+        tests = []
+        _binding_condition = {} # {variable name:last condition index using variable name}
+        _binding_field = {} # {variable name:last field index used}
+        if condition.expression:
+            # Convert variables within the expression into:
+            # (field,condition-index) format.
+            expr = condition.expression
+            for var in condition.test_variables:
+                var_name = var[1:]
+                expr = expr.replace(var, "_v(%i,%i)" % (binding_condition[var_name],binding_field[var_name]))
+            tests.append(TestAtJoinNode(self._next_id(), expression=expr))
+        else:
+            for field_idx,var_name in condition.variable_bindings:
+                # If variable name occurs anywhere in earlier-conds then create a test.
+                if var_name in binding_condition:
+                    tests.append(TestAtJoinNode(self._next_id(),
+                        field_of_arg1=field_idx,
+                        condition_number_of_arg2=binding_condition[var_name],
+                        field_of_arg2=binding_field[var_name]))
+                # Record usage for next iteration.
+                _binding_condition[var_name] = len(earlier_conds)+1
+                _binding_field[var_name] = field_idx
+        binding_condition.update(_binding_condition)
+        binding_field.update(_binding_field)
+        return tests
+
+    def update_new_node_with_matches_from_above(self, new_node):
+        """
+        Updates new beta memory or beta join nodes with match data.
+        [Production Matching for Large Learning Systems, Page 38]
+        """
+        parent = new_node.parent
+        if isinstance(parent, BetaMemoryNode):
+            for token in list(parent.tokens):
+                new_node.left_activation(token)
+        else:
+            for wme in parent.alphanode.items.values():
+                parent.right_activation(wme, children=[new_node])
+
+class WriteBehindRete(Rete):
+    """
+    An in-memory network whose changes are written behind to a database
+    network.
+
+    WMEs and productions are matched in process, and each change is appended
+    to a journal file, then applied to the database network in batched
+    transactions once enough changes are pending, once enough time has
+    passed, or when flush() is called. Elapsed time is only checked when a
+    change is made or flush_if_due() is called, so a process that may sit
+    idle with pending changes should call flush_if_due() periodically.
+    Changes still in the journal when the process dies are replayed into the
+    database network by the next instance using the same journal.
+    """
+
+    __slots__ = (
+        'target',
+        'journal_path',
+        'interval',
+        'max_pending',
+        'sync',
+        '_journal',
+        '_pending',
+        '_last_flush',
+    )
+
+    ADD_WME = 'add_wme'
+    REMOVE_WME = 'remove_wme'
+    ADD_PRODUCTION = 'add_production'
+    REMOVE_PRODUCTION = 'remove_production'
+
+    def __init__(self, target, journal_path, interval=60, max_pending=1000, sync=True):
+        """
+        Parameters:
+
+        target := The rete.models.Rete network to persist changes to.
+        journal_path := The file recording changes not yet persisted.
+        interval := The maximum number of seconds between flushes.
+        max_pending := The maximum number of changes between flushes.
+        sync := If true, each journal entry is synced to disk before the
+                change is applied.
+        """
+        super(WriteBehindRete, self).__init__()
+        self.target = target
+        self.journal_path = journal_path
+        self.interval = interval
+        self.max_pending = max_pending
+        self.sync = sync
+        self._pending = [] # [(operation, Triple or Production, condition ids)]
+        self._last_flush = time.time()
+
+        # Persist any changes left over from a previous process.
+        self._pending = self.read_journal(journal_path)
+        self._journal = open(journal_path, 'a')
+        self.flush()
+
+        # Rebuild the in-process network from the persisted one, joining
+        # each production's conditions in the same order.
+        for pnode in target.pnodes.all().select_related('production').order_by('id'):
+            conditions = pnode.conditions if pnode._condition_ids else None
+            super(WriteBehindRete, self).add_production(pnode.production, conditions=conditions)
+        for wme in target.items.order_by('id'):
+            super(WriteBehindRete, self).add_wme(wme)
+
+    @classmethod
+    def read_journal(cls, journal_path):
+        """
+        Returns the list of (operation, Triple or Production, condition ids)
+        changes recorded in a journal file. Condition ids are the order a
+        reordered production's conditions were joined in, and otherwise None.
+        A trailing partial entry, from a write interrupted by a crash, is
+        ignored.
+        """
+        if not os.path.isfile(journal_path):
+            return []
+        entries = []
+        fin = open(journal_path, 'r')
+        try:
+            for line in fin:
+                if not line.endswith('\n'):
+                    break
+                parts = line.split()
+                condition_ids = None
+                if len(parts) > 2:
+                    condition_ids = map(int, parts[2].split(','))
+                entries.append((parts[0], int(parts[1]), condition_ids))
+        finally:
+            fin.close()
+        objects = {} # {model:{id:object}}
+        for model,operations in ((Triple, (cls.ADD_WME, cls.REMOVE_WME)),
+                                 (Production, (cls.ADD_PRODUCTION, cls.REMOVE_PRODUCTION))):
+            ids = [_id for operation,_id,_ in entries if operation in operations]
+            objects[model] = {}
+            for chunk in iter_chunks(set(ids)):
+                objects[model].update(model.objects.in_bulk(chunk))
+        changes = []
+        for operation,_id,condition_ids in entries:
+            model = Triple if operation in (cls.ADD_WME, cls.REMOVE_WME) else Production
+            if _id in objects[model]:
+                changes.append((operation, objects[model][_id], condition_ids))
+        return changes
+
+    def _record(self, operation, obj, condition_ids=None):
+        """
+        Journals a change, and flushes pending changes if they're due.
+        """
+        if condition_ids:
+            self._journal.write('%s %i %s\n' % (operation, obj.id, ','.join(map(str, condition_ids))))
+        else:
+            self._journal.write('%s %i\n' % (operation, obj.id))
+        self._journal.flush()
+        if self.sync:
+            os.fsync(self._journal.fileno())
+        self._pending.append((operation, obj, condition_ids))
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """
+        Flushes pending changes if enough are pending, or if the interval has
+        passed since the last flush.
+        Returns true if changes were flushed.
+        """
+        if not self._pending:
+            return False
+        if len(self._pending) >= self.max_pending or time.time() - self._last_flush >= self.interval:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """
+        Applies all pending changes to the database network in a single
+        transaction, then clears the journal.
+        """
+        if self._pending:
+            target = self.target
+            with transaction.commit_on_success():
+                wmes = []
+                for operation,obj,condition_ids in self._pending:
+                    if operation == self.ADD_WME:
+                        wmes.append(obj)
+                        continue
+                    target.add_wmes(wmes)
+                    wmes = []
+                    if operation == self.REMOVE_WME:
+                        target.remove_wme(obj)
+                    elif operation == self.ADD_PRODUCTION:
+                        if not target.pnodes.filter(production=obj).count():
+                            # Join a reordered production's conditions in
+                            # the order the in-process network used.
+                            conditions = None
+                            if condition_ids:
+                                conditions = dict((c.id, c) for c in obj.conditions.all())
+                                conditions = [conditions[_id] for _id in condition_ids]
+                            target.add_production(obj, conditions=conditions)
+                    elif operation == self.REMOVE_PRODUCTION:
+                        if target.pnodes.filter(production=obj).count():
+                            target.remove_production(obj)
+                target.add_wmes(wmes)
+            self._pending = []
+        self._journal.truncate(0)
+        self._journal.flush()
+        self._last_flush = time.time()
+
+    def close(self):
+        """
+        Flushes pending changes and closes the journal.
+        """
+        self.flush()
+        self._journal.close()
+
+    def add_production(self, production, reorder=False, conditions=None):
+        pnode = super(WriteBehindRete, self).add_production(production, reorder=reorder, conditions=conditions)
+        self._record(self.ADD_PRODUCTION, production, pnode.condition_ids)
+        return pnode
+
+    def add_wme(self, triple):
+        if triple.id in self.alphanode_top.items:
+            return
+        super(WriteBehindRete, self).add_wme(triple)
+        self._record(self.ADD_WME, triple)
+
+    def remove_wme(self, wme):
+        if wme.id not in self.alphanode_top.items:
+            return
+        super(WriteBehindRete, self).remove_wme(wme)
+        self._record(self.REMOVE_WME, wme)
+
+    def remove_production(self, production):
+        super(WriteBehindRete, self).remove_production(production)
+        self._record(self.REMOVE_PRODUCTION, production)
@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 
-import decimal, re, time, datetime, cPickle as pickle, base64, uuid
+import decimal, re, time, datetime, cPickle as pickle, base64, uuid, bisect, hashlib
+from collections import defaultdict
 
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import F
 from django.db.models.query_utils import Q
+from django.db.models.signals import post_save, post_delete
 from django.utils.encoding import smart_str, smart_unicode
 
 from triple.constants import \
+    ID, \
     ID_IDX, \
     S_IDX, \
     P_IDX, \
@@ -19,7 +23,7 @@ from triple.constants import \
     FIELD_IDX_TO_NAME, \
     DONT_CARE
 
-from triple.models import Triple
+from triple.models import Atom, Triple, remove_duplicates
 from triple.utils import nested_to_triples
 
 from constants import *
@@ -35,6 +39,51 @@ def is_variable(value):
     """
     return isinstance(value, basestring) and value.strip().startswith('?')
 
+def iter_chunks(lst, size=300):
+    """
+    Iterates over successive slices of a list, to keep the number of bound
+    SQL parameters within the limits of backends like SQLite.
+    """
+    lst = list(lst)
+    for i in xrange(0, len(lst), size):
+        yield lst[i:i+size]
+
+def delete_where_in(model, column, ids):
+    """
+    Deletes the rows of a model whose column matches any of the given ids,
+    using one DELETE statement per chunk instead of Django's per-object
+    deletion collector.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for chunk in iter_chunks(ids):
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+            qn(model._meta.db_table),
+            qn(column),
+            ', '.join(['%s']*len(chunk))), chunk)
+    transaction.commit_unless_managed()
+
+# The available implementations of the Rete network.
+DB = 'db'
+MEMORY = 'memory'
+ENGINES = (DB, MEMORY)
+
+def get_rete_class(engine=None):
+    """
+    Returns the Rete network class implementing the given engine, defaulting
+    to the one named by settings.RETE_ENGINE.
+    
+    The database engine persists the entire network, whereas the memory
+    engine only keeps it for the lifetime of the process.
+    """
+    from django.conf import settings
+    engine = engine or getattr(settings, 'RETE_ENGINE', DB)
+    assert engine in ENGINES, "Unknown engine: %s" % (engine,)
+    if engine == MEMORY:
+        import memory
+        return memory.Rete
+    return Rete
+
 class _BaseModel(models.Model):
     
     class Meta:
@@ -203,6 +252,36 @@ class ConditionGroup(_BaseModel):
         assert isinstance(match_vars, dict)
         return [Condition.get(None, *[match_vars.get(part[1:],part) if is_variable(part) else part for part in c.parts]) for c in self.conditions.all()]
 
+class ReteTripleImportQueueLock(_BaseModel):
+    """
+    Grants a single worker the exclusive right to drain a Rete network's
+    import queue, on backends that can't skip rows locked by other workers.
+    """
+    rete = models.OneToOneField('Rete', blank=False, null=False, related_name='triple_import_queue_lock')
+    expiration_datetime = models.DateTimeField(blank=False, null=False, db_index=True)
+    
+    # How long a lock is honored before it's assumed its worker died.
+    timeout = datetime.timedelta(minutes=5)
+    
+    @classmethod
+    def acquire(cls, rete):
+        """
+        Attempts to take the lock for the given Rete network.
+        Returns the lock if successful, or None if another worker holds it.
+        """
+        now = datetime.datetime.now()
+        cls.objects.filter(rete=rete, expiration_datetime__lt=now).delete()
+        try:
+            lock = cls(rete=rete, expiration_datetime=now+cls.timeout).save()
+            transaction.commit_unless_managed()
+            return lock
+        except IntegrityError:
+            transaction.rollback_unless_managed()
+    
+    def release(self):
+        self.delete()
+        transaction.commit_unless_managed()
+
 class ReteTripleImportQueue(_BaseModel):
     """
     Represents a first-in-first-out queue of triples that need to be entered or
@@ -221,13 +300,24 @@ class ReteTripleImportQueue(_BaseModel):
         """
         Pushes a triple onto the queue for the given Rete network.
         """
-        # Find Retes that use the triple.
-        anodes = AlphaNode.objects.filter(parent__isnull=True, items__id=triple.id)
-        retes = set([anode.rete for anode in anodes]).difference([rete])
-        for _rete in retes:
-            cls(rete=_rete, triple=triple, _delete=delete).save()
-        if rete:
-            cls(rete=rete, triple=triple, _delete=delete).save()
+        cls.push_many([triple], rete=rete, delete=delete)
+    
+    @classmethod
+    def push_many(cls, triples, rete=None, delete=False):
+        """
+        Pushes triples onto the queues of every Rete network using them,
+        followed by the queue of the given Rete network.
+        """
+        triples = list(triples)
+        rete_ids = Rete.get_rete_ids(triples)
+        records = []
+        for triple in triples:
+            for rete_id in sorted(rete_ids[triple.id].difference([rete and rete.id])):
+                records.append(cls(rete_id=rete_id, triple=triple, _delete=delete))
+            if rete:
+                records.append(cls(rete=rete, triple=triple, _delete=delete))
+        for chunk in iter_chunks(records):
+            cls.objects.bulk_create(chunk)
     
     @classmethod
     def pop(cls, rete):
@@ -236,15 +326,79 @@ class ReteTripleImportQueue(_BaseModel):
         'Triple' is the earliest triple in the queue for the given Rete
         network. 'Delete' is a boolean flag indicating if the triple
         should be deleted from the given Rete network.
-        Returns None if the queue is empty.
+        Returns None if the queue is empty, or if another worker holds the
+        queue's lock. Use pop_many() to tell the two apart.
+        """
+        results = cls.pop_many(rete, 1)
+        if results:
+            return results[0]
+    
+    @classmethod
+    def supports_skip_locked(cls):
         """
-        q = cls.objects.filter(rete=rete)
-        if q.count():
-            record = q[0]
-            triple = record.triple
-            delete = record._delete
-            record.delete()
-            return triple,delete
+        Returns true if the database can skip rows locked by other
+        transactions, so several workers can claim rows concurrently.
+        Only PostgreSQL 9.5 and later support SKIP LOCKED.
+        """
+        if connection.vendor != 'postgresql':
+            return False
+        # The server version is only known once a connection is open.
+        connection.cursor()
+        return (connection.pg_version or 0) >= 90500
+    
+    @classmethod
+    def pop_many(cls, rete, n):
+        """
+        Removes up to n of the earliest (triple,delete) tuples in the queue
+        for the given Rete network, in queue order.
+        
+        Rows are claimed and deleted in a single transaction, so several
+        workers can drain the same queue without processing a row twice.
+        Returns an empty list if the queue is empty, or None if another
+        worker holds the queue's lock.
+        """
+        if cls.supports_skip_locked():
+            return cls._pop_many_skip_locked(rete, n)
+        lock = ReteTripleImportQueueLock.acquire(rete)
+        if not lock:
+            return
+        try:
+            return cls._pop_many_locked(rete, n)
+        finally:
+            lock.release()
+    
+    @classmethod
+    def _claim(cls, records):
+        """
+        Deletes the given queue records and returns their tuples.
+        """
+        records = list(records)
+        ids = [record.id for record in records]
+        for chunk in iter_chunks(ids):
+            cls.objects.filter(id__in=chunk).delete()
+        return [(record.triple,record._delete) for record in records]
+    
+    @classmethod
+    @transaction.commit_on_success
+    def _pop_many_skip_locked(cls, rete, n):
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute('''
+SELECT id FROM %(table)s
+WHERE rete_id = %%s
+ORDER BY created_datetime, id
+LIMIT %%s
+FOR UPDATE SKIP LOCKED
+''' % dict(table=qn(cls._meta.db_table)), [rete.id, n])
+        ids = [row[0] for row in cursor.fetchall()]
+        records = cls.objects.filter(id__in=ids).select_related('triple')
+        return cls._claim(records.order_by('created_datetime', 'id'))
+    
+    @classmethod
+    @transaction.commit_on_success
+    def _pop_many_locked(cls, rete, n):
+        records = cls.objects.filter(rete=rete).select_related('triple')
+        return cls._claim(records.order_by('created_datetime', 'id')[:n])
 
 def update_wme(t, field, value):
     """
@@ -267,13 +421,311 @@ def update_wme(t, field, value):
     ReteTripleImportQueue.push(t, delete=True)
     
     # Add the new triple to all the Rete networks using the old triple.
-    anodes = AlphaNode.objects.filter(parent__isnull=True, items__id=t.id)
-    retes = set([anode.rete for anode in anodes])
-    for rete in retes:
-        ReteTripleImportQueue.push(triple=tnew, rete=rete, delete=False)
+    ReteTripleImportQueue.objects.bulk_create([
+        ReteTripleImportQueue(rete_id=rete_id, triple=tnew, _delete=False)
+        for rete_id in sorted(Rete.get_rete_ids([t])[t.id])
+    ])
         
     return tnew
 
+def alpha_value(value):
+    """
+    Normalizes a WME field value or alphanode test value into the unicode
+    form stored in AlphaNode.value, so both can be compared in-process the
+    same way the database would compare them.
+    """
+    if value is None:
+        return
+    return smart_unicode(value)
+
+def join_value(value, numeric=False):
+    """
+    Normalizes a triple field value compared by an equality join test.
+    If either side of the test is the ID field, digit strings are compared as
+    integers.
+    """
+    if numeric and isinstance(value, basestring) and value.isdigit():
+        return int(value)
+    return value
+
+def get_triple_lookup(prefix, field_idx, value, numeric=False):
+    """
+    Returns a dictionary of Django ORM filter arguments selecting the triples,
+    reached through the given lookup prefix (e.g. 'parent__wme__'), whose
+    field equals the given join_value() normalized value, or None if the
+    comparison can't be expressed as a lookup.
+    """
+    if field_idx == ID_IDX:
+        if isinstance(value, (int, long)):
+            return {prefix+'id':value}
+        # Only integers can equal a triple's id.
+        return {prefix+'id__in':[]}
+    field_name = FIELD_IDX_TO_NAME[field_idx]
+    if isinstance(value, models.Model):
+        return {prefix+'_%s_id' % field_name:value.pk,
+                prefix+'_%s_type' % field_name:ContentType.objects.get_for_model(type(value))}
+    elif isinstance(value, (int, long)):
+        # Triple ids are stored in text fields in their canonical form.
+        return {prefix+'_%s_atom__text' % field_name:str(value)}
+    elif isinstance(value, basestring):
+        # Triples are matched on the integer id of the interned text, which
+        # the database resolves through the atom's unique index.
+        return {prefix+'_%s_atom__text' % field_name:value}
+
+def numeric_value(value):
+    """
+    Returns the value as a Decimal, or None if it isn't numeric.
+    """
+    if value is None or isinstance(value, bool):
+        return
+    try:
+        value = decimal.Decimal(smart_str(value).strip())
+    except decimal.InvalidOperation:
+        return
+    if value.is_nan():
+        return
+    return value
+
+def passes_constant_test(op_idx, test_value, field_value):
+    """
+    Returns true if a WME field value passes an alphanode's constant test.
+    
+    Inequality tests compare numerically, so they're only passed by numeric
+    values, except for NE, which otherwise compares as text.
+    """
+    if op_idx == EQ_IDX:
+        return alpha_value(field_value) == alpha_value(test_value)
+    test_number = numeric_value(test_value)
+    field_number = numeric_value(field_value)
+    if op_idx == NE_IDX:
+        if test_number is not None and field_number is not None:
+            return field_number != test_number
+        return alpha_value(field_value) != alpha_value(test_value)
+    if test_number is None or field_number is None:
+        return False
+    if op_idx == LT_IDX:
+        return field_number < test_number
+    elif op_idx == LE_IDX:
+        return field_number <= test_number
+    elif op_idx == GT_IDX:
+        return field_number > test_number
+    elif op_idx == GE_IDX:
+        return field_number >= test_number
+    raise Exception, "Unknown operation: %s" % (op_idx,)
+
+def get_join_signature(betamemory_id, alphanode_id, tests):
+    """
+    Returns a hash identifying a join node by its parent beta memory, its
+    alpha memory and its tests, so productions sharing a prefix of
+    conditions can share the join nodes built for that prefix.
+    [Production Matching for Large Learning Systems, Page 34]
+    """
+    tests = tuple(sorted(set(test.signature for test in tests)))
+    return hashlib.sha1(repr((betamemory_id, alphanode_id, tests))).hexdigest()
+
+def plan_conditions(conditions, get_cardinality):
+    """
+    Returns a production's conditions reordered so the most selective are
+    joined first, and each condition shares a variable with one joined
+    before it wherever possible, so no cross product of two memories is
+    built when a connected order exists.
+    
+    An expression condition is joined against the alpha memory of the
+    condition before it, so both are kept in place, and only the conditions
+    between expressions are reordered.
+    
+    get_cardinality := a function returning the estimated number of WMEs
+        matching a condition.
+    """
+    cardinality = dict((c, get_cardinality(c)) for c in conditions if not c.expression)
+    planned = []
+    bound = set()
+    
+    def place(condition):
+        planned.append(condition)
+        bound.update(var_name for _,var_name in condition.variable_bindings)
+    
+    def place_segment(segment):
+        while segment:
+            connected = [c for c in segment if bound.intersection(var_name for _,var_name in c.variable_bindings)]
+            condition = min(connected or segment, key=cardinality.get)
+            segment.remove(condition)
+            place(condition)
+    
+    segment = []
+    for condition in conditions:
+        if condition.expression:
+            # A run of expressions all follow the condition pinned before
+            # the first of them.
+            if segment:
+                pinned = segment.pop()
+                place_segment(segment)
+                place(pinned)
+            planned.append(condition)
+            segment = []
+        else:
+            segment.append(condition)
+    place_segment(segment)
+    return planned
+
+def get_extraction_plan(conditions):
+    """
+    Returns the list of (position, field name, variable name) bindings to
+    extract from a match, given the production's conditions in the order
+    they were joined, where position is the index of the condition's WME in
+    the token's list. Bindings are listed in the conditions' defined order.
+    """
+    plan = []
+    for position,condition in sorted(enumerate(conditions), key=lambda item: item[1].id):
+        for field_idx,var_name in condition.variable_bindings:
+            plan.append((position, FIELD_IDX_TO_NAME[field_idx], var_name))
+    return plan
+
+def extract_variables(plan, wmes):
+    """
+    Returns the variable bindings of a match, as {variable name:value}, from
+    its WMEs ordered by token index.
+    """
+    vars = {} # {var_name:var_value}
+    for position,field_name,var_name in plan:
+        if var_name in vars:
+            continue
+        field_value = getattr(wmes[position], field_name)
+        if field_value == DONT_CARE:
+            continue
+        vars[var_name] = field_value
+    return vars
+
+class ThresholdIndex(object):
+    """
+    Finds the inequality tests, on one field of the children of one
+    alphanode, passed by a WME field value.
+    
+    The LT, LE, GT and GE tests are kept sorted by their numeric thresholds,
+    so the tests passed by a value are found with a binary search, instead of
+    testing each one. NE tests are grouped by their value, so all but those
+    testing for the WME's value are passed.
+    """
+    
+    def __init__(self):
+        self.thresholds = dict((op_idx, []) for op_idx in (LT_IDX, LE_IDX, GT_IDX, GE_IDX)) # {operation:[threshold]}
+        self.nodes = dict((op_idx, []) for op_idx in (LT_IDX, LE_IDX, GT_IDX, GE_IDX)) # {operation:[node]}
+        self.not_equal = defaultdict(list) # {value key:[node]}
+    
+    def __len__(self):
+        return sum(map(len, self.nodes.values())) + sum(map(len, self.not_equal.values()))
+    
+    @classmethod
+    def get_key(cls, value):
+        number = numeric_value(value)
+        if number is None:
+            return alpha_value(value)
+        return number
+    
+    def add(self, op_idx, test_value, node):
+        if op_idx == NE_IDX:
+            self.not_equal[self.get_key(test_value)].append(node)
+            return
+        threshold = numeric_value(test_value)
+        if threshold is None:
+            # Never passed by any value.
+            return
+        i = bisect.bisect_right(self.thresholds[op_idx], threshold)
+        self.thresholds[op_idx].insert(i, threshold)
+        self.nodes[op_idx].insert(i, node)
+    
+    def remove(self, op_idx, test_value, node):
+        if op_idx == NE_IDX:
+            key = self.get_key(test_value)
+            self.not_equal[key].remove(node)
+            if not self.not_equal[key]:
+                del self.not_equal[key]
+            return
+        if numeric_value(test_value) is None:
+            return
+        i = self.nodes[op_idx].index(node)
+        del self.thresholds[op_idx][i]
+        del self.nodes[op_idx][i]
+    
+    def get_matches(self, field_value):
+        """
+        Returns the nodes whose test is passed by the field value.
+        """
+        matches = []
+        key = self.get_key(field_value)
+        for _key,nodes in self.not_equal.iteritems():
+            if _key != key:
+                matches.extend(nodes)
+        number = numeric_value(field_value)
+        if number is None:
+            return matches
+        # value < threshold
+        matches.extend(self.nodes[LT_IDX][bisect.bisect_right(self.thresholds[LT_IDX], number):])
+        # value <= threshold
+        matches.extend(self.nodes[LE_IDX][bisect.bisect_left(self.thresholds[LE_IDX], number):])
+        # value > threshold
+        matches.extend(self.nodes[GT_IDX][:bisect.bisect_left(self.thresholds[GT_IDX], number)])
+        # value >= threshold
+        matches.extend(self.nodes[GE_IDX][:bisect.bisect_right(self.thresholds[GE_IDX], number)])
+        return matches
+
+class AlphaIndex(object):
+    """
+    In-process discrimination index over a Rete network's alphanodes.
+
+    Maps (parent id, field index, operation index, value) to the child
+    alphanode performing that constant test, so a WME can be routed through
+    the alpha network with dictionary lookups instead of one query per field
+    per visited node. Inequality tests are found through a ThresholdIndex for
+    each (parent id, field index).
+    Similar to the exhaustive hash table method outlined in:
+    [Production Matching for Large Learning Systems, Page 16-17]
+
+    Note, the index only sees alphanodes loaded when it was built, or
+    registered afterwards through add(), so alphanodes created by another
+    Rete instance or process require a call to Rete.invalidate_alpha_index().
+    """
+
+    def __init__(self, rete):
+        self.top = rete.alphanode_top
+        self.nodes = {} # {id:AlphaNode}
+        self.children = {} # {(parent_id,field,operation,value):AlphaNode}
+        self.inequalities = defaultdict(ThresholdIndex) # {(parent_id,field):ThresholdIndex}
+        for node in AlphaNode.objects.filter(rete=rete):
+            self.add(node)
+        self.add(self.top)
+
+    def add(self, node):
+        """
+        Registers an alphanode with the index.
+        """
+        assert isinstance(node, AlphaNode)
+        if node.id in self.nodes:
+            return
+        self.nodes[node.id] = node
+        if node.parent_id is not None:
+            key = (node.parent_id, node.field, node.operation, alpha_value(node.value))
+            self.children[key] = node
+            if node.operation != EQ_IDX:
+                self.inequalities[(node.parent_id, node.field)].add(node.operation, node.value, node)
+
+    def get_child(self, parent, field_idx, op_idx, field_value):
+        """
+        Returns the child alphanode of the given parent performing the given
+        constant test, or None if no such alphanode exists.
+        """
+        return self.children.get((parent.id, field_idx, op_idx, alpha_value(field_value)))
+    
+    def get_inequality_children(self, parent, field_idx, field_value):
+        """
+        Returns the child alphanodes of the given parent performing an
+        inequality test on the given field that's passed by the field value.
+        """
+        index = self.inequalities.get((parent.id, field_idx))
+        if not index:
+            return []
+        return index.get_matches(field_value)
+
 class Rete(_BaseModel):
     """
     Encapsulates the top-level interface for a RETE network
@@ -284,6 +736,10 @@ class Rete(_BaseModel):
     
     pnodes = models.ManyToManyField('PNode', related_name='retes')
     
+    # The WMEs in the network, mirroring the contents of the top alphanode,
+    # so the networks using a triple can be found with one indexed lookup.
+    wmes = models.ManyToManyField(Triple, related_name='retes')
+    
     pnode_trigger_stack = models.ManyToManyField('PNodeGroup', related_name="rete_trigger_stacks")
     
     # Implied fields:
@@ -301,10 +757,152 @@ class Rete(_BaseModel):
                                                  parent=None)
         return node
     
+    @property
+    def alpha_index(self):
+        """
+        Returns the in-process AlphaIndex used to route WMEs, building it
+        from the stored alphanodes on first access.
+        """
+        if getattr(self, '_alpha_index', None) is None:
+            self._alpha_index = AlphaIndex(self)
+        return self._alpha_index
+
+    def invalidate_alpha_index(self):
+        """
+        Discards the in-process AlphaIndex, so it'll be rebuilt from the
+        database on next use.
+        """
+        self._alpha_index = None
+
     @property
     def items(self):
         return self.alphanode_top.items.all()
     
+    def record_wmes(self):
+        """
+        Records the WMEs in our top alpha memory that are missing from
+        Rete.wmes, as in networks built before memberships were recorded,
+        so queued updates fan out to them.
+        Returns the number of WMEs recorded.
+        """
+        Member = Rete.wmes.through
+        recorded = set(Member.objects.filter(rete=self).values_list('triple_id', flat=True))
+        missing = [triple_id for triple_id in self.items.values_list('id', flat=True) if triple_id not in recorded]
+        for chunk in iter_chunks(missing):
+            Member.objects.bulk_create([Member(rete_id=self.id, triple_id=triple_id) for triple_id in chunk])
+        return len(missing)
+    
+    @classmethod
+    def get_rete_ids(cls, triples):
+        """
+        Returns a dictionary mapping each triple's id to the set of ids of the
+        Rete networks containing it.
+        """
+        rete_ids = dict((triple.id, set()) for triple in triples)
+        Member = cls.wmes.through
+        for chunk in iter_chunks(rete_ids.keys()):
+            for triple_id,rete_id in Member.objects\
+                .filter(triple__in=chunk)\
+                .values_list('triple_id','rete_id'):
+                rete_ids[triple_id].add(rete_id)
+        return rete_ids
+    
+    def dump(self, path):
+        """
+        Writes the network's state to a snapshot file, which can be loaded
+        into the memory engine with rete.memory.Rete.load().
+        
+        Only the master token groups of pnodes are included.
+        """
+        from snapshot import Snapshot
+        snapshot = Snapshot()
+        
+        # Alphanodes, parents first.
+        anodes = {} # {AlphaNode id:index}
+        for anode in self.alphanodes.all().order_by('id'):
+            anodes[anode.id] = snapshot.append('ANOD',
+                anodes.get(anode.parent_id),
+                anode.field,
+                anode.operation,
+                snapshot.add_string(alpha_value(anode.value)))
+        Item = AlphaNode.items.through
+        for anode_id,triple_id in Item.objects\
+            .filter(alphanode__rete=self)\
+            .order_by('id')\
+            .values_list('alphanode_id','triple_id'):
+            snapshot.append('AMEM', anodes[anode_id], triple_id)
+        
+        # Beta nodes, parents first.
+        betajoins = list(BetaJoinNode.objects.filter(_alphanode__rete=self).order_by('id'))
+        tests = defaultdict(list) # {BetaJoinNode id:[TestAtJoinNode]}
+        for chunk in iter_chunks([node.id for node in betajoins]):
+            for test in TestAtJoinNode.objects.filter(parent__in=chunk).order_by('id'):
+                tests[test.parent_id].append(test)
+        children = defaultdict(list) # {BetaMemoryNode id:[BetaJoinNode]}
+        for node in betajoins:
+            children[node._betamemory_id].append(node)
+        joins = {} # {BetaJoinNode id:index}
+        memories = {} # {BetaMemoryNode id:index}
+        pending = list(reversed(children[None]))
+        while pending:
+            node = pending.pop()
+            first_test = snapshot.count('TEST')
+            for test in tests[node.id]:
+                snapshot.append('TEST',
+                    test.field_of_arg1,
+                    test.condition_number_of_arg2,
+                    test.field_of_arg2,
+                    snapshot.add_string(test.expression))
+            joins[node.id] = snapshot.append('JOIN',
+                memories.get(node._betamemory_id),
+                anodes[node._alphanode_id],
+                first_test,
+                len(tests[node.id]))
+            if node.child_id:
+                memories[node.child_id] = snapshot.append('BMEM', joins[node.id])
+                pending.extend(reversed(children[node.child_id]))
+        
+        # Tokens, parents first. Tokens may be shared by several memories,
+        # so each memory's copy references the copy in the memory above it.
+        tokens = {} # {(owner field,owner id,token id):index}
+        def append_tokens(through, owner_field, owners, parent_memory_ids, get_record):
+            token_ids = defaultdict(list) # {owner id:[token id]}
+            for chunk in iter_chunks(owners):
+                for owner_id,token_id in through.objects\
+                    .filter(**{owner_field+'__in':chunk})\
+                    .order_by('id')\
+                    .values_list(owner_field,'token'):
+                    token_ids[owner_id].append(token_id)
+            records = {} # {token id:(parent id, wme id)}
+            for chunk in iter_chunks(set(_id for _ids in token_ids.values() for _id in _ids)):
+                for token_id,parent_id,wme_id in Token.objects\
+                    .filter(id__in=chunk)\
+                    .values_list('id','parent','wme'):
+                    records[token_id] = (parent_id, wme_id)
+            for owner_id in owners:
+                for token_id in token_ids[owner_id]:
+                    parent_id,wme_id = records[token_id]
+                    parent = tokens.get(('betamemorynode', parent_memory_ids[owner_id], parent_id))
+                    tokens[(owner_field,owner_id,token_id)] = get_record(owner_id, parent, wme_id)
+        append_tokens(BetaMemoryNode.tokens.through, 'betamemorynode',
+            sorted(memories, key=memories.get),
+            dict((node.child_id, node._betamemory_id) for node in betajoins),
+            lambda owner_id,parent,wme_id: snapshot.append('TOKN', parent, wme_id, memories[owner_id], None))
+        pnodes = {} # {PNode id:index}
+        pnode_memory_ids = {} # {PNode id:parent memory id}
+        for pnode in self.pnodes.all().select_related('parent').order_by('id'):
+            pnodes[pnode.id] = snapshot.append('PNOD', pnode.production_id, joins[pnode.parent_id], pnode._triggered)
+            pnode_memory_ids[pnode.id] = pnode.parent._betamemory_id
+            if pnode._condition_ids:
+                for condition_id in pnode._condition_ids.split(','):
+                    snapshot.append('PCND', pnodes[pnode.id], int(condition_id))
+        append_tokens(PNode.tokens.through, 'pnode',
+            sorted(pnodes, key=pnodes.get),
+            pnode_memory_ids,
+            lambda owner_id,parent,wme_id: snapshot.append('TOKN', parent, wme_id, None, pnodes[owner_id]))
+        
+        snapshot.write(path)
+    
     @property
     def top_pnode_trigger_stack(self):
         """
@@ -318,10 +916,65 @@ class Rete(_BaseModel):
     def triggered_pnodes(self):
         return self.pnodes.exclude(_triggered=0)
     
-    def add_production(self, production):
+    def add_production(self, production, reorder=False, conditions=None):
         """
         Populates the RETE network from the production's conditions.
         [Production Matching for Large Learning Systems, Page 37]
+        
+        If reorder is true, the conditions are joined in the order chosen by
+        plan_conditions() instead of the order they were defined.
+        
+        conditions := Optional list of the production's conditions, in the
+            order to join them, overriding reorder.
+        """
+        plans = None if conditions is None else [list(conditions)]
+        return self.add_productions([production], reorder=reorder, plans=plans)[0]
+    
+    def add_productions(self, productions, reorder=False, plans=None):
+        """
+        Populates the RETE network from the conditions of several productions.
+        
+        The alpha and beta network for the whole rule set is built first, and
+        each new memory is then populated exactly once, parents before
+        children, with bulk inserts, instead of re-running the WMEs and
+        tokens above every new node through the network as it's built.
+        
+        plans := Optional list of the condition orders to join each
+            production in, overriding reorder.
+        
+        Returns the new pnodes, in the order of the productions.
+        """
+        if plans is not None:
+            assert len(plans) == len(productions), "A condition order must be given for each production."
+        elif not reorder:
+            plans = [None]*len(productions)
+        else:
+            # Plan against the alpha memories as they are before any new,
+            # still empty, alphanodes are built.
+            plans = [
+                plan_conditions(list(production.conditions.all().order_by('id')), self.get_condition_cardinality)
+                for production in productions
+            ]
+        new_anodes = [] # [AlphaNode], parents before children
+        new_nodes = [] # [BetaMemoryNode or PNode], parents before children
+        pnodes = [
+            self.build_production(production, new_anodes=new_anodes, new_nodes=new_nodes, conditions=conditions)
+            for production,conditions in zip(productions, plans)
+        ]
+        self.initialize_alpha_memories(new_anodes)
+        for new_node in new_nodes:
+            self.initialize_new_node(new_node)
+        return pnodes
+    
+    def build_production(self, production, new_anodes, new_nodes, conditions=None):
+        """
+        Builds or shares the nodes matching the production's conditions,
+        without populating any of the memories created. Each new alphanode is
+        appended to new_anodes and each new beta memory or pnode to new_nodes.
+        [Production Matching for Large Learning Systems, Page 37]
+        
+        conditions := Optional reordering of the production's conditions
+            to join them in.
         """
         assert isinstance(production, Production)
         assert production.conditions.all().count() >= 1, "Production must have at least 1 condition."
@@ -333,12 +986,16 @@ class Rete(_BaseModel):
         all_tests = []
         earlier_conds = []
         
-        conditions = list(production.conditions.all().order_by('id'))
+        condition_ids = None
+        if conditions is None:
+            conditions = list(production.conditions.all().order_by('id'))
+        else:
+            condition_ids = ','.join(str(c.id) for c in conditions)
         condition = conditions[0]
         _print('creating tests for',condition)
         tests = self.get_join_tests_from_condition(condition, earlier_conds, bc, bf)
         _print('created tests:',tests,'for',condition)
-        alphanode = self.build_or_share_alpha_memory(condition)
+        alphanode = self.build_or_share_alpha_memory(condition, new_anodes=new_anodes)
         current_node0 = current_node
         current_node = self.build_or_share_join_node(current_node, alphanode, tests)
         _print('created',current_node,'for',current_node0,'with',alphanode)
@@ -347,7 +1004,7 @@ class Rete(_BaseModel):
         
         for condition in conditions[1:]:
 #            t0 = time.time()
-            current_node = self.build_or_share_beta_memory_node(current_node)
+            current_node = self.build_or_share_beta_memory_node(current_node, new_nodes=new_nodes)
 #            t1 = time.time()-t0
             #print 'build_or_share_beta_memory_node:secs:\t%.3f'%t1
             
@@ -375,7 +1032,7 @@ class Rete(_BaseModel):
                 condition0 = None
             else:
     #            t0 = time.time()
-                alphanode = self.build_or_share_alpha_memory(condition)
+                alphanode = self.build_or_share_alpha_memory(condition, new_anodes=new_anodes)
     #            t1 = time.time()-t0
     #            print 'build_or_share_alpha_memory:secs:\t%.3f'%t1
                 
@@ -388,12 +1045,9 @@ class Rete(_BaseModel):
                 last_betajoinnode = current_node
             
         # Create and link pnode.
-        pnode = PNode(production=production, parent=current_node).save()
+        pnode = PNode(production=production, parent=current_node, _condition_ids=condition_ids).save()
         self.pnodes.add(pnode)
-#        t0 = time.time()
-        self.update_new_node_with_matches_from_above(pnode)
-#        t1 = time.time() - t0
-#        print 'update_new_node_with_matches_from_above secs:',t1
+        new_nodes.append(pnode)
         return pnode
     
     def add_wme(self, triple, force_recheck=False):#, anode_id_list=None):
@@ -405,9 +1059,91 @@ class Rete(_BaseModel):
 #        if not force_recheck and self.items.filter(id=triple.id).count():
 #            return False
         _print('ADDING WME:',triple)
-        self.constant_test_node_activation(self.alphanode_top, triple, force_recheck=force_recheck)
+        self.constant_test_node_activation(self.alpha_index.top, triple, force_recheck=force_recheck)
 
-    def build_or_share_alpha_memory(self, condition):
+    def add_wmes(self, triples):
+        """
+        Adds a batch of working memory elements to the RETE network.
+
+        Produces the same tokens and pnode activations as calling add_wme()
+        for each triple, but inserts alpha memory contents in bulk and
+        propagates joins a set of tokens or WMEs at a time, using the
+        standard delta rule for each beta join node:
+
+            new matches = (old tokens x new WMEs) + (new tokens x all WMEs)
+
+        WMEs already stored in an alpha memory are not re-activated there.
+        """
+        _triples = []
+        seen = set()
+        for triple in triples:
+            assert isinstance(triple, Triple)
+            if triple.id not in seen:
+                seen.add(triple.id)
+                _triples.append(triple)
+        triples = _triples
+        if not triples:
+            return
+
+        # Route each WME through the alpha network, collecting the WMEs
+        # added to each alpha memory.
+        new_items = {} # {alphanode id:[wme]}
+        for triple in triples:
+            pending = [self.alpha_index.top]
+            while pending:
+                node = pending.pop()
+                new_items.setdefault(node.id, []).append(triple)
+                pending.extend(self.get_matching_alphanode_children(node, triple))
+
+        # Skip WMEs already contained in an alpha memory.
+        Item = AlphaNode.items.through
+        existing = set()
+        for chunk in iter_chunks(seen):
+            existing.update(Item.objects.filter(triple__in=chunk).values_list('alphanode_id','triple_id'))
+        for anode_id,wmes in new_items.items():
+            wmes = [wme for wme in wmes if (anode_id, wme.id) not in existing]
+            if wmes:
+                new_items[anode_id] = wmes
+            else:
+                del new_items[anode_id]
+
+        # Bulk insert the new alpha memory contents.
+        rows = [Item(alphanode_id=anode_id, triple_id=wme.id) for anode_id,wmes in new_items.iteritems() for wme in wmes]
+        for chunk in iter_chunks(rows):
+            Item.objects.bulk_create(chunk)
+        Member = Rete.wmes.through
+        rows = [Member(rete_id=self.id, triple_id=wme.id) for wme in new_items.get(self.alpha_index.top.id, [])]
+        for chunk in iter_chunks(rows):
+            Member.objects.bulk_create(chunk)
+
+        # Join the new WMEs against the pre-existing tokens of each
+        # right-linked successor. All joins are evaluated before any token is
+        # created, so the new tokens can't be joined twice.
+        pending = []
+        for anode_id,wmes in sorted(new_items.iteritems()):
+            anode = self.alpha_index.nodes[anode_id]
+            for betanode in anode.successors.all().order_by('-id'):
+                pending.append((betanode, betanode.match_right(wmes)))
+
+        # Propagate the matches, which recursively joins each new set of
+        # tokens against the (now complete) alpha memories below it.
+        for betanode,pairs in pending:
+            betanode.activate_children(pairs)
+
+    def get_condition_cardinality(self, condition):
+        """
+        Estimates the number of WMEs matching the condition, as the size of
+        the deepest existing alpha memory on the condition's constant tests.
+        """
+        node = self.alpha_index.top
+        for field_idx,op_idx,field_value in condition.constant_tests:
+            child = self.alpha_index.get_child(node, field_idx, op_idx, field_value)
+            if child is None:
+                break
+            node = child
+        return node.items.all().count()
+    
+    def build_or_share_alpha_memory(self, condition, new_anodes=None):
         """
         Adds a production condition to the network by
         creating alpha/memory nodes.
@@ -422,10 +1158,14 @@ class Rete(_BaseModel):
         [Production Matching for Large Learning Systems, Page 35].
         
         Returns the last alphanode/memory used by the condition.
+        
+        If new_anodes is given, the alphanodes created are appended to it
+        instead of being initialized, so the caller can initialize them
+        with initialize_alpha_memories().
         """
         #TODO:?
         assert isinstance(condition, Condition)
-        current_node = self.alphanode_top
+        current_node = self.alpha_index.top
         _print('created',current_node)
         
 #        t0 = time.time()
@@ -440,26 +1180,26 @@ class Rete(_BaseModel):
 #        t1 = time.time()-t0
 #        print 'build_or_share_alpha_memory.build_tests:secs:\t%.3f'%t1
         
-        # Initialize tail alphamemory with any current WMEs.
-        # Only iterate over WMEs contained in superset of new anodes,
-        # by iterating over all WMEs (triples) contained in the parent
-        # alphanodes of alphanodes that were just created (i.e. were not
-        # pre-existing).
-        # See page 36-37 for details. Is this correct?
-#        t0 = time.time()
-        #wmes = self.items.all() # Note, very slow!
-        wmes = reduce(lambda a,b:a.union(b), [anode.parent.items.all() for anode in created_anodes], set())
-        for wme in wmes:
-            self.add_wme(wme, force_recheck=True)
-#        t1 = time.time()-t0
-#        print 'build_or_share_alpha_memory.add_wme:secs:\t%.3f'%t1
+        if new_anodes is not None:
+            new_anodes.extend(created_anodes)
+            return current_node
+        
+        # Initialize the alphanodes just created (i.e. not pre-existing)
+        # with any current WMEs. They have no successors yet, so nothing
+        # else needs to be activated.
+        # See page 36-37 for details.
+        self.initialize_alpha_memories(created_anodes)
         
         return current_node
     
-    def build_or_share_beta_memory_node(self, parent):
+    def build_or_share_beta_memory_node(self, parent, new_nodes=None):
         """
         Creates a BetaMemoryNode.
         [Production Matching for Large Learning Systems, Page 34]
+        
+        If new_nodes is given, a newly created node is appended to it instead
+        of being populated, so the caller can populate it with
+        initialize_new_node().
         """
         assert isinstance(parent, BetaJoinNode)
         if parent.child:
@@ -468,8 +1208,50 @@ class Rete(_BaseModel):
         parent.child = new_node
         parent.save()
         assert new_node.parent == parent
-        self.update_new_node_with_matches_from_above(new_node)
+        if new_nodes is not None:
+            new_nodes.append(new_node)
+        else:
+            self.update_new_node_with_matches_from_above(new_node)
         return new_node
+    
+    def initialize_alpha_memories(self, anodes):
+        """
+        Fills new alphanodes with the WMEs in their parent's memory that
+        pass their test, with one filtered query and one bulk insert per
+        alphanode. Parents must come before their children, so a new
+        parent's memory is filled before it's read.
+        [Production Matching for Large Learning Systems, Page 36-37]
+        """
+        Item = AlphaNode.items.through
+        for anode in anodes:
+            rows = [Item(alphanode_id=anode.id, triple_id=wme.id)
+                    for wme in anode.get_candidates() if anode.test(wme)]
+            for chunk in iter_chunks(rows):
+                Item.objects.bulk_create(chunk)
+    
+    def initialize_new_node(self, new_node):
+        """
+        Fills a new beta memory or pnode with the matches of its parent join
+        node, without activating any of its children.
+        Any new beta memory above it must already be initialized.
+        [Production Matching for Large Learning Systems, Page 38]
+        """
+        parent = new_node.parent
+        assert isinstance(parent, BetaJoinNode)
+        
+        # Our parent join may have been built before the memories above it
+        # were populated.
+        parent.check_right_linking()
+        parent.check_left_linking()
+        
+        pairs = parent.match_right(list(parent._alphanode.items.all()))
+        if not pairs:
+            return
+        new_tokens = remove_duplicates(Token.get_or_create_many(pairs))
+        if isinstance(new_node, PNode):
+            new_node.add_tokens(new_tokens)
+        else:
+            new_node.tokens.add(*new_tokens)
 
     def build_or_share_constant_test_node(self, parent, field_idx, op_idx, field_value):
         """
@@ -477,11 +1259,15 @@ class Rete(_BaseModel):
         
         [Production Matching for Large Learning Systems, Page 36].
         """
+        node = self.alpha_index.get_child(parent, field_idx, op_idx, field_value)
+        if node:
+            return node,False
         node,_ = AlphaNode.objects.get_or_create(rete=self,
                                                  field=field_idx,
                                                  operation=op_idx,
                                                  value=field_value,
                                                  parent=parent)
+        self.alpha_index.add(node)
         return node,_
     
     def build_or_share_join_node(self, betamemory, alphanode, tests):
@@ -491,12 +1277,13 @@ class Rete(_BaseModel):
         """
         assert betamemory is None or isinstance(betamemory, BetaMemoryNode), "Betamemory must be of type BetaMemoryNode, not %s." % (type(betamemory).__name__,)
         assert isinstance(alphanode, AlphaNode), "Alphanode must be of type AlphaNode, not %s." % (type(alphanode).__name__,)
-        if betamemory:
-            for child in betamemory._children.all():
-                if isinstance(child, BetaJoinNode) and child.alphanode == alphanode and child.tests == tests:
-                    return child
+        signature = get_join_signature(betamemory.id if betamemory else None, alphanode.id, tests)
+        q = BetaJoinNode.objects.filter(signature=signature)
+        if q.exists():
+            return q[0]
             
         bn = BetaJoinNode()
+        bn.signature = signature
         bn.alphanode = alphanode
         bn._alphanode = alphanode
         if betamemory:
@@ -526,40 +1313,31 @@ class Rete(_BaseModel):
         # Record the match at the current alphanode.
         node.memory_activation(wme, force_recheck=force_recheck)
         
+        # Propagate match through the alphanode network.
+        for child in self.get_matching_alphanode_children(node, wme):
+            self.constant_test_node_activation(child, wme, force_recheck=force_recheck, level=level+1)
+    
+    def get_matching_alphanode_children(self, node, wme):
+        """
+        Returns the child alphanodes of the given alphanode whose constant
+        test is passed by the working memory element.
+        """
+        children = []
+        
         # Find child alphanodes with a matching pattern for all fields.
         for field_idx in FIELD_INDEXES:
             
             # Lookup triple field value.
             field_value = getattr(wme, FIELD_IDX_TO_NAME[field_idx])
-#            _print(' '*(level*4),FIELD_IDX_TO_NAME[field_idx],field_value)
             
             # Find alphanodes whose condition matches the given field value.
-            q = Q(operation=EQ_IDX, value=field_value)
-#            q |= Q(Q(operation=NE_IDX), ~Q(value=field_value))
-#            try:
-#                # If value is numeric, then append numeric tests.
-#                numeric_value = decimal.Decimal(field_value)
-#                q |= Q(operation=LT_IDX, value__gt=numeric_value)
-#                q |= Q(operation=GT_IDX, value__lt=numeric_value)
-#                q |= Q(operation=LE_IDX, value__gte=numeric_value)
-#                q |= Q(operation=GE_IDX, value__lte=numeric_value)
-#                q |= Q(Q(operation=NE_IDX), ~Q(value=numeric_value))
-#            except decimal.InvalidOperation:
-#                # Otherwise, only do equality test.
-#                pass
-            children = self.alphanodes.filter(Q(parent=node),
-                                           Q(field=field_idx),
-                                           q
-                                        )
+            child = self.alpha_index.get_child(node, field_idx, EQ_IDX, field_value)
+            if child:
+                children.append(child)
             
-            # Propagate match through the alphanode network.
-#            all_children = self.alphanodes.filter(parent=node)
-#            _print(' '*(level*4),'constant_test_node_activation.children:',all_children.count())
-#            for c in all_children:
-#                _print(' '*((level+1)*4),c)
-#            _print(' '*(level*4),'constant_test_node_activation.children:',children.count())
-            for child in children:
-                self.constant_test_node_activation(child, wme, force_recheck=force_recheck, level=level+1)
+            # Find alphanodes whose inequality the given field value passes.
+            children.extend(self.alpha_index.get_inequality_children(node, field_idx, field_value))
+        return children
     
     def delete_alpha_memory(self, alphanode):
         """
@@ -580,12 +1358,24 @@ class Rete(_BaseModel):
                 self.delete_alpha_memory(alphanode)
         else:
             assert type(node) in (PNode, BetaMemoryNode), "Invalid node type: %s" % (type(node).__name__,)
-            for token in node.tokens.all():
-                self.delete_token_and_descendents(token)
+            # Tokens are shared by every memory holding the same match, so
+            # only delete the ones no other memory still holds.
+            token_ids = list(node.tokens.all().values_list('id', flat=True))
+            node.tokens.clear()
+            if isinstance(node, PNode):
+                token_ids.extend(PNodeTokenGroup.tokens.through.objects\
+                    .filter(pnodetokengroup__pnode=node)\
+                    .values_list('token_id', flat=True))
+                node.pnodetokengroups.all().delete()
+                PNodeActivation.log_removed([(node.id, token_id) for token_id in token_ids])
+            self.delete_tokens_and_descendents(Token.get_unheld_ids(token_ids))
         #remove node from the list node.parent.children
         parent = node.parent
-        parent.child = None
-        parent.save()
+        if isinstance(node, BetaMemoryNode):
+            # A pnode leaves its join's pnodes when deleted, so the join's
+            # beta memory stays linked for any productions sharing it.
+            parent.child = None
+            parent.save()
         if not list(parent.children):
             self.delete_node_and_any_unused_ancestors(parent)
         #deallocate memory for node
@@ -599,35 +1389,75 @@ class Rete(_BaseModel):
         Update to support right-linking/unlinking.
         [Production Matching for Large Learning Systems, Page 87]
         """
-        _print(' '*(level*4),'deleting token:',token)
-        _print(' '*(level*4),'token children:',token.children.all().count())
-        for child in list(token.children.all()):
-            _print(' '*(level*4),'deleting token %s from child %s' % (token, child))
-            self.delete_token_and_descendents(child, level=level+1)
-            
-        #remove tok from the list tok.node.items
-        for bm in list(token.betamemories.all()):
-            _print(' '*(level*4),'removing token %s from betamemory %s' % (token, bm))
-            bm.tokens.remove(token)
-            if not bm.tokens.all().count():
-                # If betamemory node mepty, then unlink betajoinnodes from
-                # their alphanodes.
-                for bm_child in bm._children.all():
-                    bm_child.unlink_right()
-            
-        #remove tok from pnodes
-        _print(' '*(level*4),'token pnodes:',token.pnodes.all().count())
-        for pnode in list(token.pnodes.all()):
-            _print(' '*(level*4),'removing token %s from pnode %s' % (token, pnode))
-            pnode.remove_token(token)
-            pnode._triggered -= 1
-            pnode.save()
+        self.delete_tokens_and_descendents([token])
+    
+    def delete_tokens_and_descendents(self, tokens):
+        """
+        Removes a set of tokens and all their descendent tokens.
         
-        #remove tok from the list tok.parent.children
-        token.parent.children.remove(token)#TODO:?
+        Rather than recursing token by token, the entire token tree is
+        collected up-front and its memberships, trigger counts and
+        right-unlinking are updated in aggregate.
+        """
+        token_ids = Token.get_descendent_ids(
+            [getattr(token, 'id', token) for token in tokens])
+        if not token_ids:
+            return
+        _print('deleting tokens:',len(token_ids))
+        
+        # Remove the tokens from their betamemories.
+        BetaMemoryTokens = BetaMemoryNode.tokens.through
+        betamemory_ids = set()
+        for chunk in iter_chunks(token_ids):
+            betamemory_ids.update(BetaMemoryTokens.objects\
+                .filter(token__in=chunk)\
+                .values_list('betamemorynode', flat=True))
+        delete_where_in(BetaMemoryTokens, 'token_id', token_ids)
+        
+        # If a betamemory is now empty, then unlink its betajoinnodes from
+        # their alphanodes.
+        betamemory_ids = list(betamemory_ids)
+        nonempty_ids = set()
+        for chunk in iter_chunks(betamemory_ids):
+            nonempty_ids.update(BetaMemoryTokens.objects\
+                .filter(betamemorynode__in=chunk)\
+                .values_list('betamemorynode', flat=True))
+        # Only left-linked betajoinnodes are unlinked, since a node is never
+        # unlinked from both of its memories.
+        empty_ids = [_id for _id in betamemory_ids if _id not in nonempty_ids]
+        for chunk in iter_chunks(empty_ids):
+            BetaJoinNode.objects\
+                .filter(betamemory__in=chunk)\
+                .update(alphanode=None)
         
-        #remove tok from the list tok.wme.tokens
-        token.delete()
+        # Remove the tokens from pnodes, decrementing each pnode's trigger
+        # count by the number of its tokens removed, and logging their
+        # removal.
+        PNodeTokens = PNode.tokens.through
+        removed = defaultdict(int) # {pnode_id:count}
+        pairs = [] # [(pnode_id,token_id)]
+        for chunk in iter_chunks(token_ids):
+            for pnode_id,token_id in PNodeTokens.objects\
+                .filter(token__in=chunk)\
+                .values_list('pnode','token'):
+                removed[pnode_id] += 1
+                pairs.append((pnode_id,token_id))
+            pairs.extend(PNodeTokenGroup.tokens.through.objects\
+                .filter(token__in=chunk)\
+                .values_list('pnodetokengroup__pnode','token'))
+        PNodeActivation.log_removed(pairs)
+        delete_where_in(PNodeTokens, 'token_id', token_ids)
+        delete_where_in(PNodeTokenGroup.tokens.through, 'token_id', token_ids)
+        pnode_ids_by_count = defaultdict(list) # {count:[pnode_id]}
+        for pnode_id, count in removed.iteritems():
+            pnode_ids_by_count[count].append(pnode_id)
+        for count, pnode_ids in pnode_ids_by_count.iteritems():
+            for chunk in iter_chunks(pnode_ids):
+                PNode.objects\
+                    .filter(id__in=chunk)\
+                    .update(_triggered=F('_triggered') - count)
+        
+        delete_where_in(Token, 'id', token_ids)
     
     def get_join_tests_from_condition(self, condition, earlier_conds, binding_condition, binding_field):
         """
@@ -702,6 +1532,60 @@ class Rete(_BaseModel):
             pnode.save()
         return group
         
+    def match_changes(self, since=0, productions=None, chunk_size=300):
+        """
+        Iterates over the matches added or removed after the given sequence
+        number, in order, as tuples of the form:
+        
+            (sequence number, production, added, [wme])
+        
+        where added is false for a removed match, and the WMEs are listed
+        starting from the last, as in PNode.matches, omitting any since
+        deleted. The last sequence number seen is passed as since in the next call.
+        
+        productions := Optional list of productions to limit the changes to.
+        """
+        q = self.activations.all()
+        if productions is not None:
+            q = q.filter(production__in=[getattr(p, 'id', p) for p in productions])
+        productions = {} # {id:Production}
+        while 1:
+            activations = list(q.filter(id__gt=since).order_by('id')[:chunk_size])
+            if not activations:
+                return
+            since = activations[-1].id
+            missing = set(a.production_id for a in activations if a.production_id not in productions)
+            productions.update(Production.objects.in_bulk(list(missing)))
+            wmes = {} # {id:Triple}
+            for chunk in iter_chunks(set(wme_id for a in activations for wme_id in a.wme_ids)):
+                wmes.update(Triple.objects.in_bulk(chunk))
+            for a in activations:
+                match = [wmes[wme_id] for wme_id in reversed(a.wme_ids) if wme_id in wmes]
+                yield a.id, productions[a.production_id], a.added, match
+    
+    def prune_match_changes(self, through=None):
+        """
+        Deletes the logged matches with sequence numbers up to and including
+        the given one, or all of them if none is given, so the log doesn't
+        grow without bound. Pass the last sequence number every consumer
+        has read.
+        
+        The latest change is always kept, since some backends, like SQLite,
+        reuse the id of the last row deleted, which would let new sequence
+        numbers repeat ones already read.
+        Returns the number of changes deleted.
+        """
+        q = self.activations.all()
+        if through is not None:
+            q = q.filter(id__lte=through)
+        ids = list(q.values_list('id', flat=True).order_by('id'))
+        latest = self.activations.all().order_by('-id').values_list('id', flat=True)[:1]
+        if latest and ids and ids[-1] == latest[0]:
+            ids.pop()
+        for chunk in iter_chunks(ids):
+            PNodeActivation.objects.filter(id__in=chunk).delete()
+        return len(ids)
+    
     def remove_production(self, production):
         """
         Removes a production and all it's dependencies from the network.
@@ -727,10 +1611,12 @@ class Rete(_BaseModel):
                 for pnode in bjoin.pnodes.all():
                     #TODO:Delete all tokens at all pnode groups?
                     tokens = list(pnode.tokens.all())
+                    PNodeActivation.log_removed([(pnode.id, token.id) for token in tokens])
                     pnode.tokens.clear()
                     for token in tokens:
                         token.delete()
             anode.items.clear()
+        self.wmes.clear()
         
     def remove_wme(self, wme):
         """
@@ -748,20 +1634,18 @@ class Rete(_BaseModel):
         # Remove WME from alphanode memories.
         for an in list(wme.alphanodes.all()):
             an.items.remove(wme)
-            #TODO:Fix left-unlinking.
-#            if not an.items.count():
+            if an.parent_id is None:
+                Rete.wmes.through.objects.filter(rete=an.rete_id, triple=wme).delete()
+            if not an.items.count():
+                # If the alphanode is now empty, then unlink its right-linked
+                # betajoinnodes from their betamemories.
                 #TODO:Don't left-unlink negative nodes.
-#                for betanode in an._successors.all():
-#                    betanode.unlink_left()
+                for betanode in an.successors.filter(betamemory__isnull=False):
+                    betanode.unlink_left()
             
         # Delete tokens.
-        tokens = Token.objects.filter(wme=wme)#.exclude(id__in=Token.objects.filter(parent__isnull=False).values_list('parent'))
-        _print('deleting tokens:',tokens.count())
-#        for token in tokens:
-#            print token,token.parent
-        #return
-        for token in tokens:
-            self.delete_token_and_descendents(token)
+        self.delete_tokens_and_descendents(
+            Token.objects.filter(wme=wme).values_list('id', flat=True))
     
     def update_new_node_with_matches_from_above(self, new_node):
         """
@@ -779,23 +1663,37 @@ class Rete(_BaseModel):
         else:
             raise Exception, "Unknown parent type '%s' for %s node." % (type(parent).__name__, type(new_node).__name,)
 
-    def iter_run(self):
+    def process_triple_import_queue(self, batch_size=100, wait=False, poll_interval=1):
         """
-        Iterates over match-eval cycles until no more productions are
-        triggered.
+        Drains the triple import queue, applying each queued removal or
+        addition to the network.
+        Consecutive additions are inserted in bulk.
+        
+        If another worker holds the queue's lock, either waits for it to be
+        released, polling every poll_interval seconds, or stops early.
+        Returns true if the queue was drained, or false if it stopped early
+        because the queue was locked.
         """
-        from triple.constants import CURRENT
         while 1:
-            
-            # Process pending triple additions or updates.
-            while 1:
-                top_anode = self.alphanode_top
-                result = ReteTripleImportQueue.pop(rete=self)
-                if not result:
-                    break
-                triple,delete = result
+            results = ReteTripleImportQueue.pop_many(rete=self, n=batch_size)
+            if results is None:
+                if not wait:
+                    return False
+                time.sleep(poll_interval)
+                continue
+            elif not results:
+                return True
+            top_anode = self.alpha_index.top
+            pending_adds = []
+            for triple,delete in results:
                 print 'handling triple queue:',triple,delete
                 
+                # Insert any earlier additions before their triples can be
+                # removed again.
+                if delete or triple in pending_adds:
+                    self.add_wmes(pending_adds)
+                    pending_adds = []
+                
                 # Remove the triple from the network if it's already
                 # been added.
                 if top_anode.items.filter(id=triple.id).count():
@@ -812,7 +1710,20 @@ class Rete(_BaseModel):
                 else:
                     # Add the triple to the network if we're not deleting it.
                     print '\tadding:',triple
-                    self.add_wme(triple)
+                    pending_adds.append(triple)
+            self.add_wmes(pending_adds)
+    
+    def iter_run(self):
+        """
+        Iterates over match-eval cycles until no more productions are
+        triggered.
+        """
+        from triple.constants import CURRENT
+        while 1:
+            
+            # Process pending triple additions or updates, waiting on any
+            # other worker draining the queue so no entries are left behind.
+            self.process_triple_import_queue(wait=True)
             
             pnodes = self.triggered_pnodes
             if not pnodes.count():
@@ -823,8 +1734,9 @@ class Rete(_BaseModel):
             pending_updates = []
             pending_adds = []
             for pnode in pnodes:
+                effects = pnode.production.effects
                 for vars in pnode.match_variables:
-                    for effect in pnode.production.effects:
+                    for effect in effects:
 #                        print effect
                         if isinstance(effect, Update):
                             pending_updates.append((effect,vars))
@@ -865,6 +1777,9 @@ class AlphaNode(_BaseModel):
     # Field value in the WME to test.
     value = models.CharField(max_length=MAX_LENGTH, blank=True, null=True, db_index=True)
     
+    # The interned value, set for equality tests on text fields.
+    value_atom = models.ForeignKey(Atom, blank=True, null=True, related_name='alphanodes')
+    
     # WME (triples) that have matched the condition.
     items = models.ManyToManyField(Triple, related_name='alphanodes')
     
@@ -896,6 +1811,48 @@ class AlphaNode(_BaseModel):
     def operation_name(self):
         return OP_IDX_TO_NAME.get(self.operation)
     
+    def save(self, *args, **kwargs):
+        self.value_atom_id = None
+        if self.operation == EQ_IDX and self.field != ID_IDX and self.value is not None:
+            self.value_atom_id = Atom.get_ids([self.value])[smart_unicode(self.value)]
+        return super(AlphaNode, self).save(*args, **kwargs)
+    
+    def test(self, wme):
+        """
+        Returns true if the working memory element passes our constant test.
+        """
+        return passes_constant_test(self.operation, self.value, getattr(wme, self.field_name))
+    
+    @classmethod
+    def intern_values(cls):
+        """
+        Links the values of alphanodes created before atoms were interned to
+        their atoms, so their memories can be initialized.
+        Returns the number of alphanodes updated.
+        """
+        nodes = cls.objects.filter(operation=EQ_IDX, value__isnull=False, value_atom__isnull=True)\
+            .exclude(field=ID_IDX)
+        count = 0
+        for node in nodes:
+            node.save()
+            count += 1
+        return count
+    
+    def get_candidates(self):
+        """
+        Returns the WMEs in our parent's memory that could pass our test,
+        narrowed by an indexed lookup for equality tests.
+        """
+        q = self.parent.items.all()
+        if self.operation != EQ_IDX or self.value is None:
+            return q
+        if self.field == ID_IDX:
+            return q.filter(**get_triple_lookup('', ID_IDX, join_value(self.value, numeric=True), numeric=True))
+        # Fields holding a model are compared by their text form, so they
+        # can't be ruled out by their interned text.
+        field_name = self.field_name
+        return q.filter(Q(**{'_%s_atom' % field_name:self.value_atom_id})|Q(**{'_%s_atom__isnull' % field_name:True}))
+    
     def memory_activation(self, wme, force_recheck=False):
         """
         Adds a working memory element to the alphanode's memory.
@@ -912,17 +1869,14 @@ class AlphaNode(_BaseModel):
 #            return
             
         self.items.add(wme)
+        if self.parent_id is None:
+            Rete.wmes.through.objects.get_or_create(rete_id=self.rete_id, triple_id=wme.id)
 #        if not self.successors.all().count():
 #            _print('    no successors!')
 
-        # Ensure our non-right-linked beta join nodes are left-linked.
-        # Note, right-linked beta join nodes will be checked after their
-        # right activation.
-        #TODO:Fix left-unlinking.
-#        for betanode in self._successors.exclude(id__in=self.successors.all()):
-#            betanode.link_left()
-#        for betanode in self._successors.all():
-#            betanode.link_left()
+        # Note, any left-unlinked beta join nodes are still right-linked, so
+        # they'll re-link themselves to their betamemories upon their right
+        # activation.
 
         # Right activate right-linked beta join nodes.
         for betanode in self.successors.all().order_by('-id'):
@@ -972,6 +1926,19 @@ class BetaMemoryNode(_BaseModel):
         self.tokens.add(new_token)
         for child in self.children.all():
             child.left_activation(new_token, level=level+1)
+    
+    def left_activation_many(self, pairs, level=0):
+        """
+        Batch form of left_activation(), for a list of (token, wme) pairs.
+        Builds all the new tokens, adds them to the beta memory, and informs
+        each child of the whole set at once.
+        """
+        if not pairs:
+            return
+        new_tokens = remove_duplicates(Token.get_or_create_many(pairs))
+        self.tokens.add(*new_tokens)
+        for child in self.children.all():
+            child.left_activation_many(new_tokens, level=level+1)
 
 class TestAtJoinNode(_BaseModel):
     """
@@ -1013,6 +1980,62 @@ class TestAtJoinNode(_BaseModel):
 
     def __str__(self):
         return repr(self)
+    
+    @property
+    def signature(self):
+        expression = smart_unicode(self.expression) if self.expression is not None else None
+        return (self.field_of_arg1, self.condition_number_of_arg2, self.field_of_arg2, expression)
+
+class JoinPlan(object):
+    """
+    A BetaJoinNode's join tests, compiled once into a single callable that
+    returns true if a token and WME pass all of them.
+    Equality tests are reduced to field name lookups, and expression tests to
+    code objects, so no test is re-queried or re-parsed per activation.
+    """
+    
+    def __init__(self, tests):
+        self.equality_tests = []
+        self._steps = [] # [(code, None) or (None, (field1, condition index, field2, numeric))]
+        for test in tests:
+            if test.expression:
+                code = compile(test.expression, '<TestAtJoinNode:%s>' % test.id, 'eval')
+                self._steps.append((code, None))
+            else:
+                self.equality_tests.append(test)
+                numeric = ID_IDX in (test.field_of_arg1, test.field_of_arg2)
+                self._steps.append((None, (FIELD_IDX_TO_NAME[test.field_of_arg1],
+                                           test.condition_number_of_arg2,
+                                           FIELD_IDX_TO_NAME[test.field_of_arg2],
+                                           numeric)))
+    
+    def __call__(self, token, wme):
+        scope = None
+        for code,equality in self._steps:
+            if code is not None:
+                if scope is None:
+                    def _v(condition_index, field_index):
+                        return getattr(token.get_wme(condition_index), FIELD_IDX_TO_NAME[field_index])
+                    scope = dict(_v=_v)
+                if not eval(code, globals(), scope):
+                    return False
+            else:
+                field1,condition_index,field2,numeric = equality
+                arg1 = getattr(wme, field1)
+                arg2 = getattr(token.get_wme(condition_index), field2)
+                
+                # Convert triple field to integer if it's being tested
+                # against the ID field.
+                if numeric:
+                    arg1 = join_value(arg1, numeric=True)
+                    arg2 = join_value(arg2, numeric=True)
+                
+                if arg1 != arg2:
+                    return False
+        return True
+
+# Compiled join plans, shared by all instances loaded for the same node.
+_join_plans = {} # {BetaJoinNode id:JoinPlan}
 
 class BetaJoinNode(_BaseModel):
     """
@@ -1031,6 +2054,10 @@ class BetaJoinNode(_BaseModel):
     
     child = models.OneToOneField('BetaMemoryNode', blank=True, null=True, related_name='parent')
     
+    # Hash of the parent beta memory, alpha memory and tests.
+    # See get_join_signature().
+    signature = models.CharField(max_length=40, blank=True, null=True, db_index=True)
+    
     #Implicit fields:
     #    self.pnodes.all() => set of PNode objects, a type of children
     #    self.parent => a BetaMemoryNode object
@@ -1056,11 +2083,14 @@ class BetaJoinNode(_BaseModel):
         """
         Sets the correct right-linking for the current node,
         based on the contents of its parent betamemory.
+        
+        A left-unlinked node is never right-unlinked, since it would then
+        never be activated again.
         """
         if self.parent:
             if not self.is_linked_right and self.parent.tokens.all().count():
                 self.link_right()
-            elif self.is_linked_right and not self.parent.tokens.all().count():
+            elif self.is_linked_right and self.is_linked_left and not self.parent.tokens.all().count():
                 self.unlink_right()
         elif not self.is_linked_right:
             self.link_right()
@@ -1074,7 +2104,6 @@ class BetaJoinNode(_BaseModel):
         self.save()
         
     def unlink_left(self):
-        return#TODO:Fix left-unlinking.
         self.betamemory = None
         self.save()
     
@@ -1082,11 +2111,17 @@ class BetaJoinNode(_BaseModel):
         """
         Sets the correct left-linking for the current node,
         based on the contents of its parent alphanode.
+        [Production Matching for Large Learning Systems, Page 102-103]
+        
+        A node without a betamemory is always left-linked, to the dummy top
+        token, and a right-unlinked node is never left-unlinked, since it
+        would then never be activated again.
         """
-        return#TODO:Fix left-unlinking.
+        if not self._betamemory_id:
+            return
         if not self.is_linked_left and self._alphanode.items.all().count():
             self.link_left()
-        elif self.is_linked_left and not self._alphanode.items.all().count():
+        elif self.is_linked_left and self.is_linked_right and not self._alphanode.items.all().count():
             self.unlink_left()
     
     @property
@@ -1130,8 +2165,12 @@ class BetaJoinNode(_BaseModel):
 
         # Re-link ourselves if our parent betamemory is non-empty.
         self.check_right_linking()
+        
+        # Unlink ourselves from our parent betamemory if our alphanode is
+        # empty, so we're not activated again until it's non-empty.
+        self.check_left_linking()
 
-        for wme in self.alphanode.items.all():
+        for wme in self.get_alpha_candidates(token):
             _print(' '*level,'testing token:',token,wme)
             if self.perform_join_tests(token, wme, level=level):
                 _print(' '*level,'success!')
@@ -1140,6 +2179,156 @@ class BetaJoinNode(_BaseModel):
             else:
                 _print(' '*level,'failure!')
     
+    def left_activation_many(self, tokens, level=0):
+        """
+        Batch form of left_activation(), for a list of tokens newly added to
+        the parent beta memory.
+        """
+        _print(' '*level,'act.left.many:',self,len(tokens))
+        
+        # Re-link ourselves if our parent betamemory is non-empty.
+        self.check_right_linking()
+        
+        # Unlink ourselves from our parent betamemory if our alphanode is
+        # empty, so we're not activated again until it's non-empty.
+        self.check_left_linking()
+        
+        self.activate_children(self.match_left(tokens), level=level)
+    
+    def match_left(self, tokens, level=0):
+        """
+        Returns the list of (token, wme) pairs, joining the given tokens
+        against the WMEs in the alpha memory, for which all join tests
+        succeed.
+        """
+        if not tokens or not self.alphanode:
+            return []
+        Token.prefetch_wmes(tokens)
+        wmes = list(self.alphanode.items.all())
+        if not self.equality_tests:
+            return [(token,wme) for token in tokens for wme in wmes if self.perform_join_tests(token, wme, level=level)]
+        
+        # Hash the alpha memory on the values its equality tests compare.
+        buckets = defaultdict(list) # {join key:[wme]}
+        for wme in wmes:
+            buckets[self.get_wme_join_key(wme)].append(wme)
+        pairs = []
+        for token in tokens:
+            for wme in buckets.get(self.get_token_join_key(token), []):
+                if self.perform_join_tests(token, wme, level=level):
+                    pairs.append((token,wme))
+        return pairs
+    
+    def match_right(self, wmes, level=0):
+        """
+        Returns the list of (token, wme) pairs, joining the tokens in the
+        parent beta memory against the given WMEs, for which all join tests
+        succeed.
+        """
+        # Re-link ourselves if our parent alphanode is non-empty.
+        self.check_left_linking()
+        
+        if self.parent:
+            tokens = list(self.parent.tokens.all())
+            Token.prefetch_wmes(tokens)
+        else:
+            dummy_token,_ = Token.objects.get_or_create(parent=None, wme=None)
+            tokens = [dummy_token]
+        if not self.equality_tests or not self.parent:
+            return [(token,wme) for token in tokens for wme in wmes if self.perform_join_tests(token, wme, level=level)]
+        
+        # Hash the beta memory on the values its equality tests compare.
+        buckets = defaultdict(list) # {join key:[token]}
+        for token in tokens:
+            buckets[self.get_token_join_key(token)].append(token)
+        pairs = []
+        for wme in wmes:
+            for token in buckets.get(self.get_wme_join_key(wme), []):
+                if self.perform_join_tests(token, wme, level=level):
+                    pairs.append((token,wme))
+        return pairs
+    
+    @property
+    def equality_tests(self):
+        """
+        Returns the tests comparing a field in the WME to a field in the
+        token for equality, which are used to index the join.
+        """
+        return self.join_plan.equality_tests
+    
+    def get_wme_join_key(self, wme):
+        """
+        Returns the tuple of normalized WME field values compared by our
+        equality tests.
+        """
+        key = []
+        for test in self.equality_tests:
+            numeric = ID_IDX in (test.field_of_arg1, test.field_of_arg2)
+            key.append(join_value(getattr(wme, FIELD_IDX_TO_NAME[test.field_of_arg1]), numeric))
+        return tuple(key)
+    
+    def get_token_join_key(self, token):
+        """
+        Returns the tuple of normalized token field values compared by our
+        equality tests.
+        """
+        key = []
+        for test in self.equality_tests:
+            numeric = ID_IDX in (test.field_of_arg1, test.field_of_arg2)
+            wme2 = token.get_wme(test.condition_number_of_arg2)
+            key.append(join_value(getattr(wme2, FIELD_IDX_TO_NAME[test.field_of_arg2]), numeric))
+        return tuple(key)
+    
+    def get_alpha_candidates(self, token):
+        """
+        Returns the WMEs in the alpha memory that could pass the join tests
+        with the given token, found by indexed lookups on the fields compared
+        by our equality tests, rather than scanning the whole memory.
+        """
+        q = self.alphanode.items.all()
+        for test,value in zip(self.equality_tests, self.get_token_join_key(token)):
+            numeric = ID_IDX in (test.field_of_arg1, test.field_of_arg2)
+            lookup = get_triple_lookup('', test.field_of_arg1, value, numeric)
+            if lookup is not None:
+                q = q.filter(**lookup)
+        return q
+    
+    def get_parent_candidates(self, wme):
+        """
+        Returns the tokens in the parent beta memory that could pass the join
+        tests with the given WME, found by indexed lookups on the WME fields
+        of the token ancestors referenced by our equality tests.
+        """
+        q = self.parent.tokens.all()
+        tests = self.equality_tests
+        if not tests:
+            return q
+        
+        # All tokens in a beta memory are the same distance from the dummy
+        # top token.
+        depth = list(q.values_list('index', flat=True)[:1])
+        if not depth:
+            return []
+        depth = depth[0]
+        for test,value in zip(tests, self.get_wme_join_key(wme)):
+            numeric = ID_IDX in (test.field_of_arg1, test.field_of_arg2)
+            assert test.condition_number_of_arg2 <= depth, "Invalid condition index %i for tokens of index %i." % (test.condition_number_of_arg2, depth)
+            prefix = 'parent__'*(depth - test.condition_number_of_arg2) + 'wme__'
+            lookup = get_triple_lookup(prefix, test.field_of_arg2, value, numeric)
+            if lookup is not None:
+                q = q.filter(**lookup)
+        return q
+    
+    def activate_children(self, pairs, level=0):
+        """
+        Passes a set of successful (token, wme) combinations on to each of
+        our children.
+        """
+        if not pairs:
+            return
+        for child in self.children:
+            child.left_activation_many(pairs, level=level+1)
+    
     def right_activation(self, wme, children=None, level=0):
         """
         Upon a right activation (when a new WME w is added to the alpha
@@ -1169,7 +2358,8 @@ class BetaJoinNode(_BaseModel):
         
         #TODO:correct? page 25 mentions a dummy betamemory with dummy token should be used, but doesn't specify what data these hold
         if self.parent:
-            tokens = self.parent.tokens.all()
+            tokens = list(self.get_parent_candidates(wme))
+            Token.prefetch_wmes(tokens)
         else:
             #TODO:is this how the dummy top token should be handled?
             dummy_token,_ = Token.objects.get_or_create(parent=None, wme=None)
@@ -1183,56 +2373,49 @@ class BetaJoinNode(_BaseModel):
             else:
                 _print(' '*level,'failure!')
     
+    @property
+    def join_plan(self):
+        """
+        Returns our tests compiled into a JoinPlan, which is cached until the
+        tests change.
+        """
+        plan = _join_plans.get(self.id)
+        if plan is None:
+            plan = _join_plans[self.id] = JoinPlan(self.tests.all())
+        return plan
+    
+    def invalidate_join_plan(self):
+        """
+        Discards our cached JoinPlan, so it'll be recompiled on next use.
+        """
+        _join_plans.pop(self.id, None)
+    
     def perform_join_tests(self, token, wme, level=0):
         """
         [Production Matching for Large Learning Systems, Page 25]
         """
-        #TODO:extend this to support inequality functions
-        #e.g. this would be necessary for ?created_timestamp1 < ?created_timestamp2
         assert isinstance(token, Token)
         assert isinstance(wme, Triple)
-        
-        def _v(condition_index, field_index):
-            wme = token.get_wme(condition_index)
-            value = getattr(wme, FIELD_IDX_TO_NAME[field_index])
-            _print(' '*level,'_v(%i,%i) == %s' % (condition_index, field_index, str(value)))
-            return value
-        
-        ret = True
-        for test in self.tests.all():
-            _print(' '*level,'perform_join_tests:',test)
-            if test.expression:
-                _print('!'*80)
-                _print(' '*level,'BJN:',self.id)
-                _print(' '*level,'token:',token.id)
-                _print(' '*level,'evaling:',test.expression)
-                #continue#TODO:remove
-                expr_ret = eval(test.expression, globals(), dict(_v=_v))
-                _print(' '*level,'RESULT:',test.expression,'==',expr_ret)
-                if not expr_ret:
-                    ret = False
-                    break
-            else:
-                arg1 = getattr(wme, FIELD_IDX_TO_NAME[test.field_of_arg1])
-                wme2 = token.get_wme(test.condition_number_of_arg2)
-                _print(' '*level,'wme1:',wme)
-                _print(' '*level,'wme2:',wme2)
-                arg2 = getattr(wme2, FIELD_IDX_TO_NAME[test.field_of_arg2])
-                
-                # Convert triple field to integer if it's being tested against the
-                # ID field.
-                if test.field_of_arg1 == ID_IDX or test.field_of_arg2 == ID_IDX:
-                    if isinstance(arg1, basestring) and arg1.isdigit():
-                        arg1 = int(arg1)
-                    if isinstance(arg2, basestring) and arg2.isdigit():
-                        arg2 = int(arg2)
-                        
-                if arg1 != arg2:
-                    _print(' '*level,'RESULT:',arg1,type(arg1),'!=',arg2,type(arg2))
-                    ret = False
-                    break
-        return ret
-    
+        _print(' '*level,'perform_join_tests:',self,token,wme)
+        return self.join_plan(token, wme)
+
+def _invalidate_join_plan(sender, instance, **kwargs):
+    """
+    Discards cached join plans affected by a changed node or test.
+    """
+    if isinstance(instance, BetaJoinNode):
+        # Re-linking saves a node without changing its tests, so only a new
+        # node (which may reuse a deleted node's id) or a deleted one counts.
+        if kwargs.get('created', True):
+            _join_plans.pop(instance.id, None)
+    elif instance.parent_id is not None:
+        _join_plans.pop(instance.parent_id, None)
+
+post_save.connect(_invalidate_join_plan, sender=BetaJoinNode)
+post_delete.connect(_invalidate_join_plan, sender=BetaJoinNode)
+post_save.connect(_invalidate_join_plan, sender=TestAtJoinNode)
+post_delete.connect(_invalidate_join_plan, sender=TestAtJoinNode)
+
 class Token(_BaseModel):
     """
     Represents a list of working memory elements.
@@ -1243,11 +2426,23 @@ class Token(_BaseModel):
     index = models.PositiveIntegerField(default=0, blank=False, null=False, db_index=True)
     wme = models.ForeignKey(Triple, blank=True, null=True)
     
+    # Comma-separated ids of the WMEs in the token list, ordered by index,
+    # so any of them can be found without walking the parent links.
+    _wme_ids = models.TextField(blank=True, null=True)
+    
     # Implied fields:
     #    betamemories = [BetaMemory]
     #    pnodes = [PNode]
     #    children = [Token]
     
+    def save(self, *args, **kwargs):
+        if self._wme_ids is None:
+            wme_ids = self.parent.wme_ids if self.parent_id else []
+            if self.wme_id:
+                wme_ids = wme_ids + [self.wme_id]
+            self._wme_ids = ','.join(map(str, wme_ids))
+        return super(Token, self).save(*args, **kwargs)
+    
     def __str__(self):
         return repr(self)
     
@@ -1257,38 +2452,192 @@ class Token(_BaseModel):
             parent_id = self.parent.id
         return "<%s: wme=%s, index=%i, parent=%s>" % (type(self).__name__, repr(self.wme), self.index, str(parent_id))
     
+    @classmethod
+    def get_or_create_many(cls, pairs):
+        """
+        Batch form of get_or_create(parent=token, index=token.index+1, wme=wme)
+        for a list of (token, wme) pairs.
+        Returns the tokens in the same order as the pairs.
+        """
+        keys = [(token.id, token.index+1, wme.id) for token,wme in pairs]
+        wanted = set(keys)
+        wme_ids = defaultdict(set) # {parent_id:set(wme_id)}
+        for parent_id,_,wme_id in keys:
+            wme_ids[parent_id].add(wme_id)
+        found = {} # {(parent_id,index,wme_id):token}
+        def _load():
+            # Only load the children of the given parents, rather than every
+            # token holding the WMEs.
+            for parent_chunk in iter_chunks(sorted(wme_ids)):
+                chunk_wme_ids = set()
+                for parent_id in parent_chunk:
+                    chunk_wme_ids.update(wme_ids[parent_id])
+                for wme_chunk in iter_chunks(sorted(chunk_wme_ids)):
+                    for token in cls.objects.filter(parent__in=parent_chunk, wme__in=wme_chunk):
+                        key = (token.parent_id, token.index, token.wme_id)
+                        if key in wanted:
+                            found.setdefault(key, token)
+        _load()
+        missing = [key for key in remove_duplicates(keys) if key not in found]
+        if missing:
+            paths = {} # {key:wme ids}
+            for (token,wme),key in zip(pairs, keys):
+                paths[key] = ','.join(map(str, token.wme_ids + [wme.id]))
+            for chunk in iter_chunks(missing):
+                cls.objects.bulk_create([cls(parent_id=parent_id, index=index, wme_id=wme_id, _wme_ids=paths[(parent_id,index,wme_id)])
+                                         for parent_id,index,wme_id in chunk])
+            _load()
+        return [found[key] for key in keys]
+    
+    @classmethod
+    def supports_recursive_queries(cls):
+        """
+        Returns true if the database can evaluate a recursive common table
+        expression.
+        """
+        if connection.vendor == 'postgresql':
+            return True
+        elif connection.vendor == 'sqlite':
+            from django.db.backends.sqlite3.base import Database
+            return Database.sqlite_version_info >= (3, 8, 3)
+        return False
+    
+    @classmethod
+    def get_unheld_ids(cls, token_ids):
+        """
+        Returns the subset of the given token ids not held by any beta memory
+        or pnode.
+        """
+        token_ids = list(token_ids)
+        held = set()
+        for through in (BetaMemoryNode.tokens.through,
+                        PNode.tokens.through,
+                        PNodeTokenGroup.tokens.through):
+            for chunk in iter_chunks(token_ids):
+                held.update(through.objects\
+                    .filter(token__in=chunk)\
+                    .values_list('token', flat=True))
+        return [_id for _id in token_ids if _id not in held]
+    
+    @classmethod
+    def get_descendent_ids(cls, token_ids):
+        """
+        Returns the ids of the given tokens and of all their descendents.
+        
+        Uses a single recursive query where the database supports one,
+        otherwise collects the tree one generation at a time.
+        """
+        token_ids = list(set(token_ids))
+        if not token_ids:
+            return []
+        if cls.supports_recursive_queries():
+            qn = connection.ops.quote_name
+            cursor = connection.cursor()
+            descendent_ids = set()
+            for chunk in iter_chunks(token_ids):
+                # The CTE is wrapped in a plain SELECT, since some drivers
+                # (e.g. Python 2's sqlite3) implicitly commit before any
+                # statement they don't recognize as a query.
+                cursor.execute('''
+SELECT id FROM (
+    WITH RECURSIVE descendents(id) AS (
+        SELECT id FROM %(table)s WHERE id IN (%(params)s)
+        UNION
+        SELECT t.id FROM %(table)s AS t
+        INNER JOIN descendents AS d ON t.%(parent)s = d.id
+    )
+    SELECT id FROM descendents
+) AS tree
+''' % dict(
+                    table=qn(cls._meta.db_table),
+                    parent=qn('parent_id'),
+                    params=', '.join(['%s']*len(chunk)),
+                ), chunk)
+                descendent_ids.update(row[0] for row in cursor.fetchall())
+            return list(descendent_ids)
+        descendent_ids = set(token_ids)
+        generation = token_ids
+        while generation:
+            children = []
+            for chunk in iter_chunks(generation):
+                children.extend(cls.objects\
+                    .filter(parent__in=chunk)\
+                    .values_list('id', flat=True))
+            generation = [_id for _id in children if _id not in descendent_ids]
+            descendent_ids.update(generation)
+        return list(descendent_ids)
+    
+    @classmethod
+    def prefetch_wmes(cls, tokens):
+        """
+        Loads the WMEs of all the given tokens with one batched query,
+        so get_wme() and get_list() need no further queries.
+        """
+        tokens = [token for token in tokens if getattr(token, '_wmes', None) is None]
+        wme_ids = set()
+        for token in tokens:
+            wme_ids.update(token.wme_ids)
+        wmes = {} # {id:Triple}
+        for chunk in iter_chunks(wme_ids):
+            wmes.update(Triple.objects.in_bulk(chunk))
+        for token in tokens:
+            token._wmes = [wmes[wme_id] for wme_id in token.wme_ids]
+    
+    @property
+    def wme_ids(self):
+        """
+        Returns the ids of the WMEs in the token list, ordered by index.
+        """
+        if self._wme_ids is None:
+            # Walk the parent links of tokens saved without a materialized
+            # path.
+            wme_ids = []
+            place = self
+            while place:
+                if place.wme_id:
+                    wme_ids.append(place.wme_id)
+                place = place.parent
+            self._wme_ids = ','.join(map(str, reversed(wme_ids)))
+        return [int(wme_id) for wme_id in self._wme_ids.split(',') if wme_id]
+    
+    def get_wmes(self):
+        """
+        Returns the WMEs in the token list, ordered by index, loading them
+        all with one query on first use.
+        """
+        if getattr(self, '_wmes', None) is None:
+            type(self).prefetch_wmes([self])
+        return self._wmes
+    
     def get_wme(self, index):
         """
         Retrieves the working memory element associated with the given index.
         """
         #TODO:does index==0 correspond to the current wme? or the furthest from the current token?
-        place = self
         _print('get_wme:',index,self.index)
         assert isinstance(index, int) and index <= self.index, "Invalid index %s. Must be an integer less than or equal to %i." % (str(index), self.index)
-        while place.index != index:
-            assert place.parent is not None, "Index out of range: %i" % (index,)
-            place = place.parent
-        return place.wme
+        wmes = self.get_wmes()
+        # The last WME in the list has our index.
+        position = len(wmes) - 1 - (self.index - index)
+        if position < 0:
+            # The dummy top token.
+            return
+        return wmes[position]
     
     def get_list(self):
         """
-        Retrieves the list of working memory elements
-        by traversing the token parent links starting
+        Retrieves the list of working memory elements, starting
         from the current token.
         """
-        wme = []
-        place = self
-        while place.parent:
-            wme.append(place.wme)
-#            print place.wme
-            place = place.parent
-        return wme
+        return list(reversed(self.get_wmes()))
 
 class ProductionTag(_BaseModel):
     
     # Unique descriptor.
     name = models.CharField(max_length=50, blank=False, null=False, unique=True, db_index=True)
     
+_effects = {} # {Production id:(_rhs_pickle, [effect])}
+
 class Production(_BaseModel):
     
     # Unique descriptor.
@@ -1305,9 +2654,18 @@ class Production(_BaseModel):
     
     @property
     def effects(self):
+        """
+        Returns the decoded list of effects, which is cached per production,
+        so it's only decoded again once the encoded value changes.
+        """
         if self._rhs_pickle is None:
             return []
-        return pickle.loads(base64.decodestring(self._rhs_pickle))
+        rhs_pickle,effects = _effects.get(self.id, (None, None))
+        if rhs_pickle != self._rhs_pickle:
+            effects = pickle.loads(base64.decodestring(self._rhs_pickle))
+            if self.id is not None:
+                _effects[self.id] = (self._rhs_pickle, effects)
+        return list(effects)
         
     @effects.setter
     def effects(self, obj):
@@ -1375,6 +2733,17 @@ class PNodeTokenGroup(_BaseModel):
     # If true, indicates this production had its LHS matched at least once.
     triggered = models.PositiveIntegerField(default=0, blank=False, null=False, db_index=True)
     
+def _forget_effects(sender, instance, **kwargs):
+    """
+    Discards the cached effects of a deleted production, whose id may be
+    reused.
+    """
+    _effects.pop(instance.id, None)
+
+post_delete.connect(_forget_effects, sender=Production)
+
+_pnode_retes = {} # {PNode id:Rete id}
+
 class PNode(_BaseModel):
     """
     Links a production to beta join node.
@@ -1393,6 +2762,10 @@ class PNode(_BaseModel):
     # A list of WME lists representing full matches.
     tokens = models.ManyToManyField('Token', related_name="pnodes")
     
+    # The ids of the production's conditions in the order they were joined,
+    # if they were reordered.
+    _condition_ids = models.CommaSeparatedIntegerField(max_length=MAX_LENGTH, blank=True, null=True)
+    
     # Implied fields:
     #    groups = [PNodeGroup]
     
@@ -1400,6 +2773,21 @@ class PNode(_BaseModel):
     def rete(self):
         return self.retes.all()[0]
     
+    @property
+    def rete_id(self):
+        """
+        Returns the id of our Rete network, which is cached since a pnode
+        never moves between networks.
+        """
+        rete_id = _pnode_retes.get(self.id)
+        if rete_id is None:
+            rete_ids = Rete.pnodes.through.objects\
+                .filter(pnode=self)\
+                .values_list('rete_id', flat=True)[:1]
+            if rete_ids:
+                rete_id = _pnode_retes[self.id] = rete_ids[0]
+        return rete_id
+    
     @property
     def triggered(self):
         top_group = self.rete.top_pnode_trigger_stack
@@ -1421,7 +2809,21 @@ class PNode(_BaseModel):
         _print('pnode activated!')
         
         new_token, _ = Token.objects.get_or_create(parent=token, index=token.index+1, wme=wme)
-        
+        self.add_tokens([new_token])
+    
+    def left_activation_many(self, pairs, level=0):
+        """
+        Batch form of left_activation(), for a list of (token, wme) pairs.
+        """
+        _print(' '*level,'act.left.many:',self,len(pairs))
+        if not pairs:
+            return
+        self.add_tokens(Token.get_or_create_many(pairs))
+    
+    def add_tokens(self, new_tokens):
+        """
+        Records full matches, counting one trigger per token.
+        """
         # Record our activation in our rete's trigger stack.
         #for rete in self.retes.all():
         top_group = self.rete.top_pnode_trigger_stack
@@ -1429,16 +2831,23 @@ class PNode(_BaseModel):
             # Update versioned token group.
             top_group.pnodes.add(self)
             token_group,_ = PNodeTokenGroup.objects.get_or_create(pnodegroup=top_group, pnode=self)
-            token_group.tokens.add(new_token)
-            token_group.triggered += 1
+            token_group.tokens.add(*new_tokens)
+            token_group.triggered += len(new_tokens)
         else:
             # Update master token group.
-            self.tokens.add(new_token)
+            self.tokens.add(*new_tokens)
             
-        self._triggered += 1
+        self._triggered += len(new_tokens)
         self.save()
+        
+        # Log the new matches.
+        rows = [PNodeActivation(rete_id=self.rete_id, production_id=self.production_id, token_id=token.id, added=True, _wme_ids=token._wme_ids)
+                for token in new_tokens]
+        for chunk in iter_chunks(rows):
+            PNodeActivation.objects.bulk_create(chunk)
     
     def remove_token(self, token):
+        PNodeActivation.log_removed([(self.id, token.id)])
         top_group = self.rete.top_pnode_trigger_stack
         if top_group:
             token_group,_ = PNodeTokenGroup.objects.get_or_create(pnodegroup=top_group, pnode=self)
@@ -1466,24 +2875,61 @@ class PNode(_BaseModel):
             yield ret
 #            print '---'
     
+    @property
+    def conditions(self):
+        """
+        Returns the production's conditions in the order they were joined.
+        """
+        conditions = list(self.production.conditions.all().order_by('id'))
+        if not self._condition_ids:
+            return conditions
+        conditions = dict((c.id, c) for c in conditions)
+        return [conditions[int(_id)] for _id in self._condition_ids.split(',')]
+    
     @property
     def match_variables(self):
         """
         Iterates over the variable bindings for each match set.
+        Conditions are visited in their defined order, even if they were
+        joined in another.
+        """
+        return self.iter_match_variables()
+    
+    def iter_match_variables(self, chunk_size=300):
         """
-        conditions = self.production.conditions.all().order_by('id')
-        for match in self.matches:
-            vars = {} # {var_name:var_value}
-            triples = reversed(match)
-            for c,t in zip(conditions,triples):
-                for field_idx,var_name in c.variable_bindings:
-                    if var_name in vars:
-                        continue
-                    field_value = getattr(t, FIELD_IDX_TO_NAME[field_idx])
-                    if field_value == DONT_CARE:
-                        continue
-                    vars[var_name] = field_value
-            yield vars
+        Streams the variable bindings for each match set.
+        
+        Tokens are read a chunk at a time, in id order, and the WMEs each
+        chunk references, along with any objects their bound fields refer
+        to, are loaded in bulk, so memory use is bounded by the chunk size
+        rather than the number of matches.
+        """
+        plan = get_extraction_plan(self.conditions)
+        field_names = set(field_name for _,field_name,_ in plan)
+        related = ['_%s_object' % field_name for field_name in field_names if field_name != ID]
+        tokens = self.token_list
+        last_id = 0
+        while 1:
+            rows = list(tokens\
+                .filter(id__gt=last_id)\
+                .order_by('id')\
+                .values_list('id', '_wme_ids')[:chunk_size])
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            paths = []
+            for token_id,wme_ids in rows:
+                if wme_ids is None:
+                    paths.append(Token.objects.get(id=token_id).wme_ids)
+                else:
+                    paths.append([int(wme_id) for wme_id in wme_ids.split(',') if wme_id])
+            wmes = {} # {id:Triple}
+            for chunk in iter_chunks(set(wme_id for path in paths for wme_id in path)):
+                wmes.update((wme.id, wme) for wme in Triple.objects\
+                    .filter(id__in=chunk)\
+                    .prefetch_related(*related))
+            for path in paths:
+                yield extract_variables(plan, [wmes[wme_id] for wme_id in path])
     
     def __repr__(self):
         return "<%s:%i>" % (type(self).__name__, self.id,)
@@ -1491,6 +2937,73 @@ class PNode(_BaseModel):
     def __str__(self):
         return repr(self)
 
+def _forget_pnode_rete(sender, instance, **kwargs):
+    """
+    Discards the cached network of a deleted pnode, whose id may be reused.
+    """
+    _pnode_retes.pop(instance.id, None)
+
+post_delete.connect(_forget_pnode_rete, sender=PNode)
+
+class PNodeActivation(_BaseModel):
+    """
+    An append-only log of the matches added to and removed from pnodes.
+    The id is the activation's sequence number, so consumers can read only
+    the changes after the last activation they've seen.
+    See Rete.match_changes().
+    """
+    
+    rete = models.ForeignKey(Rete, blank=False, null=False, related_name='activations')
+    
+    production = models.ForeignKey(Production, blank=False, null=False, related_name='activations')
+    
+    # The token holding the match, which no longer exists once removed.
+    token_id = models.PositiveIntegerField(blank=False, null=False)
+    
+    # True if the match was added, false if it was removed.
+    added = models.BooleanField(default=True, db_index=True)
+    
+    # Comma-separated ids of the WMEs in the match, ordered by token index.
+    _wme_ids = models.TextField(blank=True, null=True)
+    
+    class Meta:
+        ordering = ['id']
+    
+    @property
+    def wme_ids(self):
+        return [int(wme_id) for wme_id in (self._wme_ids or '').split(',') if wme_id]
+    
+    @classmethod
+    def log_removed(cls, pairs):
+        """
+        Logs the removal of each (pnode id, token id) match, before the
+        token is deleted.
+        """
+        pairs = remove_duplicates(pairs)
+        if not pairs:
+            return
+        pnodes = {} # {pnode id:(rete id, production id)}
+        for chunk in iter_chunks(list(set(pnode_id for pnode_id,_ in pairs))):
+            for pnode_id,rete_id,production_id in PNode.objects\
+                .filter(id__in=chunk)\
+                .values_list('id','retes','production'):
+                pnodes[pnode_id] = (rete_id, production_id)
+        paths = {} # {token id:wme ids}
+        for chunk in iter_chunks(list(set(token_id for _,token_id in pairs))):
+            paths.update(Token.objects\
+                .filter(id__in=chunk)\
+                .values_list('id','_wme_ids'))
+        rows = []
+        for pnode_id,token_id in pairs:
+            rete_id,production_id = pnodes[pnode_id]
+            if rete_id is None:
+                continue
+            if paths.get(token_id) is None:
+                paths[token_id] = ','.join(map(str, Token.objects.get(id=token_id).wme_ids))
+            rows.append(cls(rete_id=rete_id, production_id=production_id, token_id=token_id, added=False, _wme_ids=paths[token_id]))
+        for chunk in iter_chunks(rows):
+            cls.objects.bulk_create(chunk)
+
 class State(object):
     """
     List of literal triple patterns
@@ -1564,6 +3077,19 @@ class _ReteAction(object):
     def __init__(self):
         pass
     
+    def __getstate__(self):
+        # Compiled attributes are rebuilt on first use rather than pickled.
+        return dict((k,v) for k,v in self.__dict__.iteritems() if not k.startswith('_compiled'))
+    
+    @staticmethod
+    def _get_var_name(value):
+        """
+        Returns the name of the variable referenced by the value, or None if
+        the value is a constant.
+        """
+        if isinstance(value, basestring) and value.startswith('?') and len(value) > 1:
+            return value[1:]
+    
     def _lookup(self, value, vars):
         assert isinstance(vars, dict)
         if isinstance(value, basestring) and value.startswith('?') and len(value) > 1:
@@ -1588,24 +3114,38 @@ class Create(_ReteAction):
             # Confirm test contains a valid Python expression.
             ret = ast.parse(v)
             assert len(ret.body) == 1 and type(ret.body[0]).__name__ == 'Expr', "Invalid value. Must contain a valid Python expression: %s" % (v,)
-        
-    def _lookup(self, value, vars):
+    
+    @property
+    def compiled_var_map(self):
+        """
+        Returns the var_map expressions compiled, as {name:code}.
+        """
+        if getattr(self, '_compiled_var_map', None) is None:
+            self._compiled_var_map = dict(
+                (k, compile(v, '<Create:%s>' % (k,), 'eval'))
+                for k,v in self.var_map.iteritems())
+        return self._compiled_var_map
+    
+    def _lookup(self, value, vars, key=None):
         from triple.utils import dt
         assert isinstance(vars, dict)
-        if isinstance(value, basestring) and value.startswith('?') and len(value) > 1:
-            key = value[1:]
+        if key is None:
+            key = self._get_var_name(value)
+        if key is not None:
             if key in vars:
                 # Lookup value from variable map.
-                value = super(Create, self)._lookup(value, vars)
+                value = vars[key]
             else:
                 # Lookup value from function map.
-                value = eval(self.var_map[key], globals(), locals())
+                value = eval(self.compiled_var_map[key], globals(), locals())
                 vars[key] = value # Save to variable map.
         return value
     
     def do(self, rete, vars, graphs):
         from triple.models import T
         facts = []
+        # Nested parts are expanded on every firing, so each gets its own
+        # blank nodes.
         for part in self.parts:
             for fact in nested_to_triples(part, as_vars=0):
                 facts.append(T(*[self._lookup(f, vars) for f in fact[1:]], gid=graphs))
@@ -1620,8 +3160,20 @@ class Update(_ReteAction):
         self.field_name = field_name
         self.new_field_value = new_field_value
         
+    @property
+    def compiled_triple_var(self):
+        """
+        Returns the name of the variable holding the triple's id, or None if
+        the id is a constant.
+        """
+        if not hasattr(self, '_compiled_triple_var'):
+            self._compiled_triple_var = self._get_var_name(self.triple_id)
+        return self._compiled_triple_var
+        
     def do(self, rete, vars):
-        id = int(self._lookup(self.triple_id, vars))
+        assert isinstance(vars, dict)
+        key = self.compiled_triple_var
+        id = int(self.triple_id if key is None else vars[key])
         t = Triple.objects.get(id=id)
         rete.remove_wme(t)
         setattr(t, self.field_name, self.new_field_value)
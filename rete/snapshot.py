@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Reads and writes snapshots of a Rete network's state.
+
+A snapshot stores the network topology, alpha memories and tokens as flat
+arrays of 32-bit integers, one array per section, so it can be read back
+through mmap with no parsing beyond slicing each section. Strings (alphanode
+values and test expressions) are stored in a single table and referenced by
+index. Triples and productions are referenced by their database ids.
+
+Sections, each a flat array of fixed-width records:
+
+    ANOD := [parent alphanode, field, operation, value string]
+    AMEM := [alphanode, triple id]
+    JOIN := [parent beta memory, alphanode, first test, test count]
+    TEST := [field of arg1, condition number of arg2, field of arg2, expression string]
+    BMEM := [parent join]
+    PNOD := [production id, parent join, triggered]
+    PCND := [pnode, condition id], in join order, for reordered productions
+    TOKN := [parent token, triple id, beta memory, pnode]
+
+References to other records are their index within their section, with -1
+standing in for None. A token's parent token is always owned by the beta
+memory above the token's owner, or is the dummy top token (-1).
+"""
+import mmap
+import struct
+import sys
+from array import array
+
+MAGIC = 'RETE'
+VERSION = 1
+
+# Section names, and the number of integers in each of their records.
+SECTIONS = (
+    ('ANOD', 4),
+    ('AMEM', 2),
+    ('JOIN', 4),
+    ('TEST', 4),
+    ('BMEM', 1),
+    ('PNOD', 3),
+    ('PCND', 2),
+    ('TOKN', 4),
+)
+
+NONE = -1
+
+_HEADER = struct.Struct('<4sii')
+_SECTION = struct.Struct('<4sii')
+
+def to_int(value):
+    if value is None:
+        return NONE
+    return value
+
+def from_int(value):
+    if value == NONE:
+        return
+    return value
+
+class Snapshot(object):
+    """
+    The flat contents of a snapshot file.
+    """
+
+    def __init__(self):
+        self.strings = []
+        self._string_index = {} # {string:index}
+        self.sections = dict((name, array('i')) for name,_ in SECTIONS)
+
+    def add_string(self, value):
+        """
+        Returns the index of the string in the string table, adding it if
+        necessary.
+        """
+        if value is None:
+            return NONE
+        if value not in self._string_index:
+            self._string_index[value] = len(self.strings)
+            self.strings.append(value)
+        return self._string_index[value]
+
+    def get_string(self, index):
+        if index == NONE:
+            return
+        return self.strings[index]
+
+    def append(self, name, *values):
+        """
+        Appends a record to a section, returning its index.
+        """
+        section = self.sections[name]
+        section.extend(map(to_int, values))
+        return len(section)/dict(SECTIONS)[name] - 1
+
+    def records(self, name):
+        """
+        Iterates over the records of a section, as tuples.
+        """
+        section = self.sections[name]
+        width = dict(SECTIONS)[name]
+        for i in xrange(0, len(section), width):
+            yield tuple(section[i:i+width])
+
+    def count(self, name):
+        return len(self.sections[name])/dict(SECTIONS)[name]
+
+    def write(self, path):
+        blob = u'\0'.join(self.strings).encode('utf-8')
+        chunks = [('STRS', len(self.strings), blob)]
+        for name,_ in SECTIONS:
+            section = self.sections[name]
+            if sys.byteorder != 'little':
+                section = array('i', section)
+                section.byteswap()
+            chunks.append((name, len(section), section.tostring()))
+        fout = open(path, 'wb')
+        try:
+            fout.write(_HEADER.pack(MAGIC, VERSION, len(chunks)))
+            for name,count,data in chunks:
+                fout.write(_SECTION.pack(name, count, len(data)))
+                fout.write(data)
+        finally:
+            fout.close()
+
+    @classmethod
+    def read(cls, path):
+        snapshot = cls()
+        fin = open(path, 'rb')
+        try:
+            mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                magic,version,chunk_count = _HEADER.unpack_from(mm, 0)
+                assert magic == MAGIC, "Not a Rete snapshot: %s" % (path,)
+                assert version == VERSION, "Unsupported snapshot version: %s" % (version,)
+                offset = _HEADER.size
+                for _ in xrange(chunk_count):
+                    name,count,size = _SECTION.unpack_from(mm, offset)
+                    offset += _SECTION.size
+                    data = mm[offset:offset+size]
+                    offset += size
+                    if name == 'STRS':
+                        if count:
+                            snapshot.strings = data.decode('utf-8').split(u'\0')
+                    else:
+                        section = array('i', data)
+                        if sys.byteorder != 'little':
+                            section.byteswap()
+                        snapshot.sections[name] = section
+            finally:
+                mm.close()
+        finally:
+            fin.close()
+        snapshot._string_index = dict((s,i) for i,s in enumerate(snapshot.strings))
+        return snapshot
@@ -30,6 +30,15 @@ def walk_nodes(node, indent=0):
     
 class Test(TestCase):
     
+    def for_each_engine(self, scenario):
+        """
+        Runs scenario(Rete, engine) with the Rete class of each engine,
+        releasing the productions it added before the next engine.
+        """
+        for engine in models.ENGINES:
+            scenario(models.get_rete_class(engine), engine)
+            models.PNode.objects.all().delete()
+    
     def test_add_wme(self):
         rete = models.Rete().save()
         
@@ -74,7 +83,150 @@ class Test(TestCase):
         self.assertEqual(rete.items.all().count(), len(facts))
         
         nodes = models.AlphaNode.objects.filter(parent=None)
-        
+
+    def test_alpha_index(self):
+        """
+        Confirm the in-process alpha index mirrors the alphanode network and
+        stays coherent when alphanodes are added after it's built.
+        """
+        rete = models.Rete().save()
+        p1 = models.Production.get('p1',[])
+        c1 = models.Condition.get(p1, '?','?x','on','?y')
+        an1 = rete.build_or_share_alpha_memory(c1)
+
+        # Confirm an index built from the database finds the same node.
+        rete2 = models.Rete.objects.get(id=rete.id)
+        self.assertEqual(rete2.alpha_index.get_child(rete2.alpha_index.top, P_IDX, EQ_IDX, 'on'), an1)
+        self.assertEqual(rete2.alpha_index.get_child(rete2.alpha_index.top, P_IDX, EQ_IDX, 'under'), None)
+
+        f1 = T('block1', 'on', 'block2')
+        rete.add_wme(f1)
+        self.assertEqual(list(an1.items.all()), [f1])
+
+        # Confirm nodes added after the index is built are routed to.
+        c2 = models.Condition.get(p1, '?','?x','color','red')
+        an2 = rete.build_or_share_alpha_memory(c2)
+        self.assertEqual(rete.build_or_share_alpha_memory(c2), an2)
+        self.assertEqual(models.AlphaNode.objects.filter(rete=rete).count(), 4)
+        f2 = T('block2', 'color', 'red')
+        f3 = T('block3', 'color', 'blue')
+        rete.add_wme(f2)
+        rete.add_wme(f3)
+        self.assertEqual(list(an2.items.all()), [f2])
+        self.assertEqual(list(an1.items.all()), [f1])
+        self.assertEqual(rete.items.count(), 3)
+
+    def test_add_wmes(self):
+        """
+        Confirm adding WMEs in a batch results in the same matches as adding
+        them one at a time.
+        """
+        conditions = [
+            ['?','?x','on','?y'],
+            ['?','?y','left-of','?z'],
+            ['?','?z','color','red'],
+        ]
+        rete1 = models.Rete().save()
+        p1 = models.Production.get('p1', conditions)
+        rete1.add_production(p1)
+        rete2 = models.Rete().save()
+        p2 = models.Production.get('p2', conditions)
+        rete2.add_production(p2)
+
+        facts = []
+        facts.append(T('block1', 'on', 'block2'))
+        facts.append(T('block2', 'left-of', 'block3'))
+        facts.append(T('block3', 'color', 'red'))
+        facts.append(T('block11', 'on', 'block21'))
+        facts.append(T('block21', 'left-of', 'block31'))
+        facts.append(T('block31', 'color', 'red'))
+        facts.append(T('block21', 'left-of', 'block3'))
+        facts.append(T('block5', 'color', 'blue'))
+
+        # Add some WMEs beforehand, so the batch has to join against
+        # pre-existing tokens as well as its own.
+        for fact in facts[:2]:
+            rete1.add_wme(fact)
+        rete1.add_wmes(facts[2:] + facts[:1])
+        for fact in facts:
+            rete2.add_wme(fact)
+
+        self.assertEqual(rete1.items.count(), len(facts))
+        pnode1 = models.PNode.objects.get(production=p1)
+        pnode2 = models.PNode.objects.get(production=p2)
+        self.assertEqual(pnode1._triggered, 3)
+        self.assertEqual(pnode1._triggered, pnode2._triggered)
+        matches1 = sorted(sorted(t.id for t in m) for m in pnode1.matches)
+        matches2 = sorted(sorted(t.id for t in m) for m in pnode2.matches)
+        self.assertEqual(len(matches1), 3)
+        self.assertEqual(matches1, matches2)
+
+    def test_token_get_or_create_many(self):
+        """
+        Confirm tokens are created in bulk, reusing existing ones, and that
+        only the children of the given parents are looked up.
+        """
+        t1 = T('block1', 'on', 'block2')
+        t2 = T('block2', 'color', 'red')
+        root = models.Token.objects.create(parent=None, wme=None)
+        parents = [models.Token.objects.create(parent=root, index=1, wme=t1, _wme_ids=str(t1.id))
+                   for i in xrange(3)]
+        others = [models.Token.objects.create(parent=parent, index=2, wme=t2)
+                  for parent in parents[1:]]
+        
+        tokens = models.Token.get_or_create_many([(parents[0], t2), (parents[1], t2), (parents[0], t2)])
+        self.assertEqual(tokens[1], others[0])
+        self.assertEqual(tokens[0], tokens[2])
+        self.assertEqual(tokens[0].parent_id, parents[0].id)
+        self.assertEqual(tokens[0].wme_ids, [t1.id, t2.id])
+        self.assertEqual(models.Token.objects.filter(wme=t2).count(), 3)
+        
+        with self.assertNumQueries(1):
+            self.assertEqual(models.Token.get_or_create_many([(parents[2], t2)]), [others[1]])
+
+    def test_join_candidates(self):
+        """
+        Confirm join activations only consider the partners selected by the
+        equality tests.
+        """
+        rete = models.Rete().save()
+        p1 = models.Production.get('p1',[
+            ['?id1','?x','on','?y'],
+            ['?','?id1','created','?c'],
+            ['?','?y','left-of','?z'],
+        ])
+        rete.add_production(p1)
+        betajoins = list(models.BetaJoinNode.objects.all().order_by('id'))
+        self.assertEqual(len(betajoins), 3)
+
+        f1 = T('block1', 'on', 'block2')
+        f2 = T(f1.id, 'created', '2012')
+        f3 = T('block5', 'on', 'block6')
+        f4 = T(f3.id, 'created', '2013')
+        others = [T('block%i' % i, 'left-of', 'block%i' % (i+1)) for i in range(10, 15)]
+        f5 = T('block2', 'left-of', 'block3')
+        rete.add_wmes([f1,f2,f3,f4] + others + [f5])
+        pnode = models.PNode.objects.get(production=p1)
+        self.assertEqual(pnode._triggered, 1)
+
+        # Left activation, joining a token against the alpha memory.
+        token = models.Token.objects.get(wme=f2, index=2)
+        bj = models.BetaJoinNode.objects.get(id=betajoins[2].id)
+        self.assertEqual(list(bj.get_alpha_candidates(token)), [f5])
+
+        # Right activation, joining a WME against the beta memory, through
+        # an equality test on the ID field.
+        bj = models.BetaJoinNode.objects.get(id=betajoins[1].id)
+        self.assertEqual([t.wme for t in bj.get_parent_candidates(f4)], [f3])
+        self.assertEqual(list(bj.get_parent_candidates(f5)), [])
+        self.assertEqual(bj.get_wme_join_key(f4), (f3.id,))
+
+        # Confirm the same match results from one-at-a-time activation.
+        rete.remove_wme(f5)
+        self.assertEqual(len(list(rete.triggered_pnodes)), 0)
+        rete.add_wme(f5)
+        self.assertEqual(len(list(rete.triggered_pnodes)), 1)
+
     def test_remove_wme(self):
         rete = models.Rete().save()
         p1 = models.Production.get('p1',[
@@ -109,7 +261,106 @@ class Test(TestCase):
         # Confirm production was un-triggered.
         rete.remove_wme(facts[3])
         self.assertEqual(len(list(rete.triggered_pnodes)), 0)
-    
+
+    def test_remove_popular_wme(self):
+        """
+        Confirm retracting a WME shared by many matches removes the whole
+        token tree in aggregate.
+        """
+        rete = models.Rete().save()
+        p1 = models.Production.get('p1',[
+            ['?','?x','on','?y'],
+            ['?','?y','color','red'],
+        ])
+        rete.add_production(p1)
+
+        popular = T('block0', 'color', 'red')
+        facts = [T('block%i' % i, 'on', 'block0') for i in range(1, 21)]
+        rete.add_wmes(facts + [popular])
+        pnode = models.PNode.objects.get(production=p1)
+        self.assertEqual(pnode._triggered, 20)
+
+        top_ids = list(models.Token.objects.filter(wme__in=facts).values_list('id', flat=True))
+        self.assertEqual(len(top_ids), 20)
+        leaf_ids = list(models.Token.objects.filter(wme=popular).values_list('id', flat=True))
+        self.assertEqual(len(leaf_ids), 20)
+
+        # Confirm the recursive query and its iterative fallback agree.
+        expected = sorted(top_ids + leaf_ids)
+        self.assertEqual(sorted(models.Token.get_descendent_ids(top_ids)), expected)
+        _supports = models.Token.supports_recursive_queries
+        models.Token.supports_recursive_queries = classmethod(lambda cls: False)
+        try:
+            self.assertEqual(sorted(models.Token.get_descendent_ids(top_ids)), expected)
+        finally:
+            models.Token.supports_recursive_queries = _supports
+
+        rete.remove_wme(popular)
+        pnode = models.PNode.objects.get(production=p1)
+        self.assertEqual(pnode._triggered, 0)
+        self.assertEqual(pnode.tokens.all().count(), 0)
+        self.assertEqual(models.Token.objects.filter(id__in=leaf_ids).count(), 0)
+        self.assertEqual(models.Token.objects.filter(id__in=top_ids).count(), 20)
+
+        # Confirm emptying the alpha memory left-unlinks the join below it.
+        bj = models.BetaJoinNode.objects.exclude(_betamemory=None).get()
+        self.assertFalse(bj.is_linked_left)
+        self.assertTrue(bj.is_linked_right)
+        rete.add_wme(popular)
+        bj = models.BetaJoinNode.objects.get(id=bj.id)
+        self.assertTrue(bj.is_linked_left)
+        self.assertEqual(models.PNode.objects.get(production=p1)._triggered, 20)
+
+        # Confirm removing the tokens of the first condition empties its
+        # betamemory and right-unlinks the join below it.
+        for fact in facts:
+            rete.remove_wme(fact)
+        self.assertEqual(models.Token.objects.filter(id__in=top_ids).count(), 0)
+        bj = models.BetaJoinNode.objects.get(id=bj.id)
+        self.assertFalse(bj.is_linked_right)
+        self.assertTrue(bj.is_linked_left)
+        self.assertEqual(models.PNode.objects.get(production=p1)._triggered, 0)
+
+    def test_left_unlinking(self):
+        """
+        Confirm join nodes whose alpha memory is empty aren't left activated.
+        """
+        rete = models.Rete().save()
+        p1 = models.Production.get('p1',[
+            ['?','?x','on','?y'],
+            ['?','?y','color','red'],
+        ])
+        rete.add_production(p1)
+        bj = models.BetaJoinNode.objects.exclude(_betamemory=None).get()
+
+        activations = []
+        _left_activation = models.BetaJoinNode.left_activation
+        def left_activation(self, token, level=0):
+            activations.append(self.id)
+            return _left_activation(self, token, level=level)
+        models.BetaJoinNode.left_activation = left_activation
+        try:
+            # The color alpha memory is empty, so tokens aren't joined against
+            # it.
+            for i in range(10):
+                rete.add_wme(T('block%i' % i, 'on', 'block%i' % (i+1)))
+            self.assertEqual(activations, [bj.id])
+            bj = models.BetaJoinNode.objects.get(id=bj.id)
+            self.assertFalse(bj.is_linked_left)
+            self.assertTrue(bj.is_linked_right)
+
+            # Once it's non-empty, each new token is joined.
+            del activations[:]
+            rete.add_wme(T('block3', 'color', 'red'))
+            self.assertEqual(models.PNode.objects.get(production=p1)._triggered, 1)
+            bj = models.BetaJoinNode.objects.get(id=bj.id)
+            self.assertTrue(bj.is_linked_left)
+            rete.add_wme(T('block20', 'on', 'block3'))
+            self.assertEqual(activations, [bj.id])
+            self.assertEqual(models.PNode.objects.get(production=p1)._triggered, 2)
+        finally:
+            models.BetaJoinNode.left_activation = _left_activation
+
     def test_betanode_perform_join_tests(self):
         
         rete = models.Rete().save()
@@ -142,6 +393,14 @@ class Test(TestCase):
         self.assertEqual(t2.get_wme(index=2), facts[1])
         self.assertEqual(t2.get_wme(index=3), facts[2])
         
+        # Confirm a token's WMEs are resolved with a single query.
+        self.assertEqual(t2.wme_ids, [f.id for f in facts])
+        t2 = models.Token.objects.get(id=t2.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(t2.get_wme(index=1), facts[0])
+            self.assertEqual(t2.get_wme(index=2), facts[1])
+            self.assertEqual(t2.get_list(), list(reversed(facts)))
+        
         test = models.TestAtJoinNode(parent=bn,
                               field_of_arg1=models.S_IDX,
                               condition_number_of_arg2=2,
@@ -150,6 +409,15 @@ class Test(TestCase):
         #TODO:why facts[2]?
         self.assertEqual(bn.perform_join_tests(token=t2, wme=facts[2]), True)
         
+        # Confirm the compiled tests are cached, and recompiled when the
+        # tests change.
+        plan = bn.join_plan
+        self.assertEqual(models.BetaJoinNode.objects.get(id=bn.id).join_plan, plan)
+        self.assertEqual(plan.equality_tests, [test])
+        models.TestAtJoinNode(parent=bn, expression="_v(1,2) == 'block2'").save()
+        self.assertNotEqual(bn.join_plan, plan)
+        self.assertEqual(bn.perform_join_tests(token=t2, wme=facts[2]), False)
+        
     def test_wme_removal_structures(self):
         rete = models.Rete().save()
         
@@ -1000,6 +1268,29 @@ class Test(TestCase):
         self.assertEqual(match_vars, frozenset([frozenset([(u'index', u'1'), (u'mount_point', u'/dev/sdb'), (u'id1', 1)]),
                                                 frozenset([(u'mount_point', u'/dev/sda'), (u'index', u'0'), (u'id1', 1)])]))
 
+    def test_iter_match_variables(self):
+        """
+        Confirm variable bindings are streamed a chunk of tokens at a time,
+        including fields holding a model.
+        """
+        rete = models.Rete().save()
+        graph = GraphId.objects.create(value='g1')
+        rete.add_wmes([
+            T('block1', 'on', 'block2'),
+            T('block2', 'on', 'block3'),
+            T('block3', 'on', graph),
+        ])
+        pnode = rete.add_production(models.Production.get('p1',[
+            ['?','?x','on','?y'],
+        ]))
+        match_vars = list(pnode.iter_match_variables(chunk_size=2))
+        self.assertEqual(match_vars, [
+            {'x':'block1', 'y':'block2'},
+            {'x':'block2', 'y':'block3'},
+            {'x':'block3', 'y':graph},
+        ])
+        self.assertEqual(list(pnode.match_variables), match_vars)
+
     def test_pnode_trigger_stack(self):
         
         rete = models.Rete().save()
@@ -1167,7 +1458,639 @@ class Test(TestCase):
         rete.add_wme(T('block3', 'above', 'block4'))
         
         self.assertEqual(len(list(rete.triggered_pnodes)), 1)
+
+    def test_inequality_alpha_tests(self):
+        """
+        Confirm WMEs are routed to alphanodes testing for inequality with a
+        constant, both when the WME is added and when the alphanode is.
+        """
+        def scenario(Rete, engine):
+            rete = Rete().save()
+            short = T('block1', 'height', 2)
+            tall = T('block2', 'height', 5)
+            odd = T('block3', 'height', 'tall')
+            rete.add_wmes([short, tall])
+            
+            productions = []
+            for i,test in enumerate([u'<4', u'>3', u'≤3', u'≥5', u'≠2']):
+                p = models.Production.get('h%i' % i, [['?','?x','height',test]])
+                rete.add_production(p)
+                productions.append(p)
+            rete.add_wme(odd)
+            
+            matches = {}
+            for pnode in rete.triggered_pnodes:
+                matches[pnode.production.name] = sorted(match[0].subject for match in pnode.matches)
+            self.assertEqual(matches, {
+                'h0': [u'block1'],
+                'h1': [u'block2'],
+                'h2': [u'block1'],
+                'h3': [u'block2'],
+                'h4': [u'block2', u'block3'],
+            }, engine)
+        self.for_each_engine(scenario)
+
+    def test_join_sharing(self):
+        """
+        Confirm productions with a common prefix of conditions share the join
+        nodes built for that prefix.
+        """
+        def scenario(Rete, engine):
+            rete = Rete().save()
+            p1 = models.Production.get('p1',[
+                ['?','?x','on','?y'],
+                ['?','?y','color','red'],
+            ])
+            p2 = models.Production.get('p2',[
+                ['?','?a','on','?b'],
+                ['?','?b','color','red'],
+                ['?','?a','size','big'],
+            ])
+            pnode1 = rete.add_production(p1)
+            pnode2 = rete.add_production(p2)
+            self.assertEqual(pnode2.parent.parent.parent, pnode1.parent, engine)
+            self.assertEqual(pnode2.parent.parent.parent.parent.parent, pnode1.parent.parent.parent, engine)
+            
+            rete.add_wmes([
+                T('block1', 'on', 'block2'),
+                T('block2', 'color', 'red'),
+                T('block1', 'size', 'big'),
+            ])
+            self.assertEqual(sorted(pnode.production.name for pnode in rete.triggered_pnodes), ['p1', 'p2'], engine)
+        self.for_each_engine(scenario)
+
+    def test_remove_shared_production(self):
+        """
+        Confirm removing a production leaves the join nodes it shares with
+        other productions intact.
+        """
+        def scenario(Rete, engine):
+            rete = Rete().save()
+            p1 = models.Production.get('p1',[
+                ['?','?x','on','?y'],
+            ])
+            p2 = models.Production.get('p2',[
+                ['?','?x','on','?y'],
+                ['?','?y','color','red'],
+            ])
+            rete.add_production(p1)
+            pnode2 = rete.add_production(p2)
+            rete.add_wmes([
+                T('block1', 'on', 'block2'),
+                T('block2', 'color', 'red'),
+            ])
+            self.assertEqual(len(list(pnode2.match_variables)), 1, engine)
+            
+            rete.remove_production(p1)
+            rete.add_wme(T('block3', 'on', 'block2'))
+            self.assertEqual(sorted(match['x'] for match in pnode2.match_variables), ['block1', 'block3'], engine)
+        self.for_each_engine(scenario)
+
+    def test_add_productions(self):
+        """
+        Confirm a rule set compiled in bulk matches the WMEs already in the
+        network, counting each match once.
+        """
+        def scenario(Rete, engine):
+            rete = Rete().save()
+            rete.add_wmes([
+                T('block1', 'on', 'block2'),
+                T('block2', 'color', 'red'),
+                T('block1', 'size', 'big'),
+                T('block3', 'on', 'block2'),
+            ])
+            productions = [
+                models.Production.get('p1',[
+                    ['?','?x','on','?y'],
+                ]),
+                models.Production.get('p2',[
+                    ['?','?x','on','?y'],
+                    ['?','?y','color','red'],
+                ]),
+                models.Production.get('p3',[
+                    ['?','?x','on','?y'],
+                    ['?','?y','color','red'],
+                    ['?','?x','size','big'],
+                ]),
+                models.Production.get('p4',[
+                    ['?','?x','color','blue'],
+                ]),
+            ]
+            pnodes = rete.add_productions(productions)
+            self.assertEqual([pnode.production for pnode in pnodes], productions, engine)
+            self.assertEqual([pnode.triggered for pnode in pnodes], [2, 2, 1, 0], engine)
+            match_vars = sorted(sorted(mv.items()) for mv in pnodes[2].match_variables)
+            self.assertEqual(match_vars, [[(u'x', u'block1'), (u'y', u'block2')]], engine)
+            
+            # Shared matches survive the removal of a production.
+            rete.remove_production(productions[0])
+            self.assertEqual(sorted(pnode.production.name for pnode in rete.triggered_pnodes), ['p2', 'p3'], engine)
+        self.for_each_engine(scenario)
+
+    def test_alpha_memory_initialization(self):
+        """
+        Confirm a new alpha memory is filled from its parent's memory without
+        re-activating the rest of the network.
+        """
+        rete = models.Rete().save()
+        t1 = T('block1', 'on', 'block2')
+        t2 = T('block2', 'color', 'red')
+        t3 = T('block3', 'color', 'blue')
+        t4 = T(t1.id, 'color', 'red')
+        rete.add_wmes([t1, t2, t3, t4])
+        pnode = rete.add_production(models.Production.get('p1',[
+            ['?','?x','color','?c'],
+        ]))
+        self.assertEqual(pnode.triggered, 3)
         
+        p2 = models.Production.get('p2',[
+            ['?','?x','color','red'],
+            ['?','?x','on','?y'],
+        ])
+        p3 = models.Production.get('p3',[
+            [str(t4.id),'?x','color','?c'],
+        ])
+        anode = rete.build_or_share_alpha_memory(p2.conditions.all().order_by('id')[0])
+        self.assertEqual(sorted(anode.items.all().values_list('id', flat=True)), [t2.id, t4.id])
+        self.assertEqual(anode.value_atom.text, 'red')
+        models.AlphaNode.objects.filter(id=anode.id).update(value_atom=None)
+        self.assertEqual(models.AlphaNode.intern_values(), 1)
+        self.assertEqual(models.AlphaNode.objects.get(id=anode.id).value_atom.text, 'red')
+        anode = rete.build_or_share_alpha_memory(p3.conditions.all().order_by('id')[0])
+        self.assertEqual(list(anode.items.all()), [t4])
+        self.assertEqual(models.PNode.objects.get(id=pnode.id).triggered, 3)
+
+    def test_reorder_conditions(self):
+        """
+        Confirm a production's conditions can be joined most selective first,
+        without a cross product where a connected order exists, while its
+        variables are still extracted in the defined order.
+        """
+        def scenario(Rete, engine):
+            rete = Rete().save()
+            rete.add_wmes([T('block%i' % i, 'on', 'block%i' % (i+1)) for i in xrange(10)])
+            rete.add_wmes([T('block5', 'color', 'red'), T('block3', 'size', 'big')])
+            rete.add_production(models.Production.get('p0',[
+                ['?','?a','on','?b'],
+                ['?','?b','color','red'],
+            ]))
+            p1 = models.Production.get('p1',[
+                ['?','?x','on','?y'],
+                ['?','?w','size','big'],
+                ['?','?y','color','red'],
+            ])
+            pnode = rete.add_production(p1, reorder=True)
+            self.assertEqual([c.parts[2] for c in pnode.conditions], ['color', 'on', 'size'], engine)
+            self.assertEqual(list(pnode.match_variables), [{'x':'block4', 'y':'block5', 'w':'block3'}], engine)
+            
+            # Consecutive expressions stay behind the condition they follow.
+            t1 = T('block1', 'on', 'block2')
+            rete.add_wme(t1)
+            rete.add_wme(T(t1.id, 'created', 50))
+            p2 = models.Production.get('p2',[
+                ['?id1','?x','on','?y'],
+                ['?','?id1','created','?c1'],
+                ['float(?c1) > 1'],
+                ['float(?c1) < 100'],
+            ])
+            pnode = rete.add_production(p2, reorder=True)
+            self.assertEqual([c.expression for c in pnode.conditions][2:], ['float(?c1) > 1', 'float(?c1) < 100'], engine)
+            self.assertEqual([(match['x'], match['c1']) for match in pnode.match_variables], [('block1', '50')], engine)
+        self.for_each_engine(scenario)
+
+    def test_effects(self):
+        """
+        Confirm a production's effects are decoded once, and fire with their
+        lookups compiled.
+        """
+        import cPickle as pickle
+        rete = models.Rete().save()
+        t1 = T('block1', 'color', 'red')
+        p1 = models.Production.get('p1', [
+            ['?id','?x','color','red'],
+        ], effects=[
+            models.Create([{'?x':{'size':'?size'}}], var_map={'size':"'big'"}),
+            models.Update('?id', 'object', 'blue'),
+        ])
+        effects = p1.effects
+        self.assertEqual(models._effects[p1.id], (p1._rhs_pickle, effects))
+        self.assertEqual([type(effect) for effect in p1.effects], [models.Create, models.Update])
+        p1.effects.append(None)
+        self.assertEqual(len(p1.effects), 2)
+        
+        vars = {'x':'block1', 'id':t1.id}
+        facts = effects[0]._do(rete, vars, graphs=[])
+        self.assertEqual([(t.subject, t.predicate, t.object) for t in facts], [('block1', 'size', 'big')])
+        self.assertEqual(vars['size'], 'big')
+        effects[1]._do(rete, vars)
+        self.assertEqual(Triple.objects.get(id=t1.id).object, 'blue')
+        
+        # Compiled lookups aren't pickled.
+        self.assertEqual(sorted(pickle.loads(pickle.dumps(effects[0])).__dict__), ['parts', 'var_map'])
+        
+        # Nested parts get new blank nodes on each firing.
+        create = models.Create([{'?x':{'has':{'size':'big'}}}])
+        blanks = []
+        for i in xrange(2):
+            facts = create._do(rete, {'x':'block1'}, graphs=[])
+            blanks.append([t.object for t in facts if t.subject == 'block1'][0])
+            self.assertTrue(blanks[-1].startswith('#'))
+            self.assertEqual([(t.predicate, t.object) for t in facts if t.subject == blanks[-1]], [('size', 'big')])
+        self.assertNotEqual(blanks[0], blanks[1])
+        
+        # Changing the effects replaces the cached ones.
+        size = len(models._effects)
+        p1.effects = [models.Update('?id', 'object', 'green')]
+        self.assertEqual(p1.effects[0].new_field_value, 'green')
+        self.assertEqual(models._effects[p1.id][0], p1._rhs_pickle)
+        self.assertEqual(len(models._effects), size)
+        
+        # Deleting the production discards its cached effects.
+        p1_id = p1.id
+        p1.delete()
+        self.assertTrue(p1_id not in models._effects)
+
+    def test_match_changes(self):
+        """
+        Confirm the matches added and removed after a sequence number can be
+        read from the activation log.
+        """
+        def scenario(Rete, engine):
+            rete = Rete().save()
+            p1 = models.Production.get('p1',[
+                ['?','?x','on','?y'],
+            ])
+            p2 = models.Production.get('p2',[
+                ['?','?x','color','red'],
+            ])
+            rete.add_productions([p1, p2])
+            t1 = T('block1', 'on', 'block2')
+            rete.add_wme(t1)
+            changes = list(rete.match_changes())
+            self.assertEqual([change[1:] for change in changes], [(p1, True, [t1])], engine)
+            
+            since = changes[-1][0]
+            t2 = T('block2', 'on', 'block3')
+            rete.add_wme(t2)
+            rete.add_wme(T('block3', 'color', 'red'))
+            rete.remove_wme(t1)
+            changes = list(rete.match_changes(since=since, productions=[p1]))
+            self.assertEqual([change[1:] for change in changes], [(p1, True, [t2]), (p1, False, [t1])], engine)
+            self.assertTrue(changes[0][0] > since)
+            self.assertEqual(len(list(rete.match_changes(since=since))), 3, engine)
+            self.assertEqual(list(rete.match_changes(since=changes[-1][0], productions=[p1])), [], engine)
+            
+            # Confirm changes already read can be pruned from the log.
+            last = changes[-1][0]
+            self.assertEqual(rete.prune_match_changes(through=since), 1, engine)
+            self.assertEqual([change[0] for change in rete.match_changes()][-1], last, engine)
+            self.assertEqual(len(list(rete.match_changes())), 3, engine)
+            self.assertEqual(rete.prune_match_changes(), 2, engine)
+            self.assertEqual([change[0] for change in rete.match_changes()], [last], engine)
+            self.assertEqual(rete.prune_match_changes(), 0, engine)
+            rete.add_wme(T('block4', 'on', 'block5'))
+            changes = list(rete.match_changes(since=last))
+            self.assertEqual(len(changes), 1, engine)
+            self.assertTrue(changes[0][0] > last, engine)
+        self.for_each_engine(scenario)
+    
+    def test_pnode_rete_id(self):
+        """
+        Confirm a pnode's network is looked up once, rather than on every
+        activation.
+        """
+        rete = models.Rete().save()
+        p1 = models.Production.get('p1',[
+            ['?','?x','on','?y'],
+        ])
+        rete.add_production(p1)
+        rete.add_wme(T('block1', 'on', 'block2'))
+        pnode = models.PNode.objects.get(production=p1)
+        with self.assertNumQueries(0):
+            self.assertEqual(pnode.rete_id, rete.id)
+        self.assertEqual(rete.activations.all().count(), 1)
+
+    def test_engines(self):
+        """
+        Confirm each engine matches, extracts variables and retracts the same
+        way.
+        """
+        import time
+        def scenario(Rete, engine):
+
+            # Retraction.
+            rete = Rete().save()
+            p1 = models.Production.get('p1',[
+                ['?','?x','on','?y'],
+                ['?','?y','left-of','?z'],
+                ['?','?z','color','red'],
+            ])
+            rete.add_production(p1)
+            facts = []
+            facts.append(T('block1', 'on', 'block2'))
+            facts.append(T('block2', 'left-of', 'block3'))
+            facts.append(T('block3', 'color', 'red'))
+            facts.append(T('block11', 'on', 'block21'))
+            facts.append(T('block21', 'left-of', 'block31'))
+            facts.append(T('block31', 'color', 'red'))
+            for fact in facts:
+                rete.add_wme(fact)
+            self.assertEqual(len(list(rete.items)), len(facts))
+            self.assertEqual([pnode.triggered for pnode in rete.triggered_pnodes], [2], engine)
+            match_vars = sorted(sorted(mv.items()) for mv in list(rete.triggered_pnodes)[0].match_variables)
+            self.assertEqual(match_vars, [
+                [(u'x', u'block1'), (u'y', u'block2'), (u'z', u'block3')],
+                [(u'x', u'block11'), (u'y', u'block21'), (u'z', u'block31')],
+            ])
+            rete.remove_wme(facts[1])
+            self.assertEqual([pnode.triggered for pnode in rete.triggered_pnodes], [1], engine)
+            rete.remove_wme(facts[3])
+            self.assertEqual(len(list(rete.triggered_pnodes)), 0, engine)
+
+            # Productions added after their WMEs, and then removed.
+            rete = Rete().save()
+            facts = [T('block1', 'on', 'block2'), T('block2', 'color', 'red')]
+            rete.add_wmes(facts)
+            p2 = models.Production.get('p2',[
+                ['?','?x','on','?y'],
+                ['?','?y','color','red'],
+            ])
+            p3 = models.Production.get('p3',[
+                ['?','?x','on','?y'],
+            ])
+            rete.add_production(p2)
+            rete.add_production(p3)
+            self.assertEqual(len(list(rete.triggered_pnodes)), 2, engine)
+            pnode = [pnode for pnode in rete.triggered_pnodes if pnode.production == p2][0]
+            self.assertEqual([[t.id for t in match] for match in pnode.matches], [[facts[1].id, facts[0].id]])
+            rete.remove_production(p2)
+            self.assertEqual([pnode.production for pnode in rete.triggered_pnodes], [p3], engine)
+
+            # Expression tests.
+            rete = Rete().save()
+            p4 = models.Production.get('p4',[
+                ['?id1','?x','on','?y'],
+                ['?','?id1','created','?created1'],
+                ['?id2','?y','left-of','?z'],
+                ['?','?id2','created','?created2'],
+                ['float(?created1) < float(?created2)'],
+                ['?','?z','above','?z2'],
+            ])
+            rete.add_production(p4)
+            t1 = T('block1', 'on', 'block2')
+            t2 = T(t1.id, 'created', time.time())
+            t3 = T('block2', 'left-of', 'block3')
+            t4 = T(t3.id, 'created', time.time()+1)
+            for t in (t1, t2, t3, t4):
+                rete.add_wme(t)
+            self.assertEqual(len(list(rete.triggered_pnodes)), 0, engine)
+            rete.add_wme(T('block3', 'above', 'block4'))
+            self.assertEqual(len(list(rete.triggered_pnodes)), 1, engine)
+        self.for_each_engine(scenario)
+
+    def test_remove_repeated_wme(self):
+        """
+        Confirm removing a WME held by both a token and its descendent, as
+        with expression tests and self-joins, retracts both once.
+        """
+        def scenario(Rete, engine):
+            rete = Rete().save()
+            p1 = models.Production.get('p1',[
+                ['?id','?x','on','?y'],
+                ['?','?id','created','?c'],
+                ['float(?c) > 3'],
+            ])
+            p2 = models.Production.get('p2',[
+                ['?','?x','on','?y'],
+                ['?','?y','on','?z'],
+            ])
+            rete.add_productions([p1, p2])
+            facts = [T('block%i' % i, 'on', 'block%i' % i) for i in xrange(6)]
+            rete.add_wmes(facts)
+            rete.add_wmes([T(fact.id, 'created', i+1) for i,fact in enumerate(facts)])
+            self.assertEqual(sorted(pnode.triggered for pnode in rete.triggered_pnodes), [6, 18], engine)
+            for fact in facts[::2]:
+                rete.remove_wme(fact)
+            self.assertEqual(sorted(pnode.triggered for pnode in rete.triggered_pnodes), [3, 12], engine)
+        self.for_each_engine(scenario)
+
+    def test_snapshot(self):
+        """
+        Confirm a network can be dumped from either engine and restored into
+        the memory engine, and keeps matching after it's restored.
+        """
+        import os, tempfile
+        from memory import Rete as MemoryRete
+        conditions = [
+            ['?','?x','on','?y'],
+            ['?','?y','left-of','?z'],
+            ['?','?z','color','red'],
+        ]
+        facts = []
+        facts.append(T('block1', 'on', 'block2'))
+        facts.append(T('block2', 'left-of', 'block3'))
+        facts.append(T('block3', 'color', 'red'))
+        facts.append(T('block11', 'on', 'block21'))
+        facts.append(T('block21', 'left-of', 'block31'))
+        fd,path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for engine in models.ENGINES:
+                rete = models.get_rete_class(engine)().save()
+                p1 = models.Production.get('p1', conditions)
+                rete.add_production(p1)
+                rete.add_wmes(facts)
+                rete.dump(path)
+
+                rete2 = MemoryRete.load(path)
+                self.assertEqual(sorted(t.id for t in rete2.items), sorted(t.id for t in facts))
+                pnodes = list(rete2.triggered_pnodes)
+                self.assertEqual([(pnode.production, pnode.triggered) for pnode in pnodes], [(p1, 1)], engine)
+                self.assertEqual([[t.id for t in m] for m in pnodes[0].matches], [[facts[2].id, facts[1].id, facts[0].id]])
+
+                rete2.add_wme(T('block31', 'color', 'red'))
+                self.assertEqual(pnodes[0].triggered, 2)
+                rete2.remove_wme(facts[1])
+                self.assertEqual(pnodes[0].triggered, 1)
+
+                # Confirm the snapshot of a restored network is the same.
+                rete2.dump(path)
+                rete3 = MemoryRete.load(path)
+                self.assertEqual(sorted(sorted(mv.items()) for mv in rete3.pnodes[0].match_variables),
+                                 sorted(sorted(mv.items()) for mv in rete2.pnodes[0].match_variables))
+
+                models.PNode.objects.all().delete()
+        finally:
+            os.remove(path)
+
+    def test_write_behind(self):
+        """
+        Confirm changes to a write-behind network are matched immediately,
+        persisted in batches, and replayed from the journal after a crash.
+        """
+        import os, tempfile
+        from memory import WriteBehindRete
+        fd,path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            target = models.Rete().save()
+            rete = WriteBehindRete(target, path, max_pending=4, sync=False)
+            p1 = models.Production.get('p1',[
+                ['?','?x','on','?y'],
+                ['?','?y','color','red'],
+            ])
+            rete.add_production(p1)
+            f1 = T('block1', 'on', 'block2')
+            f2 = T('block2', 'color', 'red')
+            rete.add_wme(f1)
+            rete.add_wme(f2)
+            self.assertEqual(len(rete.triggered_pnodes), 1)
+            self.assertEqual(target.pnodes.all().count(), 0)
+            self.assertEqual(len(open(path).readlines()), 3)
+
+            # Confirm reaching the threshold flushes.
+            f3 = T('block3', 'on', 'block2')
+            rete.add_wme(f3)
+            self.assertEqual(len(open(path).readlines()), 0)
+            self.assertEqual(list(target.triggered_pnodes)[0]._triggered, 2)
+
+            # Confirm an idle network flushes once the interval has passed.
+            rete.interval = 60
+            f5 = T('block5', 'on', 'block2')
+            rete.add_wme(f5)
+            self.assertEqual(rete.flush_if_due(), False)
+            self.assertEqual(len(open(path).readlines()), 1)
+            rete._last_flush -= 60
+            self.assertEqual(rete.flush_if_due(), True)
+            self.assertEqual(len(open(path).readlines()), 0)
+            self.assertEqual(list(target.triggered_pnodes)[0]._triggered, 3)
+            rete.remove_wme(f5)
+            rete.flush()
+
+            # Simulate a crash, leaving changes in the journal.
+            rete.remove_wme(f1)
+            rete.add_wme(T('block4', 'on', 'block2'))
+            self.assertEqual(len(open(path).readlines()), 2)
+            rete = WriteBehindRete(target, path, sync=False)
+            self.assertEqual(len(open(path).readlines()), 0)
+            self.assertEqual(sorted(t.subject for t in target.items), ['block2', 'block3', 'block4'])
+            self.assertEqual(list(target.triggered_pnodes)[0]._triggered, 2)
+            self.assertEqual([pnode.triggered for pnode in rete.triggered_pnodes], [2])
+
+            rete.remove_production(p1)
+            self.assertEqual(target.pnodes.all().count(), 1)
+            rete.close()
+            self.assertEqual(target.pnodes.all().count(), 0)
+
+            # Confirm a reordered production is persisted and rebuilt with
+            # the same join order.
+            rete = WriteBehindRete(target, path, sync=False)
+            rete.add_production(models.Production.get('p3',[['?','?c','color','red']]))
+            p2 = models.Production.get('p2',[
+                ['?','?a','on','?b'],
+                ['?','?b','color','red'],
+            ])
+            order = [c.id for c in rete.add_production(p2, reorder=True).conditions]
+            self.assertNotEqual(order, sorted(order))
+            self.assertEqual(open(path).readlines()[-1].split()[-1], ','.join(map(str, order)))
+            rete.flush()
+            self.assertEqual([c.id for c in target.pnodes.get(production=p2).conditions], order)
+            rete = WriteBehindRete(target, path, sync=False)
+            pnode2 = rete._pnodes_by_production[p2.id]
+            self.assertEqual([c.id for c in pnode2.conditions], order)
+            self.assertEqual(pnode2.triggered, 2)
+            rete.close()
+        finally:
+            os.remove(path)
+
+    def test_ReteTripleImportQueue_pop_many(self):
+        """
+        Confirm the import queue can be drained in batches, and that a
+        locked queue isn't drained by a second worker.
+        """
+        rete0 = models.Rete().save()
+        rete1 = models.Rete().save()
+        p1 = models.Production.get('p1',[
+            ['?','?x','on','?y'],
+            ['?','?y','color','red'],
+        ])
+        rete0.add_production(p1)
+
+        facts = [T('block%i' % i, 'on', 'block0') for i in range(1, 6)]
+        facts.append(T('block0', 'color', 'red'))
+        for fact in facts:
+            models.ReteTripleImportQueue.push(fact, rete=rete0)
+        models.ReteTripleImportQueue.push(facts[0], rete=rete1, delete=True)
+
+        results = models.ReteTripleImportQueue.pop_many(rete0, 2)
+        self.assertEqual(results, [(facts[0],False), (facts[1],False)])
+        self.assertEqual(rete0.triple_import_queue.all().count(), 4)
+
+        # Confirm a worker can't claim rows while another holds the lock.
+        lock = models.ReteTripleImportQueueLock.acquire(rete0)
+        self.assertTrue(lock)
+        self.assertEqual(models.ReteTripleImportQueueLock.acquire(rete0), None)
+        self.assertEqual(models.ReteTripleImportQueue.pop_many(rete0, 2), None)
+        self.assertEqual(models.ReteTripleImportQueue.pop(rete1), (facts[0],True))
+        self.assertEqual(models.ReteTripleImportQueue.pop_many(rete1, 2), [])
+        
+        # Confirm a locked queue isn't reported as drained.
+        self.assertEqual(rete0.process_triple_import_queue(), False)
+        self.assertEqual(rete0.triple_import_queue.all().count(), 4)
+        lock.release()
+
+        # Confirm the remainder is processed in bulk.
+        for fact in facts[:2]:
+            models.ReteTripleImportQueue.push(fact, rete=rete0)
+        self.assertEqual(rete0.process_triple_import_queue(batch_size=3), True)
+        self.assertEqual(rete0.triple_import_queue.all().count(), 0)
+        self.assertEqual(rete0.items.all().count(), len(facts))
+        self.assertEqual(models.PNode.objects.get(production=p1)._triggered, 5)
+        self.assertEqual(models.ReteTripleImportQueue.pop(rete0), None)
+
+    def test_rete_wmes(self):
+        """
+        Confirm each Rete network records the triples it contains, so
+        queued updates fan out without scanning the alpha memories.
+        """
+        from triple.constants import SUBJECT
+        rete0 = models.Rete().save()
+        rete1 = models.Rete().save()
+        rete2 = models.Rete().save()
+
+        t1 = T('block1', 'on', 'block2')
+        t2 = T('block2', 'on', 'block3')
+        rete0.add_wme(t1)
+        rete1.add_wmes([t1, t2])
+        self.assertEqual(sorted(r.id for r in t1.retes.all()), [rete0.id, rete1.id])
+        self.assertEqual(models.Rete.get_rete_ids([t1, t2]), {t1.id:set([rete0.id, rete1.id]), t2.id:set([rete1.id])})
+
+        with self.assertNumQueries(2):
+            models.ReteTripleImportQueue.push_many([t1, t2], rete=rete2)
+        self.assertEqual(rete0.triple_import_queue.all().count(), 1)
+        self.assertEqual(rete1.triple_import_queue.all().count(), 2)
+        self.assertEqual(rete2.triple_import_queue.all().count(), 2)
+        models.ReteTripleImportQueue.objects.all().delete()
+
+        t2new = models.update_wme(t2, SUBJECT, 'block4')
+        queues = list(models.ReteTripleImportQueue.objects.all().order_by('id'))
+        self.assertEqual([(q.rete, q.triple, q._delete) for q in queues], [(rete1, t2, True), (rete1, t2new, False)])
+
+        # Note, removal applies to every alpha memory containing the WME.
+        rete1.remove_wme(t1)
+        self.assertEqual(list(t1.retes.all()), [])
+        self.assertEqual(rete0.items.count(), 0)
+        rete0.add_wme(t1)
+        self.assertEqual(list(t1.retes.all()), [rete0])
+        rete0.remove_all_wme()
+        self.assertEqual(rete0.wmes.all().count(), 0)
+        
+        # Memberships missing from older networks can be recorded.
+        models.Rete.wmes.through.objects.filter(rete=rete1).delete()
+        self.assertEqual(rete1.record_wmes(), 1)
+        self.assertEqual(rete1.record_wmes(), 0)
+        self.assertEqual(list(rete1.wmes.all()), list(rete1.items))
+
     def _test_ReteTripleImportQueue(self):
         """
         Test queuing triples for entry into a RETE network
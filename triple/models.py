@@ -9,14 +9,16 @@ import tempfile
 import cPickle as pickle
 import datetime
 import base64
+import operator
 from collections import defaultdict
 
 from django.conf import settings
 from django.core.files import File
 from django.db import models
 from django.db import IntegrityError, transaction, connection
-from django.db.models import F
+from django.db.models import F, Count
 from django.db.models.query_utils import Q
+from django.utils.encoding import smart_unicode
 from django.contrib.auth.models import User
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
@@ -42,37 +44,59 @@ def remove_duplicates(lst):
             next.append(el)
     return next
 
-def getDictCursor():
-    db = settings.DATABASES['default']
-    engine = db['ENGINE'].split('.')[-1]
-    if engine == 'mysql':
+def getDictCursor(stream=False, chunk_size=300):
+    """
+    Returns a cursor whose rows are dictionaries keyed by column name.
+    
+    The cursor is opened on Django's own connection for the current thread,
+    so queries share its settings and transaction and reuse the connection
+    instead of connecting to the database on every call.
+    
+    If stream is true, rows are fetched from the database chunk_size at a
+    time as the cursor is iterated, using a server-side cursor where the
+    backend supports one, so large results are never held in memory at once.
+    """
+    if connection.vendor == 'mysql':
         import MySQLdb.cursors
-        return connection.cursor(MySQLdb.DictCursor)
-    elif engine == 'postgresql_psycopg2':
-        # Django's db.connection doesn't support DictCursor.
-        import psycopg2
+        # Ensure Django has opened its connection.
+        connection.cursor()
+        if stream:
+            return connection.connection.cursor(MySQLdb.cursors.SSDictCursor)
+        return connection.connection.cursor(MySQLdb.cursors.DictCursor)
+    elif connection.vendor == 'postgresql':
+        # Django's cursor wrapper doesn't support DictCursor, so open one on
+        # the underlying psycopg2 connection.
         import psycopg2.extras
-        connection = psycopg2.connect("dbname='%s' user='%s' password='%s'" % (
-                                        db['NAME'],
-                                        db['USER'],
-                                        db['PASSWORD'],))
-        #connection.autocommit(1)#todo:enable when psycopg2 upgraded
-        return connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        if connection.connection is not None and connection.connection.closed:
+            # Discard a connection dropped by the server, so Django reopens it.
+            connection.close()
+        connection.cursor()
+        if stream:
+            # A named cursor is held open on the server, which sends rows
+            # itersize at a time.
+            cursor = connection.connection.cursor('query_%s' % uuid.uuid4().hex, cursor_factory=psycopg2.extras.DictCursor)
+            cursor.itersize = chunk_size
+            return cursor
+        return connection.connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
     else:
-        # Otherwise, simulate a DictCursor by wrapping the cursor instance.
+        # Otherwise, simulate a DictCursor by wrapping the cursor instance,
+        # converting rows to dictionaries as they're fetched.
         class _DictCursor:
             def __init__(self):
-                from django.db import connection
                 self.cursor = connection.cursor()
-                self._results = None
             def execute(self, *args, **kwargs):
                 self.cursor.execute(*args, **kwargs)
-                desc = self.cursor.description
-                self._results = [dict(zip([col[0] for col in desc], row)) for row in self.cursor.fetchall()]
             def __iter__(self):
-                if self._results is not None:
-                    for row in self._results:
-                        yield row
+                desc = self.cursor.description
+                if desc is None:
+                    return
+                names = [col[0] for col in desc]
+                while 1:
+                    rows = self.cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield dict(zip(names, row))
         return _DictCursor()
         #raise Exception, 'Unknown database engine: %s' % db['ENGINE']
 
@@ -97,9 +121,48 @@ class _BaseModel(models.Model):
 #        return super(Atom, self).save(*args, **kwargs)
 
 class Atom(_BaseModel):
+    """
+    An interned symbol, so the text fields of triples and alphanodes can be
+    indexed and compared as small integers.
+    """
     text = models.CharField(max_length=MAX_LENGTH, blank=True, null=False, db_index=True, unique=True)
+    
+    @classmethod
+    def get_ids(cls, texts):
+        """
+        Returns a dictionary of the form {text:atom id} for the given texts,
+        interning any not seen before.
+        """
+        texts = set(smart_unicode(text) for text in texts if text is not None)
+        if not texts:
+            return {}
+        ids = dict(cls.objects.filter(text__in=texts).values_list('text', 'id'))
+        for text in texts.difference(ids):
+            ids[text] = cls.objects.get_or_create(text=text)[0].id
+        return ids
 
 class TripleManager(models.Manager):
+    
+    def intern_atoms(self, chunk_size=300):
+        """
+        Links the text fields of triples missing their atoms, such as those
+        saved before atoms were interned, or written by bulk_create() or
+        update(), which bypass Triple.save(). Until linked, those triples
+        aren't matched by queries or Rete networks.
+        Returns the number of triples updated.
+        """
+        missing = [Q(**{'_%s_text__isnull' % field_name:False, '_%s_atom__isnull' % field_name:True})
+                   for field_name in (S, P, O)]
+        ids = list(self.filter(reduce(operator.or_, missing)).values_list('id', flat=True))
+        for i in xrange(0, len(ids), chunk_size):
+            for triple in self.filter(id__in=ids[i:i+chunk_size]):
+                triple.intern_atoms()
+                # Update the links only, so no save signals are sent.
+                self.filter(id=triple.id).update(**dict(
+                    ('_%s_atom' % field_name, getattr(triple, '_%s_atom_id' % field_name))
+                    for field_name in (S, P, O)))
+        return len(ids)
+    
     def search(self, subject=None, predicate=None, object=None, gid=None, **kwargs):
         """
         Queries fact objects matching the given criteria.
@@ -582,16 +645,19 @@ class Triple(models.Model):#_BaseModel):
     _subject_id = models.PositiveIntegerField(blank=True, null=True, db_index=True)
     _subject_object = generic.GenericForeignKey('_subject_type', '_subject_id')
     _subject_text = models.CharField(max_length=MAX_LENGTH, blank=True, null=True, db_index=True)
+    _subject_atom = models.ForeignKey(Atom, related_name='subject_triples', blank=True, null=True, db_index=True)
     
     _predicate_type = models.ForeignKey(ContentType, related_name='fact_predicate_type', blank=True, null=True, db_index=True)
     _predicate_id = models.PositiveIntegerField(blank=True, null=True, db_index=True)
     _predicate_object = generic.GenericForeignKey('_predicate_type', '_predicate_id')
     _predicate_text = models.CharField(max_length=MAX_LENGTH, blank=True, null=True, db_index=True)
+    _predicate_atom = models.ForeignKey(Atom, related_name='predicate_triples', blank=True, null=True, db_index=True)
     
     _object_type = models.ForeignKey(ContentType, related_name='fact_object_type', blank=True, null=True, db_index=True)
     _object_id = models.PositiveIntegerField(blank=True, null=True, db_index=True)
     _object_object = generic.GenericForeignKey('_object_type', '_object_id')
     _object_text = models.CharField(max_length=MAX_LENGTH, blank=True, null=True, db_index=True)
+    _object_atom = models.ForeignKey(Atom, related_name='object_triples', blank=True, null=True, db_index=True)
     
     objects = TripleManager()
     
@@ -606,6 +672,19 @@ class Triple(models.Model):#_BaseModel):
             t.graphs.add(gid)
         return t
     
+    def save(self, *args, **kwargs):
+        self.intern_atoms()
+        return super(Triple, self).save(*args, **kwargs)
+    
+    def intern_atoms(self):
+        """
+        Links each text field to the Atom interning its value.
+        """
+        texts = dict((field_name, getattr(self, '_%s_text' % field_name)) for field_name in (S, P, O))
+        ids = Atom.get_ids(texts.values())
+        for field_name,text in texts.iteritems():
+            setattr(self, '_%s_atom_id' % field_name, None if text is None else ids[smart_unicode(text)])
+    
     @classmethod
     def current_object(cls):
         q = cls.objects.raw("""
@@ -733,6 +812,80 @@ TS = Triple.objects.searchall
 
 d = D = dict
 
+class Statistics(object):
+    """
+    Tracks how many triples hold the most common values of each field, so
+    Query can estimate how selective each of its literal constraints is.
+    
+    Counts are collected with one grouped query per field, scanning the
+    whole triple table, so they're never collected while building a query.
+    Call refresh() after loading triples, or refresh_if_stale() from a
+    periodic job. Until the first refresh, queries are planned without
+    statistics, and afterwards they use the last counts collected.
+    """
+    
+    def __init__(self, max_age=300, limit=1000):
+        self.max_age = max_age
+        self.limit = limit
+        self.total = 0
+        self.counts = {} # {field name:{text:triple count}}
+        self.floors = {} # {field name:count assumed for untracked values}
+        self.timestamp = None
+        
+    def refresh(self):
+        self.total = Triple.objects.count()
+        for field_name in (S, P, O):
+            column = '_%s_text' % field_name
+            rows = Triple.objects.filter(**{column+'__isnull':False})\
+                .values_list(column)\
+                .annotate(count=Count('id'))\
+                .order_by('-count')[:self.limit]
+            counts = self.counts[field_name] = dict((smart_unicode(text),count) for text,count in rows)
+            # If every value was tracked, an untracked value matches nothing.
+            # Otherwise it's no more common than the rarest tracked value.
+            self.floors[field_name] = min(counts.itervalues()) if len(counts) >= self.limit else 0
+        self.timestamp = time.time()
+        
+    @property
+    def ready(self):
+        """
+        Returns true if counts have been collected.
+        """
+        return self.timestamp is not None
+    
+    @property
+    def stale(self):
+        return not self.ready or time.time() - self.timestamp > self.max_age
+        
+    def refresh_if_stale(self):
+        if self.stale:
+            self.refresh()
+        
+    def count(self):
+        """
+        Returns the total number of triples, as of the last refresh.
+        """
+        return self.total
+        
+    def estimate(self, field_name, text):
+        """
+        Returns the estimated number of triples whose field equals the text,
+        or None if no counts have been collected.
+        """
+        if not self.ready:
+            return
+        return self.counts[field_name].get(smart_unicode(text), self.floors[field_name])
+    
+    def get_bucket(self, field_name, text):
+        """
+        Returns the order of magnitude of estimate().
+        """
+        if not self.ready:
+            return
+        return len(str(self.estimate(field_name, text)))
+
+statistics = Statistics()
+
 class Literal(object):
     def __init__(self, value):
         self.value = value
@@ -760,6 +913,41 @@ class Literal(object):
     
     def sql(self, depth=0):
         return "'%s'" % self.value
+    
+    def atom_sql(self, parameterize=False):
+        """
+        Returns a subquery selecting the id of the Atom interning our value,
+        which the database evaluates once per query.
+        
+        If parameterize is true, the value is referenced by the bind
+        parameter slot assigned by get_shape().
+        """
+        if parameterize:
+            return "(SELECT id FROM triple_atom WHERE text = %%(_p%i)s)" % self.param_index
+        return "(SELECT id FROM triple_atom WHERE text = %s)" % self.sql()
+    
+    def get_shape(self, params, field_name=None):
+        """
+        Returns a hashable description of our role in the query, with any
+        constant value replaced by a bind parameter slot appended to params.
+        
+        Constants compared to the given triple field are also described by
+        their estimated selectivity, since that decides the join order.
+        """
+        if isinstance(self.value, models.Model):
+            return ('model', ContentType.objects.get_for_model(type(self.value)).id, self.value.id)
+        elif self.is_variable or self.value == ANY:
+            return ('var', self.value)
+        self.param_index = len(params)
+        params.append(self.text)
+        return ('param', self.id_var_name, field_name and statistics.get_bucket(field_name, self.text))
+    
+    @property
+    def text(self):
+        """
+        Returns our value in the form stored in a triple's text field.
+        """
+        return self.value if isinstance(self.value, basestring) else str(self.value)
 
 class Thing(object):
     """
@@ -782,7 +970,25 @@ class Thing(object):
                 v = Thing(**v)
             self.items[Literal(k)] = v
     
-    def sql(self, depth=0, table_count=0, parent_table_prefix='t', parent_column=None, variable_map=None, parent_table_alias=None):
+    def get_shape(self, params):
+        """
+        Returns a hashable description of our structure, in the order sql()
+        visits it, with constant values replaced by bind parameter slots
+        appended to params.
+        """
+        items = []
+        for k,v in self.items.iteritems():
+            if isinstance(k,Literal) and k.value.startswith('_'):
+                items.append((('col', k.value), v.get_shape(params)))
+                continue
+            if isinstance(v, Literal):
+                items.append((k.get_shape(params, P), v.get_shape(params, O)))
+            else:
+                items.append((k.get_shape(params, P), v.get_shape(params)))
+        subject = self.subject.get_shape(params, S) if self.subject else None
+        return (subject, tuple(items))
+    
+    def sql(self, depth=0, table_count=0, parent_table_prefix='t', parent_column=None, variable_map=None, parent_table_alias=None, parameterize=False, estimates=None):
         """
         Generates a SQL SELECT query corresponding to N3 structure.
         
@@ -790,8 +996,12 @@ class Thing(object):
             depth := The recursion depth of the current call.
             table_count := An integer of the number of tables joined at the current recursion depth.
             parent_table_prefix := A string used as the prefix for the current table alias.
-            parent_column := The SQL column that is equivalent to the current _object_text.
+            parent_column := The SQL column that is equivalent to the current _object_atom_id.
             variable_map := An index listing all the variables bound to each column.
+            parameterize := If true, constant values are emitted as bind
+                parameter markers. Requires get_shape() to have been called.
+            estimates := An index of the estimated number of rows matched
+                by each table alias.
         """
         
         def _make_table_alias():
@@ -810,6 +1020,8 @@ class Thing(object):
         local_aliases = []
         if variable_map is None:
             variable_map = defaultdict(set) # {variable_name:set([column names])}
+        if estimates is None:
+            estimates = {} # {table alias:estimated row count}
         for k,v in self.items.iteritems():
             
             # Track query of special internal columns.
@@ -827,6 +1039,7 @@ class Thing(object):
                 
             # Add table name for FROM clause.
             table_alias = _make_table_alias()
+            estimate = [statistics.count()]
             
             # Add subject to WHERE clause.
             if parent_column:
@@ -835,27 +1048,30 @@ class Thing(object):
                 # e.g. Given the statement "[] has [attr value]" this
                 # would bind the ?object in the triple "[] has ?object"
                 # to the ?subject in "?subject attr value".
-                where.append("%s = %s._subject_text" % (parent_column,table_alias))
+                where.append("%s = %s._subject_atom_id" % (parent_column,table_alias))
             if len(local_aliases) > 1:
                 # If we've generated multiple tables all using the same subject,
                 # then we need to link all their subjects together.
-                where.append("%s._subject_text = %s._subject_text" % (local_aliases[-2],table_alias))
+                where.append("%s._subject_atom_id = %s._subject_atom_id" % (local_aliases[-2],table_alias))
             if self.subject:
                 # Add the literal subject, if specified.
                 assert isinstance(self.subject, Literal), "Non-literal subjects not supported."#todo:?
                 if isinstance(self.subject.value, models.Model):
                     where.append("%s._subject_id = %s" % (table_alias, self.subject.value.id))
                     where.append("%s._subject_type_id = %s" % (table_alias, ContentType.objects.get_for_model(type(self.subject.value)).id))
+                    estimate.append(1)
                 elif self.subject.is_variable:
                     variable_map[self.subject.value].add("%s._subject_text" % table_alias)
                 else:
                     assert isinstance(self.subject.value, basestring)
-                    where.append("%s._subject_text = %s" % (table_alias, self.subject.sql()))
+                    where.append("%s._subject_atom_id = %s" % (table_alias, self.subject.atom_sql(parameterize)))
+                    estimate.append(statistics.estimate(S, self.subject.text))
             
             # Add predicate to WHERE clause.
             assert isinstance(k, Literal), "Non-literal keys not supported."#todo:?
             if k.value != ANY:
-                where.append("%s._predicate_text = %s" % (table_alias, k.sql()))
+                where.append("%s._predicate_atom_id = %s" % (table_alias, k.atom_sql(parameterize)))
+                estimate.append(statistics.estimate(P, k.text))
             #todo:support models.Model predicates?
             
             # Add object to WHERE clause.
@@ -866,19 +1082,27 @@ class Thing(object):
                 if isinstance(v.value, models.Model):
                     where.append("%s._object_id = %s" % (table_alias, v.value.id))
                     where.append("%s._object_type_id = %s" % (table_alias, ContentType.objects.get_for_model(type(v.value)).id))
+                    estimate.append(1)
                 elif v.is_variable:
                     variable_map[v.value].add("%s._object_text" % table_alias)
                 else:
-                    where.append("%s._object_text = %s" % (table_alias, v.sql()))
+                    where.append("%s._object_atom_id = %s" % (table_alias, v.atom_sql(parameterize)))
+                    estimate.append(statistics.estimate(O, v.text))
+                if statistics.ready:
+                    estimates[table_alias] = min(estimate)
             else:
                 assert isinstance(v, Thing)
+                if statistics.ready:
+                    estimates[table_alias] = min(estimate)
                 _select,_tables,_where = v.sql(depth=depth+1,
                                        #table_count=table_count,
                                        table_count=len(tables)+table_count,
                                        variable_map=variable_map,
                                        parent_table_alias=table_alias,
-                                       parent_column='%s._object_text'%(table_alias,),
-                                       parent_table_prefix=table_alias+'_')
+                                       parent_column='%s._object_atom_id'%(table_alias,),
+                                       parent_table_prefix=table_alias+'_',
+                                       parameterize=parameterize,
+                                       estimates=estimates)
                 select.extend(_select)
                 tables.update(_tables)
                 where.extend(_where)
@@ -890,10 +1114,15 @@ class Thing(object):
         # Otherwise, just return data structures to merge with higher
         # the level.
         if depth == 0:
-            return _build_sql(select, tables, where, variable_map, order_by=None, limit=None)
+            return _build_sql(select, tables, where, variable_map, order_by=None, limit=None, estimates=estimates if statistics.ready else None)
         else:
             return select,tables,where
 
+# Marks a bind parameter in SQL generated by Query.sql(parameterize=True).
+_PARAM_MARKER = re.compile(r"%\(_p([0-9]+)\)s")
+
+_query_plans = {} # {query shape:(sql, parameter slots)}
+
 class Query(object):
     """
     Represents the top-level object containing a triple query.
@@ -924,10 +1153,45 @@ class Query(object):
                         assert isinstance(v, D)
                         self.things.append(Thing(subject=k, **v))
         
-    def sql(self, depth=0, variable_map=None):
+    def get_shape(self, params):
+        """
+        Returns a hashable description of the query's structure, with
+        constant values replaced by bind parameter slots appended to params.
+        Queries differing only in their constants share the same shape.
+        """
+        return (tuple(thing.get_shape(params) for thing in self.things),
+                tuple(self.select or []),
+                tuple(self.constraints),
+                tuple(self.order_by),
+                self.limit,
+                self.same_graph)
+    
+    def compile(self):
+        """
+        Returns the tuple (sql, params), where sql references our constant
+        values as the bind parameters params.
+        
+        The SQL is generated once per query shape and cached, so repeating
+        a query with different constants skips SQL generation, and lets the
+        database reuse its plan.
+        """
+        params = []
+        shape = self.get_shape(params)
+        plan = _query_plans.get(shape)
+        if plan is None:
+            parts = _PARAM_MARKER.split(self.sql(parameterize=True))
+            # Escape literal percent signs, since the SQL is run with
+            # parameters.
+            sql = '%s'.join(part.replace('%', '%%') for part in parts[::2])
+            plan = _query_plans[shape] = (sql, map(int, parts[1::2]))
+        sql,slots = plan
+        return sql, [params[slot] for slot in slots]
+    
+    def sql(self, depth=0, variable_map=None, parameterize=False):
         select = list(self.select or [])
         tables = set()
         where = []
+        estimates = {} # {table alias:estimated row count}
         if variable_map is None:
             variable_map = defaultdict(set) # {variable_name:set([column names])}
             
@@ -935,7 +1199,9 @@ class Query(object):
         for thing in self.things:
             _select,_tables,_where = thing.sql(depth=depth+1,
                                                table_count=len(tables),
-                                               variable_map=variable_map,)
+                                               variable_map=variable_map,
+                                               parameterize=parameterize,
+                                               estimates=estimates)
             select.extend(_select)
             tables.update(_tables)
             where.extend(_where)
@@ -947,6 +1213,7 @@ class Query(object):
                 table_alias = table[table.index(' AS ')+4:]
                 graph_alias = "%s_g%i" % (table_alias, i)
                 tables.add("triple_triple_graphs AS %s" % graph_alias)
+                estimates[graph_alias] = estimates.get(table_alias)
                 where.append("%s.id = %s.triple_id" % (table_alias,graph_alias))
                 if last_graph_alias:
                     where.append("%s.graphid_id = %s.graphid_id" % (graph_alias,last_graph_alias))
@@ -979,26 +1246,70 @@ class Query(object):
         assert limit is None or isinstance(limit, int)
             
         if depth == 0:
-            return _build_sql(select, tables, where, variable_map, order_by, limit)
+            return _build_sql(select, tables, where, variable_map, order_by, limit, estimates if statistics.ready else None)
         else:
             return select,tables,where
         
-    def execute(self):
-        cursor = getDictCursor()
-        cursor.execute(self.sql())
+    def execute(self, chunk_size=300):
+        """
+        Runs the query, returning a cursor that streams the matching rows,
+        as dictionaries, chunk_size at a time.
+        """
+        sql,params = self.compile()
+        cursor = getDictCursor(stream=True, chunk_size=chunk_size)
+        cursor.execute(sql, params)
         return cursor
 
-def _build_sql(select, tables, where, variable_map, order_by, limit):
+def _atom_column(column):
+    """
+    Returns the atom id column interning the given text column.
+    e.g. t1._object_text => t1._object_atom_id
+    """
+    return column[:-len('_text')]+'_atom_id'
+
+# Matches the table alias qualifying a column name.
+_ALIAS_REF = re.compile(r"([a-zA-Z_][a-zA-Z0-9_]*)\.")
+
+def _order_tables(tables, where, estimates):
+    """
+    Returns the tables ordered to join the fewest rows first, preferring at
+    each step a table linked by the WHERE clause to one already placed, so
+    no intermediate cross product is formed.
+    """
+    aliases = dict((table.split(' AS ')[-1], table) for table in tables)
+    links = defaultdict(set) # {alias:set(linked aliases)}
+    for clause in where:
+        referenced = set(_ALIAS_REF.findall(clause)).intersection(aliases)
+        for alias in referenced:
+            links[alias].update(referenced)
+    placed = []
+    remaining = set(aliases)
+    while remaining:
+        linked = [alias for alias in remaining if links[alias].intersection(placed)]
+        alias = min(linked or remaining, key=lambda alias: (estimates.get(alias, sys.maxint), alias))
+        placed.append(alias)
+        remaining.remove(alias)
+    return [aliases[alias] for alias in placed]
+
+def _build_sql(select, tables, where, variable_map, order_by, limit, estimates=None):
     """
     Helper function to join SQL list parts into final SQL query string.
+    
+    If estimates of each table's row count are given, tables are listed in
+    the order returned by _order_tables(), with the constraints on earlier
+    tables first. SQLite is held to that order with CROSS JOIN, since its
+    planner has no statistics of its own to reorder them with.
     """
     # Add column constraints implied by duplicate variable name
-    # usage.
+    # usage. Text columns are compared through their interned atom ids.
     for _variable_name,_columns in variable_map.iteritems():
         _last = None
         for _column in sorted(_columns):
             if _last:
-                where.append("%s = %s" % (_last,_column))
+                if _last.endswith('_text') and _column.endswith('_text'):
+                    where.append("%s = %s" % (_atom_column(_last),_atom_column(_column)))
+                else:
+                    where.append("%s = %s" % (_last,_column))
             _last = _column
     
     # Validate SELECT columns.
@@ -1015,8 +1326,18 @@ def _build_sql(select, tables, where, variable_map, order_by, limit):
     table_aliases = sorted([t.split(' AS ')[-1] for t in tables])
     select_str = select_str % dict(first_alias=table_aliases[0])
     
-    from_str = 'FROM    '+(',\n        '.join(sorted(tables)))
-    where_str = 'WHERE   '+('\n    AND '.join(sorted(where)))
+    if estimates is None:
+        from_str = 'FROM    '+(',\n        '.join(sorted(tables)))
+        where_str = 'WHERE   '+('\n    AND '.join(sorted(where)))
+    else:
+        tables = _order_tables(tables, where, estimates)
+        positions = dict((table.split(' AS ')[-1], i) for i,table in enumerate(tables))
+        def _where_position(clause):
+            return max([positions.get(alias, -1) for alias in _ALIAS_REF.findall(clause)] or [-1])
+        where = sorted(remove_duplicates(where), key=lambda clause: (_where_position(clause), clause))
+        join_str = '\n        CROSS JOIN ' if connection.vendor == 'sqlite' else ',\n        '
+        from_str = 'FROM    '+join_str.join(tables)
+        where_str = 'WHERE   '+('\n    AND '.join(where))
     
     order_by = order_by or []
     order_by_str = ('ORDER BY\n        ' + ',\n        '.join(order_by)) if order_by else ''
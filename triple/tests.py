@@ -11,7 +11,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
 
 from triple import models
-from triple.models import Triple, T, TS, ANY, Query
+from triple.models import Triple, T, TS, ANY, Query, D
 
 class Test(TestCase):
     
@@ -105,6 +105,102 @@ class Test(TestCase):
         self.assertEqual(q[0]['object'], f1.object)
         self.assertEqual(q[0]['fact'], f1)
         
+    def test_atoms(self):
+        """
+        Confirm triple text is interned as atoms, and queries compare the
+        interned ids.
+        """
+        t1 = T('#bob','has-a','hat')
+        t2 = T('#sue','has-a','#bob')
+        g1 = models.GID('#graphs/people')
+        t3 = T(t1, '#belongsTo', g1)
+        self.assertEqual(t1._subject_atom.text, '#bob')
+        self.assertEqual(t1._predicate_atom_id, t2._predicate_atom_id)
+        self.assertEqual(t1._subject_atom_id, t2._object_atom_id)
+        self.assertEqual(t3._subject_atom, None)
+        self.assertEqual(t3._object_atom, None)
+        self.assertEqual(models.Atom.objects.filter(text='has-a').count(), 1)
+        
+        q = Query(where={'?who':D(**{'has-a':D(**{'has-a':'?what'})})}, select=['?who','?what'], same_graph=False)
+        self.assertTrue('_atom_id' in q.sql())
+        rows = list(q.execute())
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['who'], '#sue')
+        self.assertEqual(rows[0]['what'], 'hat')
+        
+        q = Query(where={'?who':D(**{'has-a':'hat'})}, select=['?who'], same_graph=False)
+        self.assertEqual([row['who'] for row in q.execute()], ['#bob'])
+        q = Query(where={'?who':D(**{'has-a':'hats'})}, select=['?who'], same_graph=False)
+        self.assertEqual(list(q.execute()), [])
+        
+        # Triples written without Triple.save() are matched once interned.
+        Triple.objects.filter(id=t1.id).update(_subject_atom=None, _object_atom=None)
+        q = Query(where={'?who':D(**{'has-a':'hat'})}, select=['?who'], same_graph=False)
+        self.assertEqual(list(q.execute()), [])
+        self.assertEqual(Triple.objects.intern_atoms(), 1)
+        self.assertEqual(Triple.objects.intern_atoms(), 0)
+        self.assertEqual([row['who'] for row in q.execute()], ['#bob'])
+        
+    def test_query_streaming(self):
+        """
+        Confirm query results are streamed in chunks.
+        """
+        for i in xrange(7):
+            T('#bob','has-a','hat%i' % i)
+        q = Query(where={'#bob':D(**{'has-a':'?what'})}, select=['?what'], same_graph=False)
+        rows = q.execute(chunk_size=3)
+        self.assertEqual(sorted(row['what'] for row in rows), ['hat%i' % i for i in xrange(7)])
+        
+    def test_query_plans(self):
+        """
+        Confirm queries differing only in their constants share one cached,
+        parameterized SQL plan.
+        """
+        T('#bob','has-a','hat')
+        T("#o'neil",'has-a','cat')
+        q1 = Query(where={'?who':D(**{'has-a':'hat'})}, select=['?who'], same_graph=False)
+        q2 = Query(where={'?who':D(**{'has-a':'cat'})}, select=['?who'], same_graph=False)
+        sql1,params1 = q1.compile()
+        sql2,params2 = q2.compile()
+        self.assertEqual(sql1, sql2)
+        self.assertEqual(sorted(params1), ['has-a', 'hat'])
+        self.assertEqual(sorted(params2), ['cat', 'has-a'])
+        self.assertTrue('hat' not in sql1)
+        self.assertEqual([row['who'] for row in q1.execute()], ['#bob'])
+        self.assertEqual([row['who'] for row in q2.execute()], ["#o'neil"])
+        
+        q3 = Query(where={"#o'neil":D(**{'has-a':'?what'})}, select=['?what'], same_graph=False)
+        self.assertEqual([row['what'] for row in q3.execute()], ['cat'])
+        
+    def test_query_join_order(self):
+        """
+        Confirm query tables are joined most selective first.
+        """
+        for i in xrange(20):
+            T('#thing%i' % i,'has-a','hat%i' % i)
+        T('#thing3','rare','yes')
+        q = Query(where={'?x':D(**{'has-a':'?y', 'rare':'yes'})}, select=['?x','?y'], same_graph=False)
+        
+        # Statistics are never collected while building a query.
+        _statistics = models.statistics
+        models.statistics = models.Statistics()
+        try:
+            self.assertNumQueries(0, q.sql)
+            self.assertTrue('CROSS JOIN' not in q.sql())
+        finally:
+            models.statistics = _statistics
+        
+        models.statistics.refresh()
+        self.assertEqual(models.statistics.estimate('predicate', 'has-a'), 20)
+        self.assertEqual(models.statistics.estimate('predicate', 'rare'), 1)
+        self.assertEqual(models.statistics.estimate('predicate', 'missing'), 0)
+        
+        sql = q.sql()
+        first_alias = sql.split('\n')[2].split(' AS ')[-1]
+        self.assertTrue("%s._predicate_atom_id = (SELECT id FROM triple_atom WHERE text = 'rare')" % first_alias in sql)
+        rows = list(q.execute())
+        self.assertEqual(rows, [{'x':'#thing3', 'y':'hat3'}])
+        
     def test_nested_creation(self):
         """
         Confirm connected triples can be created via shorthand.